@@ -20,15 +20,20 @@ import sys
 
 sys.path.append('hooks/')
 
+import key_rotation
 import multisite
+import profiling
 
 from charmhelpers.core.hookenv import (
     action_fail,
+    action_get,
     config,
     action_set,
+    is_leader,
 )
 from utils import (
     pause_unit_helper,
+    request_per_unit_key,
     resume_unit_helper,
     register_configs,
 )
@@ -122,6 +127,69 @@ def tidydefaults(args):
                     ': {} - {}'.format(zone, cpe.output))
 
 
+def profile_report(args):
+    """Retrieve reports of profiled hook executions"""
+    profiles = profiling.list_profiles(action_get('hook'))
+    profiles = profiles[:action_get('count') or 1]
+    if not profiles:
+        action_fail('No profiles found in {}, is the profile-hooks config '
+                    'option set?'.format(profiling.profile_dir()))
+        return
+    values = {}
+    for index, base in enumerate(profiles):
+        name = 'profile-{}'.format(index)
+        values['{}.path'.format(name)] = base + '.txt'
+        with open(base + '.txt') as f:
+            values['{}.report'.format(name)] = f.read()
+        if action_get('collapsed') and os.path.exists(base + '.collapsed'):
+            with open(base + '.collapsed') as f:
+                values['{}.collapsed'.format(name)] = f.read()
+    action_set(values=values)
+
+
+def rotate_key(args):
+    """Rotate the cephx keys of the gateway units, one unit at a time"""
+    if not is_leader():
+        action_fail('Key rotation must be started on the leader unit')
+        return
+    if not request_per_unit_key():
+        action_fail('Gateway units share a single key, which ceph-mon '
+                    'manages; not rotating')
+        return
+    if not key_rotation.rotation_supported():
+        action_fail('ceph-mon does not support key rotation')
+        return
+    try:
+        rotation = key_rotation.start_rotation()
+    except ValueError as e:
+        action_fail(str(e))
+        return
+    if key_rotation.advance_rotation() or key_rotation.pending_nonce():
+        key_rotation.request_rotation()
+    action_set(values={
+        'nonce': rotation['nonce'],
+        'units': ' '.join(rotation['queue']),
+    })
+
+
+def cancel_key_rotation(args):
+    """Cancel the rotation of the cephx keys of the gateway units"""
+    if not is_leader():
+        action_fail('Key rotation must be cancelled on the leader unit')
+        return
+    try:
+        rotation = key_rotation.cancel_rotation()
+    except ValueError as e:
+        action_fail(str(e))
+        return
+    if request_per_unit_key():
+        key_rotation.request_rotation()
+    action_set(values={
+        'nonce': rotation['nonce'],
+        'units': ' '.join(rotation['queue']),
+    })
+
+
 # A dictionary of all the defined actions to callables (which take
 # parsed arguments).
 ACTIONS = {
@@ -131,6 +199,9 @@ ACTIONS = {
     "readonly": readonly,
     "readwrite": readwrite,
     "tidydefaults": tidydefaults,
+    "profile-report": profile_report,
+    "rotate-key": rotate_key,
+    "cancel-key-rotation": cancel_key_rotation,
 }
 
 
@@ -0,0 +1,679 @@
+#
+# Copyright 2020 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Fake Juju hook tools and system commands for the hook benchmarks.
+
+Every fake command is a script running this one with the name of the
+command, which is dispatched on.  The model the commands act on (config,
+relations, leader settings, multi-site configuration...) is kept in a JSON
+state file named by $BENCH_STATE; system files are kept below $BENCH_ROOT,
+which stands in for / for the paths listed in REDIRECTED.  Every command
+sleeps for the latency configured for it in the state before doing
+anything, to mimic the cost of talking to the Juju agent or to the Ceph
+cluster.
+
+redirect() applies the same mapping to the hook process itself.
+"""
+
+import builtins
+import fcntl
+import grp
+import io
+import json
+import os
+import pwd
+import re
+import shlex
+import sys
+import time
+import uuid
+
+REDIRECTED = (
+    '/etc/',
+    '/run/',
+    '/srv/',
+    '/usr/lib/nagios/',
+    '/usr/local/lib/nagios/',
+    '/var/',
+)
+
+HOOK_TOOLS = (
+    'application-version-set',
+    'close-port',
+    'config-get',
+    'goal-state',
+    'is-leader',
+    'juju-log',
+    'leader-get',
+    'leader-set',
+    'network-get',
+    'open-port',
+    'opened-ports',
+    'relation-get',
+    'relation-ids',
+    'relation-list',
+    'relation-set',
+    'status-get',
+    'status-set',
+    'unit-get',
+)
+
+CEPH_TOOLS = (
+    'ceph',
+    'ceph-authtool',
+    'radosgw-admin',
+)
+
+APT_TOOLS = (
+    'apt-cache',
+    'apt-config',
+    'apt-get',
+    'apt-mark',
+    'dpkg',
+    'dpkg-query',
+)
+
+SYSTEM_TOOLS = (
+    'a2dismod',
+    'a2dissite',
+    'a2enmod',
+    'a2ensite',
+    'add-apt-repository',
+    'chown',
+    'jujud',
+    'ln',
+    'service',
+    'sysctl',
+    'systemctl',
+    'systemd-detect-virt',
+)
+
+TOOLS = HOOK_TOOLS + CEPH_TOOLS + APT_TOOLS + SYSTEM_TOOLS
+
+PACKAGE_VERSIONS = {
+    'apache2': '2.4.29-1ubuntu4.14',
+    'haproxy': '1.8.8-1ubuntu0.11',
+    'ntp': '1:4.2.8p10-3ubuntu1',
+    'ceph-common': '12.2.13-0ubuntu0.18.04.4',
+    'radosgw': '12.2.13-0ubuntu0.18.04.4',
+}
+PACKAGE_DEPENDS = {
+    'radosgw': ['ceph-common'],
+}
+DEFAULT_VERSION = '1.0-1'
+
+JUJU_VERSION = '2.8.1-bionic-amd64'
+
+
+def host_path(path, root=None):
+    """Map an absolute path of the system to its fake below BENCH_ROOT.
+
+    :param path: path to map
+    :type path: Any
+    :param root: fake root, defaults to $BENCH_ROOT
+    :type root: Optional[str]
+    :returns: path mapped, or path unchanged if it is not redirected
+    :rtype: Any
+    """
+    root = root or os.environ.get('BENCH_ROOT')
+    if isinstance(path, bytes):
+        mapped = host_path(os.fsdecode(path), root)
+        return os.fsencode(mapped)
+    if (root and isinstance(path, str) and
+            (path + '/').startswith(REDIRECTED) and
+            not path.startswith(root)):
+        return root + path
+    return path
+
+
+def redirect(root):
+    """Redirect file system access of this process below root.
+
+    Only access through the os module and open() is redirected; that covers
+    everything the charm and charmhelpers do.  Changes of ownership are
+    ignored and every user and group maps to the current ones.
+
+    :param root: fake root
+    :type root: str
+    """
+    os.environ['BENCH_ROOT'] = root
+
+    def _wrap(func, nargs=1):
+        def wrapper(*args, **kwargs):
+            args = list(args)
+            for i in range(min(nargs, len(args))):
+                args[i] = host_path(args[i], root)
+            return func(*args, **kwargs)
+        return wrapper
+
+    for name in ('access', 'chmod', 'listdir', 'lstat', 'mkdir', 'open',
+                 'readlink', 'remove', 'rmdir', 'scandir', 'stat', 'unlink',
+                 'utime'):
+        setattr(os, name, _wrap(getattr(os, name)))
+    for name in ('link', 'rename', 'replace', 'symlink'):
+        setattr(os, name, _wrap(getattr(os, name), nargs=2))
+    builtins.open = io.open = _wrap(io.open)
+    os.chown = os.lchown = os.fchown = lambda *args, **kwargs: None
+
+    user = pwd.getpwuid(os.getuid())
+    group = grp.getgrgid(os.getgid())
+    pwd.getpwnam = lambda name: user
+    grp.getgrnam = lambda name: group
+
+
+class State(object):
+    """The model the fake commands act on, saved on exit if changed."""
+
+    def __init__(self, path=None):
+        self.path = path or os.environ['BENCH_STATE']
+        self._lock = open(self.path + '.lock', 'w')
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        with open(self.path) as f:
+            self.data = json.load(f)
+        self._saved = json.dumps(self.data, sort_keys=True)
+
+    def __enter__(self):
+        return self.data
+
+    def __exit__(self, *exc):
+        if json.dumps(self.data, sort_keys=True) != self._saved:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.data, f, indent=1, sort_keys=True)
+            os.rename(self.path + '.tmp', self.path)
+        self._lock.close()
+
+
+def _dump(value):
+    print(json.dumps(value))
+
+
+def _positional(args):
+    """Drop the options of a hook tool command line, keeping -r's value.
+
+    :returns: relation id, if any, and the positional arguments
+    :rtype: Tuple[Optional[str], List[str]]
+    """
+    rid = None
+    positional = []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg in ('-r', '--relation'):
+            rid = args.pop(0)
+        elif arg == '--format':
+            args.pop(0)
+        elif not arg.startswith('-') or arg == '-':
+            positional.append(arg)
+    return rid, positional
+
+
+def _relation(state, rid):
+    rid = rid or os.environ.get('JUJU_RELATION_ID')
+    return state['relations'][rid]
+
+
+def config_get(state, args):
+    _rid, positional = _positional(args)
+    if positional:
+        _dump(state['config'].get(positional[0]))
+    else:
+        _dump(state['config'])
+
+
+def relation_ids(state, args):
+    _rid, positional = _positional(args)
+    _dump(sorted((rid for rid, relation in state['relations'].items()
+                  if relation['name'] == positional[0]),
+                 key=lambda rid: int(rid.split(':')[1])))
+
+
+def relation_list(state, args):
+    rid, _positional_args = _positional(args)
+    _dump(sorted(unit for unit in _relation(state, rid)['units']
+                 if unit != state['unit']))
+
+
+def relation_get(state, args):
+    rid, positional = _positional(args)
+    attribute = positional[0] if positional else '-'
+    unit = (positional[1] if len(positional) > 1 else
+            os.environ.get('JUJU_REMOTE_UNIT'))
+    settings = _relation(state, rid)['units'].get(unit, {})
+    _dump(settings if attribute == '-' else settings.get(attribute))
+
+
+def relation_set(state, args):
+    if '--help' in args:
+        print('usage: relation-set [options] key=value [key=value ...]\n'
+              '    --file  (= -)\n')
+        return
+    import yaml
+    rid, positional = _positional(args)
+    settings = {}
+    if '--file' in args:
+        with open(args[args.index('--file') + 1]) as f:
+            settings.update(yaml.safe_load(f) or {})
+        positional = positional[1:]
+    for arg in positional:
+        key, value = arg.split('=', 1)
+        settings[key] = value or None
+    relation = _relation(state, rid)
+    local = relation['units'].setdefault(state['unit'], {})
+    for key, value in settings.items():
+        if value is None:
+            local.pop(key, None)
+        else:
+            local[key] = str(value)
+    if relation['name'] == 'mon' and 'broker_req' in settings:
+        _broker_response(state, relation, settings['broker_req'])
+
+
+def _broker_response(state, relation, broker_req):
+    """Answer a Ceph broker request as ceph-mon would."""
+    request = json.loads(broker_req)
+    key = 'broker-rsp-{}'.format(state['unit'].replace('/', '-'))
+    for unit, settings in relation['units'].items():
+        if unit != state['unit']:
+            settings[key] = json.dumps({
+                'exit-code': 0,
+                'request-id': request.get('request-id'),
+            })
+
+
+def leader_get(state, args):
+    _rid, positional = _positional(args)
+    attribute = positional[0] if positional else '-'
+    leader = state['leader']
+    _dump(leader if attribute == '-' else leader.get(attribute))
+
+
+def leader_set(state, args):
+    _rid, positional = _positional(args)
+    for arg in positional:
+        key, value = arg.split('=', 1)
+        if value:
+            state['leader'][key] = value
+        else:
+            state['leader'].pop(key, None)
+
+
+def is_leader(state, args):
+    _dump(state['is_leader'])
+
+
+def status_set(state, args):
+    _rid, positional = _positional(args)
+    state['status'] = {
+        'status': positional[0],
+        'message': positional[1] if len(positional) > 1 else '',
+    }
+
+
+def status_get(state, args):
+    status = state.get('status', {'status': 'unknown', 'message': ''})
+    _dump(dict(status, status_data={}))
+
+
+def unit_get(state, args):
+    _rid, positional = _positional(args)
+    _dump(state['address'])
+
+
+def network_get(state, args):
+    if '--primary-address' in args:
+        print(state['address'])
+        return
+    print('bind-addresses:\n'
+          '- interfacename: eth0\n'
+          '  addresses:\n'
+          '  - address: {0}\n'
+          '    cidr: {1}\n'
+          'egress-subnets:\n'
+          '- {0}/32\n'
+          'ingress-addresses:\n'
+          '- {0}\n'.format(state['address'],
+                           state['address'].rsplit('.', 1)[0] + '.0/24'))
+
+
+def goal_state(state, args):
+    _dump({'units': {}, 'relations': {}})
+
+
+def opened_ports(state, args):
+    _dump(state.get('ports', []))
+
+
+def open_port(state, args):
+    _rid, positional = _positional(args)
+    ports = state.setdefault('ports', [])
+    if positional[0] not in ports:
+        ports.append(positional[0])
+
+
+def close_port(state, args):
+    _rid, positional = _positional(args)
+    if positional[0] in state.get('ports', []):
+        state['ports'].remove(positional[0])
+
+
+def jujud(state, args):
+    print(JUJU_VERSION)
+
+
+def _dpkg_status_path():
+    return host_path('/var/lib/dpkg/status')
+
+
+def _read_dpkg_status():
+    packages = {}
+    with open(_dpkg_status_path()) as f:
+        for stanza in f.read().split('\n\n'):
+            match = re.search(r'^Package: (\S+)$', stanza, re.M)
+            if match:
+                packages[match.group(1)] = stanza.strip()
+    return packages
+
+
+def _write_dpkg_status(packages):
+    path = _dpkg_status_path()
+    with open(path + '.tmp', 'w') as f:
+        f.write('\n\n'.join(packages[name] for name in sorted(packages)))
+        f.write('\n')
+    os.rename(path + '.tmp', path)
+
+
+def dpkg_stanza(package, version=None):
+    """A dpkg status entry of an installed package.
+
+    :rtype: str
+    """
+    return ('Package: {}\n'
+            'Status: install ok installed\n'
+            'Architecture: amd64\n'
+            'Version: {}'.format(
+                package,
+                version or PACKAGE_VERSIONS.get(package, DEFAULT_VERSION)))
+
+
+def apt_get(state, args):
+    if 'install' not in args:
+        return
+    packages = _read_dpkg_status()
+    for arg in args[args.index('install') + 1:]:
+        if arg.startswith('-'):
+            continue
+        if arg.endswith('_'):
+            packages.pop(arg[:-1], None)
+        else:
+            name = re.split('[/=]', arg)[0]
+            for package in [name] + PACKAGE_DEPENDS.get(name, []):
+                packages[package] = dpkg_stanza(package)
+    _write_dpkg_status(packages)
+
+
+def apt_cache(state, args):
+    for package in args:
+        if package.startswith('-') or package == 'show':
+            continue
+        print('Package: {}\n'
+              'Architecture: amd64\n'
+              'Version: {}\n'.format(
+                  package,
+                  PACKAGE_VERSIONS.get(package, DEFAULT_VERSION)))
+
+
+def apt_config(state, args):
+    print('APT "";\n'
+          'APT::Architecture "amd64";\n'
+          'Dir "/";\n'
+          'Dir::State "var/lib/apt/";\n'
+          'Dir::Cache "var/cache/apt/";')
+
+
+def dpkg_query(state, args):
+    installed = _read_dpkg_status()
+    print('Desired=Unknown/Install/Remove/Purge/Hold\n'
+          '||/ Name Version Architecture Description\n'
+          '+++-====-=======-============-===========')
+    missing = 0
+    for package in args:
+        if package.startswith('-'):
+            continue
+        if package in installed:
+            version = re.search(r'^Version: (\S+)$', installed[package],
+                                re.M).group(1)
+            print('ii  {} {} amd64 {}'.format(package, version, package))
+        else:
+            print('dpkg-query: no packages found matching {}'.format(
+                package))
+            missing = 1
+    return missing
+
+
+def _version_key(part):
+    """Sort key of a Debian upstream version or revision."""
+    key = []
+    while part:
+        alpha = re.match(r'[^0-9]*', part).group(0)
+        part = part[len(alpha):]
+        key.append([(0 if c == '~' else
+                     1 if not c else
+                     2 + ord(c) if c.isalpha() else
+                     2 + 256 + ord(c)) for c in alpha] + [1])
+        digits = re.match(r'[0-9]*', part).group(0)
+        part = part[len(digits):]
+        key.append(int(digits or 0))
+    return key
+
+
+def version_compare(a, b):
+    """Compare Debian versions as dpkg --compare-versions does.
+
+    :returns: <0, 0 or >0 as a is older, equal to or newer than b
+    :rtype: int
+    """
+    def split(version):
+        epoch, _, rest = version.rpartition(':')
+        upstream, _, revision = rest.partition('-')
+        if '-' in rest:
+            upstream, revision = rest.rsplit('-', 1)
+        return (int(epoch or 0), _version_key(upstream),
+                _version_key(revision))
+    a, b = split(a), split(b)
+    return (a > b) - (a < b)
+
+
+def dpkg(state, args):
+    if '--print-architecture' in args:
+        print('amd64')
+        return 0
+    if '--compare-versions' in args:
+        a, op, b = args[args.index('--compare-versions') + 1:][:3]
+        result = version_compare(a, b)
+        return 0 if {'lt': result < 0, 'le': result <= 0, 'eq': result == 0,
+                     'ne': result != 0, 'ge': result >= 0, 'gt': result > 0,
+                     }[op] else 1
+    return 0
+
+
+def systemctl(state, args):
+    services = state.setdefault('services', {})
+    positional = [arg for arg in args if not arg.startswith('-')]
+    action, names = positional[0], positional[1:]
+    for name in names:
+        name = name.replace('.service', '')
+        if action == 'is-active':
+            return 0 if services.get(name, 'running') == 'running' else 3
+        elif action == 'is-enabled':
+            return 0
+        elif action in ('start', 'restart', 'reload', 'unmask', 'enable'):
+            services[name] = 'running'
+        elif action in ('stop', 'mask', 'disable'):
+            services[name] = 'stopped'
+    return 0
+
+
+def service(state, args):
+    name, action = args[:2]
+    if action == 'status':
+        return systemctl(state, ['is-active', name])
+    return systemctl(state, [action, name])
+
+
+def sysctl(state, args):
+    for arg in args:
+        if not arg.startswith('-'):
+            print('{} = 0'.format(arg))
+
+
+def systemd_detect_virt(state, args):
+    print('none')
+    return 1
+
+
+def ceph_authtool(state, args):
+    path = host_path(args[0])
+    name = [arg.split('=', 1)[1] for arg in args if arg.startswith('--name')]
+    key = [arg.split('=', 1)[1] for arg in args
+           if arg.startswith('--add-key')]
+    with open(path, 'w') as f:
+        f.write('[{}]\n\tkey = {}\n'.format(name[0], key[0]))
+
+
+def ln(state, args):
+    source, destination = [arg for arg in args if not arg.startswith('-')]
+    destination = host_path(destination)
+    if os.path.lexists(destination):
+        os.remove(destination)
+    os.symlink(host_path(source), destination)
+
+
+def radosgw_admin(state, args):
+    multisite = state.setdefault('multisite', {
+        'realms': [], 'zonegroups': [], 'zones': [], 'users': []})
+    positional = [arg for arg in args if not arg.startswith('-')]
+    options = dict(arg[2:].split('=', 1) for arg in args
+                   if arg.startswith('--') and '=' in arg)
+    kind, action = (positional + ['', ''])[:2]
+    collection = '{}s'.format(kind)
+    if action == 'list' and collection in multisite:
+        _dump({collection: multisite[collection]})
+    elif action == 'create' and collection in multisite:
+        name = options.get('rgw-{}'.format(kind), options.get('uid'))
+        if name not in multisite[collection]:
+            multisite[collection].append(name)
+        if kind == 'user':
+            _dump({'user_id': name, 'keys': [{
+                'user': name,
+                'access_key': uuid.uuid4().hex[:20].upper(),
+                'secret_key': uuid.uuid4().hex,
+            }]})
+        else:
+            _dump({'id': str(uuid.uuid4()), 'name': name})
+    elif (kind, action) == ('realm', 'pull'):
+        realm = state['config'].get('realm')
+        if realm and realm not in multisite['realms']:
+            multisite['realms'].append(realm)
+        _dump({'id': str(uuid.uuid4()), 'name': realm})
+    elif action in ('modify', 'pull'):
+        _dump({'id': str(uuid.uuid4())})
+
+
+def ceph(state, args):
+    _dump({})
+
+
+def noop(state, args):
+    return 0
+
+
+COMMANDS = {
+    'a2dismod': noop,
+    'a2dissite': noop,
+    'a2enmod': noop,
+    'a2ensite': noop,
+    'add-apt-repository': noop,
+    'application-version-set': noop,
+    'apt-cache': apt_cache,
+    'apt-config': apt_config,
+    'apt-get': apt_get,
+    'apt-mark': noop,
+    'ceph': ceph,
+    'ceph-authtool': ceph_authtool,
+    'chown': noop,
+    'close-port': close_port,
+    'config-get': config_get,
+    'dpkg': dpkg,
+    'dpkg-query': dpkg_query,
+    'goal-state': goal_state,
+    'is-leader': is_leader,
+    'juju-log': noop,
+    'jujud': jujud,
+    'leader-get': leader_get,
+    'leader-set': leader_set,
+    'ln': ln,
+    'network-get': network_get,
+    'open-port': open_port,
+    'opened-ports': opened_ports,
+    'radosgw-admin': radosgw_admin,
+    'relation-get': relation_get,
+    'relation-ids': relation_ids,
+    'relation-list': relation_list,
+    'relation-set': relation_set,
+    'service': service,
+    'status-get': status_get,
+    'status-set': status_set,
+    'sysctl': sysctl,
+    'systemctl': systemctl,
+    'systemd-detect-virt': systemd_detect_virt,
+    'unit-get': unit_get,
+}
+
+
+def install_tools(bin_dir, root, state):
+    """Write a script for every fake command into bin_dir.
+
+    The scripts run this module with the interpreter running this one and
+    do not depend on the environment they are run with, as hooks and
+    charmhelpers quite often run commands with an environment of their
+    own.
+
+    :param bin_dir: directory to put in front of $PATH
+    :type bin_dir: str
+    :param root: fake root
+    :type root: str
+    :param state: path of the JSON state file
+    :type state: str
+    """
+    for tool in TOOLS:
+        path = os.path.join(bin_dir, tool)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'BENCH_ROOT={} BENCH_STATE={} exec {} {} {} "$@"\n'.format(
+                        shlex.quote(root), shlex.quote(state),
+                        shlex.quote(sys.executable),
+                        shlex.quote(os.path.abspath(__file__)), tool))
+        os.chmod(path, 0o755)
+
+
+def main(argv):
+    tool = argv[1]
+    with State() as state:
+        time.sleep(state['latency'].get(tool, 0.0))
+        return COMMANDS[tool](state, argv[2:]) or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,567 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the cost of running the charm's hooks end to end.
+
+Each scenario runs a copy of the charm against the fake Juju hook tools and
+system commands of fakes.py, with /etc, /var and friends redirected to a
+temporary directory, so no Juju, Ceph or root access is needed:
+
+    ./benchmarks/hook_bench.py [--latency TOOL=SECONDS] [--repeat N]
+                               [--json] [--update-baseline] [scenario ...]
+
+A scenario first runs the hooks leading to the state it needs, unmeasured,
+then runs and measures its hook in a fresh interpreter: the wall time, the
+number of commands run and the number of files written outside the charm
+directory.  TOOL is the name of a fake command or one of hook-tools, ceph or
+apt.  A non-zero exit code is returned if a scenario runs more commands or
+writes more files than recorded in benchmarks/baseline.json, or is slower
+than the baseline by more than --tolerance.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections import Counter, OrderedDict, namedtuple
+
+import fakes
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CHARM_DIR = os.path.dirname(BENCH_DIR)
+BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+
+CHARM_FILES = ('actions', 'config.yaml', 'files', 'hardening.yaml', 'hooks',
+               'lib', 'metadata.yaml', 'templates')
+
+LOCAL_UNIT = 'ceph-radosgw/0'
+FSID = '7f3ab2f2-5a5b-11ea-8f6c-00163e7b5a5c'
+KEY = 'AQCOp1leAAAAABAAbz9oWfRpb6B3SmBXQ7kK7Q=='
+
+LATENCY_GROUPS = {
+    'apt': fakes.APT_TOOLS,
+    'ceph': fakes.CEPH_TOOLS,
+    'hook-tools': fakes.HOOK_TOOLS,
+}
+
+# Files below the fake root which are not the charm's doing.
+UNRENDERED = ('/var/lib/dpkg/',)
+
+DRIVER = '''
+import json
+import os
+import runpy
+import subprocess
+import sys
+
+sys.path.insert(0, {bench_dir!r})
+import fakes
+
+fakes.redirect(os.environ['BENCH_ROOT'])
+commands = []
+_execute_child = subprocess.Popen._execute_child
+
+
+def _counted(self, args, *popenargs, **kwargs):
+    command = list(args) if isinstance(args, (list, tuple)) else [args]
+    tool = os.path.basename(str(command[0]))
+    commands.append(tool)
+    # NOTE: never run the real thing, whatever PATH the caller passed.
+    if tool in fakes.TOOLS:
+        command[0] = os.path.join(os.environ['BENCH_BIN'], tool)
+        args = command
+    return _execute_child(self, args, *popenargs, **kwargs)
+
+
+subprocess.Popen._execute_child = _counted
+hook, results = sys.argv[1:3]
+sys.argv = [os.path.join('hooks', hook)]
+sys.path.insert(0, os.path.abspath('hooks'))
+code = 0
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+except SystemExit as e:
+    code = e.code if isinstance(e.code, int) else int(bool(e.code))
+finally:
+    with open(results, 'w') as f:
+        json.dump({{'commands': commands, 'exit': code}}, f)
+'''
+
+
+def unit_address(app, index):
+    """A stable address for a unit of a remote application.
+
+    :rtype: str
+    """
+    return '10.5.{}.{}'.format(sum(map(ord, app)) % 200 + 1, 10 + index)
+
+
+def mon_settings(index):
+    name = 'rgw.{}'.format(socket.gethostname())
+    address = unit_address('ceph-mon', index)
+    return {
+        'auth': 'cephx',
+        'ceph-public-address': address,
+        'fsid': FSID,
+        'private-address': address,
+        'radosgw_key': KEY,
+        '{}_key'.format(name): KEY,
+    }
+
+
+def peer_settings(index):
+    address = unit_address('ceph-radosgw', index)
+    return {
+        'admin-address': address,
+        'internal-address': address,
+        'private-address': address,
+        'public-address': address,
+    }
+
+
+def keystone_settings(index):
+    address = unit_address('keystone', index)
+    return {
+        'admin_domain_id': 'fe5ce7e1d7e84f51ba4b4a5e0e5e3a6e',
+        'api_version': '3',
+        'auth_host': address,
+        'auth_port': '35357',
+        'auth_protocol': 'http',
+        'private-address': address,
+        'service_domain': 'service_domain',
+        'service_host': address,
+        'service_password': 'password',
+        'service_port': '5000',
+        'service_protocol': 'http',
+        'service_tenant': 'services',
+        'service_tenant_id': '3bc7b2c3a7e14b2ba2d9b2a8b5e6f4a1',
+        'service_username': 'swift',
+    }
+
+
+def client_settings(index):
+    return {'private-address': unit_address('swift-client', index)}
+
+
+def master_settings(index):
+    return {'private-address': unit_address('ceph-radosgw-secondary', index)}
+
+
+def slave_settings(index):
+    return {
+        'access_key': 'ZRHK5UOD0KFLBO9JZ7UI',
+        'private-address': unit_address('ceph-radosgw-primary', index),
+        'realm': 'bench',
+        'secret': 'W7O0JACV2HQJ3A4P4KHYXYY4AMC3A3EXIQ3WQ7RV',
+        'url': 'http://{}:80'.format(
+            unit_address('ceph-radosgw-primary', index)),
+        'zonegroup': 'bench-zg',
+    }
+
+
+# relation name: (remote application, settings of a remote unit)
+RELATIONS = OrderedDict([
+    ('mon', ('ceph-mon', mon_settings)),
+    ('cluster', ('ceph-radosgw', peer_settings)),
+    ('identity-service', ('keystone', keystone_settings)),
+    ('object-store', ('swift-client', client_settings)),
+    ('master', ('ceph-radosgw-secondary', master_settings)),
+    ('slave', ('ceph-radosgw-primary', slave_settings)),
+])
+
+
+def build_relations(counts, first_id=1):
+    """Relations of the local unit and the settings of their remote units.
+
+    :param counts: relation name to (number of relations, units in each);
+                   peers are numbered from 1, the local unit being 0.
+    :type counts: Dict[str, Tuple[int, int]]
+    :param first_id: number of the first relation id
+    :type first_id: int
+    :returns: relation id to relation
+    :rtype: Dict[str, dict]
+    """
+    relations = OrderedDict()
+    for name, (app, settings) in RELATIONS.items():
+        nrelations, nunits = counts.get(name, (0, 0))
+        for i in range(nrelations):
+            rid = '{}:{}'.format(name, len(relations) + first_id)
+            remote = app if nrelations == 1 else '{}-{}'.format(app, i)
+            first = 1 if name == 'cluster' else 0
+            relations[rid] = {
+                'name': name,
+                'units': OrderedDict(
+                    ('{}/{}'.format(remote, j), settings(j))
+                    for j in range(first, first + nunits)),
+            }
+    return relations
+
+
+def default_config():
+    """Defaults of the charm's config options.
+
+    :rtype: dict
+    """
+    import yaml
+    with open(os.path.join(CHARM_DIR, 'config.yaml')) as f:
+        options = yaml.safe_load(f)['options']
+    return {name: option.get('default')
+            for name, option in options.items()}
+
+
+MULTISITE = {'realm': 'bench', 'zonegroup': 'bench-zg'}
+
+# Hooks run before a unit related to ceph-mon is ready to serve: the first
+# mon-relation-changed sends the broker request, answered straight away by
+# the fake ceph-mon, and the second one gets the keys.
+SETTLE = [
+    ('install.real', None),
+    ('mon-relation-changed', 'mon'),
+    ('mon-relation-changed', 'mon'),
+]
+
+# hook: hook measured
+# relation: name of the relation the hook is run for, if any
+# setup: hooks run, unmeasured, before the relations in joined are added
+# config: config options changed from their defaults
+# counts: relations, as for build_relations(), present from the start
+# joined: relations added just before the hook measured is run
+Scenario = namedtuple('Scenario',
+                      'hook relation setup config counts joined')
+
+SCENARIOS = OrderedDict([
+    ('install', Scenario('install.real', None, [], {}, {}, {})),
+    ('config-changed', Scenario(
+        'config-changed', None, SETTLE, {},
+        {'mon': (1, 3), 'cluster': (1, 2), 'identity-service': (1, 1),
+         'object-store': (1, 1)}, {})),
+    ('mon-relation-changed', Scenario(
+        'mon-relation-changed', 'mon', SETTLE[:2], {}, {'mon': (1, 3)}, {})),
+    ('master-relation-joined', Scenario(
+        'master-relation-joined', 'master', SETTLE,
+        dict(MULTISITE, zone='bench-primary'), {'mon': (1, 3)},
+        {'master': (1, 1)})),
+    ('slave-relation-changed', Scenario(
+        'slave-relation-changed', 'slave', SETTLE,
+        dict(MULTISITE, zone='bench-secondary'), {'mon': (1, 3)},
+        {'slave': (1, 1)})),
+    ('update-status', Scenario(
+        'update-status', None, SETTLE + [('config-changed', None)], {},
+        {'mon': (1, 3), 'cluster': (1, 2)}, {})),
+])
+
+
+def seed_root(root, bin_dir, packages=()):
+    """Populate the fake root with what a fresh Ubuntu machine has.
+
+    :param root: fake root
+    :type root: str
+    :param bin_dir: directory of the fake commands
+    :type bin_dir: str
+    :param packages: packages already installed
+    :type packages: Iterable[str]
+    """
+    for directory in ('etc/apache2/sites-available', 'etc/default',
+                      'etc/haproxy',
+                      'etc/nagios/nrpe.d', 'run/systemd/system',
+                      'var/lib/ceph/radosgw', 'var/lib/dpkg', 'var/log',
+                      'var/lib/juju/tools/machine-0',
+                      'usr/local/lib/nagios/plugins'):
+        os.makedirs(os.path.join(root, directory))
+    files = {
+        'etc/lsb-release': 'DISTRIB_ID=Ubuntu\nDISTRIB_RELEASE=18.04\n'
+                           'DISTRIB_CODENAME=bionic\n'
+                           'DISTRIB_DESCRIPTION="Ubuntu 18.04.4 LTS"\n',
+        'etc/os-release': 'NAME="Ubuntu"\nVERSION_ID="18.04"\nID=ubuntu\n'
+                          'VERSION_CODENAME=bionic\n',
+        'var/lib/dpkg/lock': '',
+        'var/lib/dpkg/lock-frontend': '',
+        'var/lib/dpkg/status': ''.join(
+            fakes.dpkg_stanza(p) + '\n\n' for p in packages),
+    }
+    for path, contents in files.items():
+        with open(os.path.join(root, path), 'w') as f:
+            f.write(contents)
+    os.symlink(os.path.join(bin_dir, 'jujud'),
+               os.path.join(root, 'var/lib/juju/tools/machine-0/jujud'))
+
+
+def snapshot(root):
+    """Size and modification time of every file below root.
+
+    :rtype: Dict[str, Tuple[int, int]]
+    """
+    files = {}
+    for dirpath, _dirnames, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            files[path[len(root):]] = (st.st_size, st.st_mtime_ns)
+    return files
+
+
+class Environment(object):
+    """A temporary charm directory, fake root and model to run hooks in."""
+
+    def __init__(self, config, relations, latency):
+        self.tmp = tempfile.mkdtemp(prefix='hook-bench-')
+        self.root = os.path.join(self.tmp, 'root')
+        self.charm = os.path.join(self.tmp, 'charm')
+        self.bin = os.path.join(self.tmp, 'bin')
+        self.state = os.path.join(self.tmp, 'state.json')
+        os.makedirs(self.charm)
+        os.makedirs(self.bin)
+        for name in CHARM_FILES:
+            source = os.path.join(CHARM_DIR, name)
+            destination = os.path.join(self.charm, name)
+            if os.path.isdir(source):
+                shutil.copytree(source, destination, symlinks=True,
+                                ignore=shutil.ignore_patterns('__pycache__'))
+            elif os.path.exists(source):
+                shutil.copy2(source, destination)
+        fakes.install_tools(self.bin, self.root, self.state)
+        seed_root(self.root, self.bin)
+        model = {
+            'address': '10.5.0.100',
+            'config': dict(default_config(), **config),
+            'is_leader': True,
+            'latency': latency,
+            'leader': {},
+            'relations': relations,
+            'unit': LOCAL_UNIT,
+        }
+        with open(self.state, 'w') as f:
+            json.dump(model, f, indent=1)
+
+    def cleanup(self):
+        shutil.rmtree(self.tmp)
+
+    def model(self):
+        with open(self.state) as f:
+            return json.load(f)
+
+    def join(self, counts):
+        """Add relations, as Juju does before running their joined hooks.
+
+        :param counts: relations to add, as for build_relations()
+        :type counts: Dict[str, Tuple[int, int]]
+        """
+        model = self.model()
+        model['relations'].update(
+            build_relations(counts, len(model['relations']) + 1))
+        with open(self.state, 'w') as f:
+            json.dump(model, f, indent=1)
+
+    def run(self, hook, relation=None):
+        """Run a hook in a fresh interpreter.
+
+        :param hook: name of the hook
+        :type hook: str
+        :param relation: name of the relation the hook is run for; the
+                         first relation of that name and its first remote
+                         unit are used.
+        :type relation: Optional[str]
+        :returns: wall time, commands run and files written
+        :rtype: dict
+        """
+        env = dict(os.environ,
+                   BENCH_BIN=self.bin,
+                   BENCH_ROOT=self.root,
+                   BENCH_STATE=self.state,
+                   CHARM_DIR=self.charm,
+                   JUJU_CHARM_DIR=self.charm,
+                   JUJU_HOOK_NAME=hook,
+                   JUJU_UNIT_NAME=LOCAL_UNIT,
+                   PATH='{}:{}'.format(self.bin, os.environ.get('PATH', '')),
+                   UNIT_STATE_DB=os.path.join(self.tmp, 'unit-state.db'))
+        for name in ('JUJU_RELATION', 'JUJU_RELATION_ID', 'JUJU_REMOTE_UNIT'):
+            env.pop(name, None)
+        if relation:
+            model = self.model()
+            rid = sorted(r for r, data in model['relations'].items()
+                         if data['name'] == relation)[0]
+            env.update(JUJU_RELATION=relation, JUJU_RELATION_ID=rid)
+            remote = [u for u in model['relations'][rid]['units']
+                      if u != LOCAL_UNIT]
+            if remote:
+                env['JUJU_REMOTE_UNIT'] = remote[0]
+        results = os.path.join(self.tmp, 'results.json')
+        before = snapshot(self.root)
+        start = time.monotonic()
+        output = subprocess.run(
+            [sys.executable, '-c', DRIVER.format(bench_dir=BENCH_DIR), hook,
+             results],
+            cwd=self.charm, env=env, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+        wall = time.monotonic() - start
+        with open(results) as f:
+            result = json.load(f)
+        if output.returncode or result['exit']:
+            raise RuntimeError('{} failed:\n{}'.format(
+                hook, output.stdout.decode('UTF-8', 'replace')))
+        after = snapshot(self.root)
+        rendered = sorted(path for path, stat in after.items()
+                          if before.get(path) != stat and
+                          not path.startswith(UNRENDERED))
+        return {
+            'wall': wall,
+            'subprocesses': len(result['commands']),
+            'commands': dict(Counter(result['commands'])),
+            'rendered': rendered,
+        }
+
+
+def run_scenario(name, latency, repeat=1):
+    """Run a scenario, returning the measure of its quickest run.
+
+    :rtype: dict
+    """
+    scenario = SCENARIOS[name]
+    best = None
+    for _ in range(repeat):
+        environment = Environment(scenario.config,
+                                  build_relations(scenario.counts), latency)
+        try:
+            for hook, relation in scenario.setup:
+                environment.run(hook, relation)
+            environment.join(scenario.joined)
+            result = environment.run(scenario.hook, scenario.relation)
+        finally:
+            environment.cleanup()
+        if best is None or result['wall'] < best['wall']:
+            best = result
+    return best
+
+
+def parse_latency(values):
+    """Latency of each fake command from TOOL=SECONDS arguments.
+
+    :rtype: Dict[str, float]
+    """
+    latency = {}
+    for value in values:
+        tool, seconds = value.split('=', 1)
+        for name in LATENCY_GROUPS.get(tool, (tool,)):
+            if name not in fakes.TOOLS:
+                raise ValueError('unknown tool {}'.format(name))
+            latency[name] = float(seconds)
+    return latency
+
+
+def regressions(results, baseline, tolerance):
+    """Compare results with the baseline.
+
+    :returns: description of each regression
+    :rtype: List[str]
+    """
+    found = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            continue
+        for metric in ('subprocesses', 'rendered'):
+            if result[metric] > base[metric]:
+                found.append('{}: {} {} > {}'.format(
+                    name, metric, result[metric], base[metric]))
+        if result['wall_ms'] > base['wall_ms'] * (1 + tolerance):
+            found.append('{}: wall time {:.0f} ms > {:.0f} ms + {:.0%}'.format(
+                name, result['wall_ms'], base['wall_ms'], tolerance))
+    return found
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('scenarios', nargs='*',
+                        help='scenarios to run: {}'.format(
+                            ', '.join(SCENARIOS)))
+    parser.add_argument('--latency', action='append', default=[],
+                        metavar='TOOL=SECONDS',
+                        help='latency of a fake command or group of them')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each scenario, the quickest is kept')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='wall time increase tolerated over baseline')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='baseline to compare with')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='record the results as the new baseline')
+    parser.add_argument('--json', action='store_true',
+                        help='emit results as JSON')
+    parser.add_argument('--verbose', action='store_true',
+                        help='list the commands run and files written')
+    opts = parser.parse_args(args)
+    unknown = set(opts.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: {}'.format(
+            ', '.join(sorted(unknown))))
+
+    latency = parse_latency(opts.latency)
+    results = OrderedDict()
+    details = {}
+    for name in opts.scenarios or SCENARIOS:
+        result = run_scenario(name, latency, opts.repeat)
+        results[name] = {
+            'wall_ms': round(result['wall'] * 1000, 1),
+            'subprocesses': result['subprocesses'],
+            'rendered': len(result['rendered']),
+        }
+        details[name] = result
+
+    if opts.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for name, result in results.items():
+            print('{:28} {:8.1f} ms {:5} commands {:4} files'.format(
+                name, result['wall_ms'], result['subprocesses'],
+                result['rendered']))
+            if opts.verbose:
+                for command, count in sorted(
+                        details[name]['commands'].items()):
+                    print('    {:30} {:5}'.format(command, count))
+                for path in details[name]['rendered']:
+                    print('    {}'.format(path))
+
+    if opts.update_baseline:
+        baseline = {}
+        if os.path.exists(opts.baseline):
+            with open(opts.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(opts.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        return 0
+
+    if os.path.exists(opts.baseline):
+        with open(opts.baseline) as f:
+            baseline = json.load(f)
+        found = regressions(results, baseline, opts.tolerance)
+        if found:
+            print('Regressions against {}:'.format(opts.baseline))
+            for regression in found:
+                print('    {}'.format(regression))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the Python start up cost of each of the charm's hooks.
+
+All hooks are symlinks to hooks/hooks.py so the start up cost of a hook is
+the import of hooks.py plus any module deferred with utils.lazy_import()
+which is referenced from the code path of the hook.  Every hook is
+measured in a fresh interpreter, run from the root of the charm:
+
+    ./benchmarks/hook_startup.py [--max-ms MS] [--json] [hook ...]
+
+A non-zero exit code is returned if the start up cost of any hook exceeds
+--max-ms.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+CHARM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DRIVER = '''
+import json
+import sys
+import time
+import types
+
+sys.path[:0] = ['hooks', 'lib']
+start = time.monotonic()
+import hooks
+import_time = time.monotonic() - start
+
+
+# NOTE: isinstance() would trigger loading of a lazy module so only ever
+#       look at type() of the objects found.
+def _lazy(obj):
+    return type(obj).__name__ == '_LazyModule'
+
+
+def _names(func, seen):
+    if func in seen:
+        return set()
+    seen.add(func)
+    names = set()
+    codes = [func.__code__]
+    while codes:
+        code = codes.pop()
+        names.update(code.co_names)
+        codes.extend(c for c in code.co_consts
+                     if isinstance(c, types.CodeType))
+    for cell in func.__closure__ or ():
+        try:
+            contents = cell.cell_contents
+        except ValueError:
+            continue
+        if type(contents) is types.FunctionType:
+            names |= _names(contents, seen)
+    for name in list(names):
+        obj = getattr(hooks, name, None)
+        if (type(obj) is types.FunctionType and
+                obj.__module__ == hooks.__name__):
+            names |= _names(obj, seen)
+    return names
+
+
+hook = sys.argv[1]
+deferred = {}
+names = _names(hooks.hooks._hooks[hook], set())
+for name in sorted(names):
+    obj = getattr(hooks, name, None)
+    if _lazy(obj):
+        start = time.monotonic()
+        getattr(obj, '__file__')
+        deferred[obj.__name__] = time.monotonic() - start
+print(json.dumps({'import': import_time, 'deferred': deferred}))
+'''
+
+
+def hook_names():
+    """List the hooks which dispatch to hooks.py"""
+    hooks_dir = os.path.join(CHARM_DIR, 'hooks')
+    return sorted(
+        name for name in os.listdir(hooks_dir)
+        if os.path.islink(os.path.join(hooks_dir, name)) and
+        os.readlink(os.path.join(hooks_dir, name)) == 'hooks.py')
+
+
+def measure(hook):
+    """Measure start up cost of a hook in a fresh interpreter
+
+    :param hook: name of the hook
+    :type hook: str
+    :returns: import time of hooks.py and of each deferred module (seconds)
+    :rtype: dict
+    """
+    output = subprocess.check_output(
+        [sys.executable, '-c', DRIVER, hook], cwd=CHARM_DIR)
+    return json.loads(output.decode('UTF-8').splitlines()[-1])
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('hooks', nargs='*', help='hooks to measure')
+    parser.add_argument('--max-ms', type=float,
+                        help='fail if any hook start up exceeds this')
+    parser.add_argument('--json', action='store_true',
+                        help='emit results as JSON')
+    opts = parser.parse_args(args)
+
+    results = {}
+    for hook in opts.hooks or hook_names():
+        result = measure(hook)
+        result['total'] = result['import'] + sum(result['deferred'].values())
+        results[hook] = result
+
+    if opts.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        for hook, result in sorted(results.items()):
+            print('{:40} {:8.1f} ms  (hooks.py {:.1f} ms{})'.format(
+                hook, result['total'] * 1000, result['import'] * 1000,
+                ''.join(', {} {:.1f} ms'.format(m, t * 1000)
+                        for m, t in sorted(result['deferred'].items()))))
+
+    if opts.max_ms:
+        slow = [hook for hook, result in results.items()
+                if result['total'] * 1000 > opts.max_ms]
+        if slow:
+            print('Start up exceeded {} ms: {}'.format(
+                opts.max_ms, ', '.join(sorted(slow))))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure how the cost of hooks grows with the size of the model.
+
+Hooks are run, as by hook_bench.py, against topologies of growing size:
+ceph-mon units, ceph-radosgw peers, object-store consumers (one relation
+each) and keystone units.  In each topology the unit is settled first, then
+the hooks are run one after the other, in the order given.  For each hook
+and topology the wall time, the commands run and the hook tool calls are
+reported, followed by the growth of hook tool calls: the calls per remote
+unit added over the last step divided by those over the first step.  About
+1 means the hook scales linearly with the model, more means each unit
+added costs more than the previous ones did.
+
+    ./benchmarks/topology_scale.py [--size MONS,PEERS,CONSUMERS,KEYSTONES]
+                                   [--max-growth G] [--json]
+                                   [--update-baseline] [hook ...]
+
+A non-zero exit code is returned if a hook makes more hook tool calls than
+recorded in benchmarks/topology_baseline.json for the same topology, or if
+its growth exceeds --max-growth.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from collections import OrderedDict
+
+import fakes
+import hook_bench
+
+BASELINE = os.path.join(hook_bench.BENCH_DIR, 'topology_baseline.json')
+
+# mons, peers, object-store consumers, keystone units; the last one is the
+# size of a large production model.
+SIZES = [
+    (1, 1, 1, 1),
+    (3, 4, 10, 1),
+    (5, 12, 40, 3),
+]
+
+# hook: relation the hook is run for
+HOOKS = OrderedDict([
+    ('config-changed', None),
+    ('mon-relation-changed', 'mon'),
+    ('cluster-relation-changed', 'cluster'),
+    ('identity-service-relation-changed', 'identity-service'),
+    ('object-store-relation-joined', 'object-store'),
+    ('update-status', None),
+])
+
+
+def topology(size):
+    """Relation counts of a topology, as for hook_bench.build_relations().
+
+    :param size: mons, peers, object-store consumers and keystone units
+    :type size: Tuple[int, int, int, int]
+    :rtype: Dict[str, Tuple[int, int]]
+    """
+    mons, peers, consumers, keystones = size
+    return {
+        'cluster': (1, peers),
+        'identity-service': (1, keystones),
+        'mon': (1, mons),
+        'object-store': (consumers, 1),
+    }
+
+
+def remote_units(size):
+    mons, peers, consumers, keystones = size
+    return mons + peers + consumers + keystones
+
+
+def size_name(size):
+    return ','.join(str(n) for n in size)
+
+
+def measure(hooks, size, latency):
+    """Run hooks, one after the other, once a unit is settled in a topology.
+
+    :param hooks: hooks to run
+    :type hooks: List[str]
+    :param size: mons, peers, object-store consumers and keystone units
+    :type size: Tuple[int, int, int, int]
+    :returns: results of each hook
+    :rtype: Dict[str, dict]
+    """
+    environment = hook_bench.Environment({}, hook_bench.build_relations(
+        topology(size)), latency)
+    results = {}
+    try:
+        for setup_hook, setup_relation in hook_bench.SETTLE:
+            environment.run(setup_hook, setup_relation)
+        for hook in hooks:
+            result = environment.run(hook, HOOKS[hook])
+            results[hook] = {
+                'wall_ms': round(result['wall'] * 1000, 1),
+                'subprocesses': result['subprocesses'],
+                'hook_tools': sum(count for command, count in
+                                  result['commands'].items()
+                                  if command in fakes.HOOK_TOOLS),
+            }
+    finally:
+        environment.cleanup()
+    return results
+
+
+def growth(results, sizes):
+    """Hook tool calls per unit added over the last step over the first.
+
+    :param results: results of a hook, by size name
+    :type results: Dict[str, dict]
+    :param sizes: sizes measured, smallest first
+    :type sizes: List[Tuple[int, int, int, int]]
+    :rtype: Optional[float]
+    """
+    if len(sizes) < 3:
+        return None
+
+    def marginal(a, b):
+        calls = (results[size_name(b)]['hook_tools'] -
+                 results[size_name(a)]['hook_tools'])
+        return calls / float(remote_units(b) - remote_units(a))
+
+    first = marginal(sizes[0], sizes[1])
+    last = marginal(sizes[-2], sizes[-1])
+    if first <= 0:
+        return None if last <= 0 else float('inf')
+    return round(last / first, 2)
+
+
+def parse_size(value):
+    size = tuple(int(n) for n in value.split(','))
+    if len(size) != 4 or min(size) < 1:
+        raise argparse.ArgumentTypeError(
+            'expected MONS,PEERS,CONSUMERS,KEYSTONES, got {}'.format(value))
+    return size
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('hooks', nargs='*',
+                        help='hooks to measure: {}'.format(', '.join(HOOKS)))
+    parser.add_argument('--size', type=parse_size, action='append',
+                        metavar='MONS,PEERS,CONSUMERS,KEYSTONES',
+                        help='topology to measure, instead of the default '
+                             'ones; may be repeated')
+    parser.add_argument('--latency', action='append', default=[],
+                        metavar='TOOL=SECONDS',
+                        help='latency of a fake command or group of them')
+    parser.add_argument('--max-growth', type=float,
+                        help='fail if the growth of any hook exceeds this')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='baseline to compare with')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='record the results as the new baseline')
+    parser.add_argument('--json', action='store_true',
+                        help='emit results as JSON')
+    opts = parser.parse_args(args)
+    unknown = set(opts.hooks) - set(HOOKS)
+    if unknown:
+        parser.error('unknown hooks: {}'.format(', '.join(sorted(unknown))))
+
+    sizes = sorted(opts.size or SIZES, key=remote_units)
+    latency = hook_bench.parse_latency(opts.latency)
+    hooks = opts.hooks or list(HOOKS)
+    results = OrderedDict((hook, OrderedDict()) for hook in hooks)
+    for size in sizes:
+        for hook, result in measure(hooks, size, latency).items():
+            results[hook][size_name(size)] = result
+
+    if opts.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print('{:36} {:>12} {:>10} {:>9} {:>10}'.format(
+            'hook', 'topology', 'wall', 'commands', 'hook tools'))
+        for hook, by_size in results.items():
+            for name, result in by_size.items():
+                print('{:36} {:>12} {:>7.0f} ms {:>9} {:>10}'.format(
+                    hook, name, result['wall_ms'], result['subprocesses'],
+                    result['hook_tools']))
+            print('{:36} {:>12} {}'.format(
+                hook, 'growth', growth(by_size, sizes)))
+
+    if opts.update_baseline:
+        baseline = {}
+        if os.path.exists(opts.baseline):
+            with open(opts.baseline) as f:
+                baseline = json.load(f)
+        for hook, by_size in results.items():
+            baseline.setdefault(hook, {}).update(by_size)
+        with open(opts.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        return 0
+
+    found = []
+    if os.path.exists(opts.baseline):
+        with open(opts.baseline) as f:
+            baseline = json.load(f)
+        for hook, by_size in results.items():
+            for name, result in by_size.items():
+                base = baseline.get(hook, {}).get(name)
+                if base and result['hook_tools'] > base['hook_tools']:
+                    found.append('{} at {}: hook tools {} > {}'.format(
+                        hook, name, result['hook_tools'],
+                        base['hook_tools']))
+    if opts.max_growth:
+        for hook, by_size in results.items():
+            hook_growth = growth(by_size, sizes)
+            if hook_growth is not None and hook_growth > opts.max_growth:
+                found.append('{}: growth {} > {}'.format(
+                    hook, hook_growth, opts.max_growth))
+    if found:
+        print('Regressions:')
+        for regression in found:
+            print('    {}'.format(regression))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
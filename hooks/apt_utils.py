@@ -0,0 +1,549 @@
+#
+# Copyright 2020 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Hook scoped package metadata cache.
+
+charmhelpers' ubuntu_apt_pkg.Cache runs ``apt-cache show`` and
+``dpkg-query --list`` for every single package looked up.  The helpers in
+this module share one cache for the lifetime of the hook instead.
+
+Installed package versions are read from an index of the dpkg status
+database kept in unitdata, which is only rebuilt when the database has
+changed, so looking up installed packages does not spawn any process.
+Packages which are not installed are looked up with ``apt-cache show``,
+along with the other packages the charm is known to look at, in a single
+call.  The cache is invalidated by the apt_* wrappers below which change
+what is installed or available.
+
+The apt_* wrappers wait for the dpkg locks to be released before running
+apt, rather than relying on charmhelpers retrying apt every 10 seconds.
+"""
+
+import ctypes
+import ctypes.util
+import fcntl
+import os
+import select
+import struct
+import time
+
+import charmhelpers.fetch as ch_fetch
+
+from charmhelpers.core import unitdata
+from charmhelpers.core.hookenv import (
+    config,
+    log,
+    status_set,
+    DEBUG,
+    WARNING,
+)
+from charmhelpers.fetch import (
+    apt_pkg,
+    ubuntu_apt_pkg,
+)
+
+DPKG_STATUS = '/var/lib/dpkg/status'
+DPKG_LOCKS = [
+    '/var/lib/dpkg/lock-frontend',
+    '/var/lib/dpkg/lock',
+]
+# Seconds between probes of the dpkg locks; a probe is also made as soon as
+# a lock file is closed if inotify is available.
+DPKG_LOCK_POLL = 1
+
+# struct flock on Linux: l_type, l_whence, l_start, l_len, l_pid
+_FLOCK = 'hhqqi'
+_IN_CLOSE = 0x00000008 | 0x00000010  # IN_CLOSE_WRITE | IN_CLOSE_NOWRITE
+
+# unitdata keys holding the index of installed packages and the results of
+# version comparisons, neither of which change unless packages do.
+INSTALLED_INDEX_KEY = 'apt-installed-index'
+VERSION_COMPARE_KEY = 'apt-version-compare'
+INDEX_FORMAT = 2
+
+# Packages looked up by the charm; fetched along with whatever is asked for
+# first so that later lookups in the same hook are served from the cache.
+PREFETCH_PACKAGES = [
+    'apache2',
+    'haproxy',
+    'libapache2-mod-fastcgi',
+    'ntp',
+    'radosgw',
+]
+
+_cache = None
+_installed = None
+_version_compare = None
+_transaction = None
+
+
+class DpkgLockTimeout(Exception):
+    """A dpkg lock was still held once the time to wait for it expired."""
+
+
+def _parse_dpkg_status(path=None):
+    """Parse installed packages from the dpkg status database.
+
+    :param path: Path to dpkg status database
+    :type path: str
+    :returns: version, architecture and hold state of each installed
+              package
+    :rtype: Dict[str, Dict[str, Any]]
+    """
+    packages = {}
+    pkg = {}
+    with open(path or DPKG_STATUS, encoding='UTF-8', errors='replace') as f:
+        for line in f.read().splitlines() + ['']:
+            if not line:
+                status = pkg.get('status', '').split()
+                if status[-1:] == ['installed'] and 'package' in pkg:
+                    packages[pkg['package']] = {
+                        'version': pkg.get('version'),
+                        'architecture': pkg.get('architecture'),
+                        'hold': status[0] == 'hold',
+                    }
+                pkg = {}
+            elif not line.startswith(' ') and ':' in line:
+                key, value = line.split(':', 1)
+                key = key.lower()
+                if key in ('package', 'status', 'version', 'architecture'):
+                    pkg[key] = value.strip()
+    return packages
+
+
+def installed_packages():
+    """Return the index of installed packages.
+
+    The index is kept in unitdata and rebuilt when the modification time or
+    size of the dpkg status database changes.
+
+    :returns: version, architecture and hold state of each installed
+              package
+    :rtype: Dict[str, Dict[str, Any]]
+    """
+    global _installed
+    if _installed is None:
+        st = os.stat(DPKG_STATUS)
+        stamp = [INDEX_FORMAT, st.st_mtime_ns, st.st_size]
+        db = unitdata.kv()
+        index = db.get(INSTALLED_INDEX_KEY)
+        if not index or index.get('stamp') != stamp:
+            index = {'stamp': stamp, 'packages': _parse_dpkg_status()}
+            db.set(INSTALLED_INDEX_KEY, index)
+            db.flush()
+        _installed = index['packages']
+    return _installed
+
+
+class PackageCache(ubuntu_apt_pkg.Cache):
+    """ubuntu_apt_pkg.Cache which remembers packages for the whole hook"""
+
+    def __init__(self, progress=None):
+        super(PackageCache, self).__init__(progress)
+        self._packages = {}
+
+    def prefetch(self, packages):
+        """Fetch information about packages not already in the cache.
+
+        :param packages: Names of packages
+        :type packages: List[str]
+        :raises: subprocess.CalledProcessError
+        """
+        missing = []
+        for package in packages:
+            if package not in self._packages and package not in missing:
+                missing.append(package)
+        installed = installed_packages()
+        unknown = [p for p in missing if p not in installed]
+        apt_results = self._apt_cache_show(unknown) if unknown else {}
+        for package in missing:
+            if package in installed:
+                pkg = ubuntu_apt_pkg.Package({'name': package})
+                pkg.current_ver = ubuntu_apt_pkg.Version(
+                    {'ver_str': installed[package]['version']})
+                pkg.architecture = installed[package]['architecture']
+                self._packages[package] = pkg
+                continue
+            apt_result = apt_results.get(package)
+            if apt_result is None:
+                # remember that the package is unknown to apt
+                self._packages[package] = None
+                continue
+            apt_result['name'] = apt_result.pop('package')
+            pkg = ubuntu_apt_pkg.Package(apt_result)
+            pkg.current_ver = None
+            pkg.architecture = None
+            self._packages[package] = pkg
+
+    def invalidate(self):
+        """Forget everything fetched so far."""
+        self._packages.clear()
+
+    def __getitem__(self, package):
+        """Get information about a package from apt and dpkg databases.
+
+        :param package: Name of package
+        :type package: str
+        :returns: Package object
+        :rtype: object
+        :raises: KeyError, subprocess.CalledProcessError
+        """
+        if package in installed_packages():
+            self.prefetch([package])
+        else:
+            self.prefetch(PREFETCH_PACKAGES + [package])
+        pkg = self._packages[package]
+        if pkg is None:
+            raise KeyError(package)
+        return pkg
+
+
+def apt_cache():
+    """Return the package cache shared for the lifetime of the hook.
+
+    :returns: Object used to interrogate the system apt and dpkg databases.
+    :rtype: PackageCache
+    """
+    global _cache
+    if _cache is None:
+        _cache = PackageCache()
+    return _cache
+
+
+def invalidate_apt_cache():
+    """Invalidate the shared package cache after packages have changed."""
+    global _installed
+    _installed = None
+    if _cache is not None:
+        _cache.invalidate()
+
+
+def filter_installed_packages(packages):
+    """Return a list of packages that require installation."""
+    installed = installed_packages()
+    return [package for package in packages if package not in installed]
+
+
+def filter_missing_packages(packages):
+    """Return a list of packages that are installed.
+
+    :param packages: list of packages to evaluate.
+    :returns list: Packages that are installed.
+    """
+    return list(
+        set(packages) -
+        set(filter_installed_packages(packages))
+    )
+
+
+def cmp_pkgrevno(package, revno):
+    """Compare supplied revno with the revno of the installed package.
+
+    *  1 => Installed revno is greater than supplied arg
+    *  0 => Installed revno is the same as supplied arg
+    * -1 => Installed revno is less than supplied arg
+
+    Results of comparisons, which need up to three calls of dpkg, are kept
+    in unitdata as they only depend on the two versions compared.
+    """
+    global _version_compare
+    if _version_compare is None:
+        _version_compare = unitdata.kv().get(VERSION_COMPARE_KEY) or {}
+    key = '{} {}'.format(apt_cache()[package].current_ver.ver_str, revno)
+    if key not in _version_compare:
+        _version_compare[key] = apt_pkg.version_compare(*key.split(' '))
+        db = unitdata.kv()
+        db.set(VERSION_COMPARE_KEY, _version_compare)
+        db.flush()
+    return _version_compare[key]
+
+
+def get_upstream_version(package):
+    """Determine upstream version based on installed package
+
+    @returns None (if not installed) or the upstream version
+    """
+    try:
+        pkg = apt_cache()[package]
+    except Exception:
+        # the package is unknown to the current apt cache.
+        return None
+
+    if not pkg.current_ver:
+        # package is known, but no version is currently installed.
+        return None
+
+    return apt_pkg.upstream_version(pkg.current_ver.ver_str)
+
+
+def dpkg_lock_holder(path):
+    """Determine the process holding a dpkg lock.
+
+    :param path: Path to dpkg lock file
+    :type path: str
+    :returns: PID of the process holding the lock, -1 if the holder is
+              unknown or None if the lock is not held
+    :rtype: Optional[int]
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        lock = fcntl.fcntl(fd, fcntl.F_GETLK,
+                           struct.pack(_FLOCK, fcntl.F_WRLCK, os.SEEK_SET,
+                                       0, 0, 0))
+    except OSError:
+        return -1
+    finally:
+        os.close(fd)
+    l_type, _, _, _, pid = struct.unpack(_FLOCK, lock)
+    if l_type == fcntl.F_UNLCK:
+        return None
+    return pid if pid > 0 else -1
+
+
+def _dpkg_locks_holder():
+    for path in DPKG_LOCKS:
+        holder = dpkg_lock_holder(path)
+        if holder is not None:
+            return holder
+    return None
+
+
+def _describe_process(pid):
+    try:
+        with open('/proc/{}/comm'.format(pid)) as f:
+            return 'PID {} ({})'.format(pid, f.read().strip())
+    except (IOError, OSError):
+        return 'PID {}'.format(pid) if pid > 0 else 'unknown process'
+
+
+def _inotify_watch(paths):
+    """Watch for lock files being closed, returns a file descriptor or None"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (AttributeError, OSError):
+        return None
+    if fd < 0:
+        return None
+    for path in paths:
+        libc.inotify_add_watch(fd, path.encode('UTF-8'), _IN_CLOSE)
+    return fd
+
+
+def wait_for_dpkg_lock(timeout=None):
+    """Wait for the dpkg locks to be released.
+
+    Returns as soon as no process holds a dpkg lock.  Whilst waiting the
+    holder of the lock is reported in the workload status.
+
+    :param timeout: Seconds to wait for, defaults to the dpkg-lock-timeout
+                    config option; 0 does not wait at all
+    :type timeout: Optional[float]
+    :raises: DpkgLockTimeout if a lock is still held once timeout has
+             expired
+    """
+    if timeout is None:
+        timeout = config('dpkg-lock-timeout') or 0
+    holder = _dpkg_locks_holder()
+    if holder is None or not timeout:
+        return
+    deadline = time.time() + timeout
+    reported = None
+    watch = _inotify_watch(DPKG_LOCKS)
+    try:
+        while holder is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise DpkgLockTimeout(
+                    'dpkg lock still held by {} after {} seconds'
+                    .format(_describe_process(holder), timeout))
+            if holder != reported:
+                message = ('Waiting for dpkg lock held by {}'
+                           .format(_describe_process(holder)))
+                log(message, level=DEBUG)
+                status_set('maintenance', message)
+                reported = holder
+            if watch is None:
+                time.sleep(min(remaining, DPKG_LOCK_POLL))
+            else:
+                select.select([watch], [], [], min(remaining, DPKG_LOCK_POLL))
+                try:
+                    os.read(watch, 4096)
+                except OSError:
+                    pass
+            holder = _dpkg_locks_holder()
+    finally:
+        if watch is not None:
+            os.close(watch)
+
+
+def apt_update(fatal=False, lock_timeout=None):
+    """Update local apt cache and invalidate the package cache."""
+    wait_for_dpkg_lock(lock_timeout)
+    try:
+        ch_fetch.apt_update(fatal=fatal)
+    finally:
+        invalidate_apt_cache()
+
+
+def apt_install(packages, options=None, fatal=False, lock_timeout=None):
+    """Install one or more packages and invalidate the package cache."""
+    wait_for_dpkg_lock(lock_timeout)
+    try:
+        ch_fetch.apt_install(packages, options=options, fatal=fatal)
+    finally:
+        invalidate_apt_cache()
+
+
+def apt_purge(packages, fatal=False, lock_timeout=None):
+    """Purge one or more packages and invalidate the package cache."""
+    wait_for_dpkg_lock(lock_timeout)
+    try:
+        ch_fetch.apt_purge(packages, fatal=fatal)
+    finally:
+        invalidate_apt_cache()
+
+
+class AptTransaction(object):
+    """Package changes gathered over a hook and applied with one apt-get call.
+
+    Install and purge intents are applied with a single ``apt-get install``
+    call, purges being requested with the ``package_`` syntax.  Packages
+    which are already in the state asked for are dropped when the
+    transaction is committed and nothing is run if no package needs
+    changing, not even an apt update.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.update = False
+        self.install = []
+        self.upgrade = []
+        self.purge = []
+
+    @staticmethod
+    def _add(intents, packages):
+        if isinstance(packages, str):
+            packages = [packages]
+        for package in packages:
+            if package not in intents:
+                intents.append(package)
+
+    def add_update(self):
+        """Update the apt cache before installing any package."""
+        self.update = True
+
+    def add_install(self, packages, upgrade=False):
+        """Install packages.
+
+        :param packages: Package(s) to install
+        :type packages: Union[str, List[str]]
+        :param upgrade: Install packages even if they are installed already,
+                        upgrading them to the candidate version
+        :type upgrade: bool
+        """
+        self._add(self.upgrade if upgrade else self.install, packages)
+
+    def add_purge(self, packages):
+        """Purge packages.
+
+        :param packages: Package(s) to purge
+        :type packages: Union[str, List[str]]
+        """
+        self._add(self.purge, packages)
+
+    def plan(self):
+        """Determine the changes needed to reach the state asked for.
+
+        Packages asked for with a release or version, e.g.
+        ``haproxy/trusty-backports``, are always installed.
+
+        :returns: packages to install and purge
+        :rtype: Tuple[List[str], List[str]]
+        """
+        installed = installed_packages()
+        install = list(self.upgrade)
+        install.extend(
+            p for p in self.install
+            if p not in install and
+            ('/' in p or '=' in p or p not in installed))
+        purge = [p for p in self.purge if p in installed]
+        return install, purge
+
+    def commit(self, fatal=True, message=None):
+        """Apply the changes gathered so far.
+
+        :param fatal: Whether the apt-get calls should be checked and retried,
+                      and the dpkg lock waited for; if not, the changes are
+                      dropped when another process holds the lock
+        :type fatal: bool
+        :param message: Maintenance status to set if any package is changed
+        :type message: Optional[str]
+        :raises: subprocess.CalledProcessError, DpkgLockTimeout
+        """
+        if not (self.install or self.upgrade or self.purge):
+            return
+        install, purge = self.plan()
+        update = self.update
+        self.reset()
+        if not (install or purge):
+            log('All packages are in the state asked for, skipping apt',
+                level=DEBUG)
+            return
+        lock_timeout = None
+        if not fatal:
+            holder = _dpkg_locks_holder()
+            if holder is not None:
+                log('dpkg lock held by {}, not applying package changes: {}'
+                    .format(_describe_process(holder),
+                            ' '.join(install + ['{}_'.format(p)
+                                                for p in purge])),
+                    level=WARNING)
+                return
+            lock_timeout = 0
+        if message:
+            status_set('maintenance', message)
+        if update and install:
+            apt_update(fatal=fatal, lock_timeout=lock_timeout)
+        apt_install(install + ['{}_'.format(p) for p in purge],
+                    fatal=fatal, lock_timeout=lock_timeout)
+
+
+def apt_transaction():
+    """Return the package transaction shared for the lifetime of the hook.
+
+    :rtype: AptTransaction
+    """
+    global _transaction
+    if _transaction is None:
+        _transaction = AptTransaction()
+    return _transaction
+
+
+def commit_apt_transaction():
+    """Apply package changes still pending at the end of the hook.
+
+    Changes left for the end of the hook, such as the install of
+    python-dbus for the nrpe checks, are best effort: failing to apply them,
+    or another process holding the dpkg lock, neither fails the hook nor
+    holds it up.  Hooks which need their packages commit the transaction
+    themselves.
+    """
+    apt_transaction().commit(fatal=False)
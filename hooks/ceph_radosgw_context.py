@@ -23,7 +23,6 @@ from charmhelpers.contrib.hahelpers.cluster import (
     determine_api_port,
     determine_apache_port,
 )
-from charmhelpers.core.host import cmp_pkgrevno
 from charmhelpers.core.hookenv import (
     DEBUG,
     WARNING,
@@ -41,8 +40,11 @@ from charmhelpers.contrib.network.ip import (
 )
 from charmhelpers.contrib.storage.linux.ceph import CephConfContext
 
+import ceph_rgw
 import utils
 
+from apt_utils import cmp_pkgrevno
+
 
 class ApacheSSLContext(context.ApacheSSLContext):
     interfaces = ['https']
@@ -217,6 +219,10 @@ class MonContext(context.CephContext):
                          for k in user_provided}
         ctxt.update(user_provided)
 
+        if config('pool-type') == 'erasure-coded':
+            ctxt.update(ceph_rgw.ec_stripe_settings(
+                *ceph_rgw.ec_data_pool_profile()))
+
         if self.context_complete(ctxt):
             # Multi-site Zone configuration is optional,
             # so add after assessment
@@ -13,20 +13,46 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
+import grp
+import hashlib
+import json
 import os
-import subprocess
+import pwd
+import stat
+import tempfile
+import uuid
+
+import yaml
 
 from charmhelpers.core.hookenv import (
     config,
+    is_leader,
+    leader_get,
+    leader_set,
+    local_unit,
+    log,
+    related_units,
+    relation_get,
+    relation_ids,
+    relation_set,
     service_name,
+    DEBUG,
+    INFO,
+    WARNING,
 )
+from charmhelpers.core import unitdata
 
 from charmhelpers.core.host import (
     mkdir,
-    symlink,
+)
+from charmhelpers.contrib.openstack.context import (
+    CephBlueStoreCompressionContext,
 )
 from charmhelpers.contrib.storage.linux.ceph import (
     CephBrokerRq,
+    get_broker_rsp_key,
+    is_request_complete as _is_request_complete,
 )
 
 CEPH_DIR = '/etc/ceph'
@@ -34,8 +60,165 @@ CEPH_RADOSGW_DIR = '/var/lib/ceph/radosgw'
 _radosgw_keyring = "keyring.rados.gateway"
 CEPH_POOL_APP_NAME = 'rgw'
 
+# Relation setting of the ceph-mon units giving the latest broker api
+# version they support; version 2 reports the state of each op.
+BROKER_API_VERSION = 'broker-api-version'
+
+# unitdata key holding the digest of the ops of the last request resumed
+# and how many of its ops were complete then.
+BROKER_RESUMED_KEY = 'broker-request-resumed'
+
+# Pools radosgw creates on start up, by suffix, the others being only
+# created once buckets are.
+STARTUP_POOLS = ('.rgw.root', '.rgw.control', '.rgw.meta', '.rgw.log')
+
+# Performance profiles of erasure coded data pools, by name: the stripe
+# unit of the erasure code profile, values of the data pool and the sizes,
+# in bytes, radosgw writes objects in, see ec_stripe_settings().
+EC_PERFORMANCE_PROFILES = {
+    # Large objects, read and written sequentially.
+    'throughput': {
+        'stripe-unit': 65536,
+        'pool-values': {'compression_mode': 'none', 'fast_read': False},
+        'max-chunk-size': 4194304,
+        'obj-stripe-size': 16777216,
+    },
+    # Compressible objects, written once and seldom read.
+    'capacity': {
+        'stripe-unit': 16384,
+        'pool-values': {'compression_mode': 'aggressive',
+                        'fast_read': False},
+        'max-chunk-size': 4194304,
+        'obj-stripe-size': 4194304,
+    },
+    # Objects of a few hundred KiB or less, read latency mattering most.
+    'small-object': {
+        'stripe-unit': 4096,
+        'pool-values': {'compression_mode': 'none', 'fast_read': True},
+        'max-chunk-size': 524288,
+        'obj-stripe-size': 524288,
+    },
+}
+
+# Leader setting holding the EC performance profile and k the data pool was
+# created with, as JSON.
+EC_DATA_POOL_PROFILE = 'ec-data-pool-profile'
+
+# Groups of pools the rgw-pool-group-settings option applies to, by suffix
+# of the pools, pools not listed being in the meta group.
+POOL_GROUPS = {
+    '.rgw.buckets.data': 'data',
+    '.rgw.buckets.index': 'index',
+    '.rgw.buckets.extra': 'index',
+    '.rgw.log': 'log',
+    '.rgw.usage': 'log',
+    '.rgw.intent-log': 'log',
+    '.rgw.gc': 'log',
+}
+POOL_GROUP_NAMES = ('data', 'index', 'log', 'meta')
+
+# Settings of a pool group, with their type, as keys of the create pool ops.
+POOL_GROUP_KEYS = {
+    'target-size-bytes': int,
+    'target-size-ratio': float,
+    'max-bytes': int,
+    'max-objects': int,
+}
+
+# Broker requests built during the hook, by hash of the config they were
+# built from, and whether requests are complete, by relation and digest of
+# their ops.
+_broker_requests = {}
+_request_states = {}
+
+
+def render_keyring(name, key):
+    """Render a keyring holding a single key, as ceph-authtool does.
+
+    :param name: name of the cephx entity, without the client. prefix
+    :type name: str
+    :param key: cephx key
+    :type key: str
+    :rtype: str
+    """
+    return '[client.{}]\n\tkey = {}\n'.format(name, key)
+
+
+def write_keyring(path, contents, owner, group, perms=0o600):
+    """Atomically write a keyring if its contents or ownership differ.
+
+    The keyring is written to a temporary file in the same directory,
+    which is synced before being renamed over the keyring, so readers only
+    ever see the previous or the new keyring.
+
+    :param path: path of keyring
+    :type path: str
+    :param contents: contents of keyring
+    :type contents: str
+    :param owner: user owning the keyring
+    :type owner: str
+    :param group: group owning the keyring
+    :type group: str
+    :param perms: mode of keyring
+    :type perms: int
+    :returns: whether the keyring was written
+    :rtype: bool
+    """
+    uid = pwd.getpwnam(owner).pw_uid
+    gid = grp.getgrnam(group).gr_gid
+    try:
+        with open(path) as f:
+            current = f.read()
+        st = os.stat(path)
+        if (current == contents and (st.st_uid, st.st_gid) == (uid, gid) and
+                stat.S_IMODE(st.st_mode) == perms):
+            return False
+    except (IOError, OSError):
+        pass
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix='.{}.'.format(os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            os.fchown(f.fileno(), uid, gid)
+            os.fchmod(f.fileno(), perms)
+            f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    return True
+
+
+def _link(source, destination):
+    """Point destination at source unless it already does."""
+    try:
+        if os.readlink(destination) == source:
+            return
+        os.unlink(destination)
+    except OSError:
+        if os.path.lexists(destination):
+            os.unlink(destination)
+    os.symlink(source, destination)
+
 
 def import_radosgw_key(key, name=None):
+    """Write the keyring of the key radosgw uses to access the cluster.
+
+    :param key: cephx key
+    :type key: str
+    :param name: name of the per unit key, None for the legacy global key
+    :type name: Optional[str]
+    :returns: whether the keyring was created or its key changed
+    :rtype: bool
+    """
     if name:
         keyring_path = os.path.join(CEPH_RADOSGW_DIR,
                                     'ceph-{}'.format(name),
@@ -48,36 +231,380 @@ def import_radosgw_key(key, name=None):
         link_path = None
         owner = group = 'root'
 
-    if not os.path.exists(keyring_path):
+    if not os.path.isdir(os.path.dirname(keyring_path)):
         mkdir(path=os.path.dirname(keyring_path),
               owner=owner, group=group, perms=0o750)
-        cmd = [
-            'ceph-authtool',
-            keyring_path,
-            '--create-keyring',
-            '--name=client.{}'.format(
-                name or 'radosgw.gateway'
-            ),
-            '--add-key={}'.format(key)
-        ]
-        subprocess.check_call(cmd)
-        cmd = [
-            'chown',
-            '{}:{}'.format(owner, group),
-            keyring_path
-        ]
-        subprocess.check_call(cmd)
-        # NOTE: add a link to the keyring in /var/lib/ceph
-        # to /etc/ceph so we can use it for radosgw-admin
-        # operations for multi-site configuration
-        if link_path:
-            symlink(keyring_path, link_path)
-        return True
-
-    return False
+    changed = write_keyring(
+        keyring_path,
+        render_keyring(name or 'radosgw.gateway', key),
+        owner, group)
+    # NOTE: add a link to the keyring in /var/lib/ceph
+    # to /etc/ceph so we can use it for radosgw-admin
+    # operations for multi-site configuration
+    if link_path:
+        _link(keyring_path, link_path)
+    return changed
+
+
+def _config_hash(prefix, api_version):
+    return hashlib.sha256(json.dumps(
+        [prefix, api_version, service_name(), dict(config())],
+        sort_keys=True, default=str).encode('UTF-8')).hexdigest()
+
+
+def broker_api_version(relation='mon'):
+    """Broker api version to use, the latest all ceph-mon units support.
+
+    :rtype: int
+    """
+    versions = [1]
+    for rid in relation_ids(relation):
+        for unit in related_units(rid):
+            rdata = relation_get(rid=rid, unit=unit) or {}
+            try:
+                versions.append(int(rdata.get(BROKER_API_VERSION) or 1))
+            except ValueError:
+                versions.append(1)
+    return 2 if len(versions) > 1 and min(versions[1:]) >= 2 else 1
+
+
+def ops_digest(rq):
+    """Stable digest of the ops of a broker request.
+
+    :param rq: broker request
+    :type rq: CephBrokerRq
+    :rtype: str
+    """
+    return hashlib.sha256(
+        json.dumps(rq.ops, sort_keys=True).encode('UTF-8')).hexdigest()
 
 
 def get_create_rgw_pools_rq(prefix=None):
+    """Broker request pre-creating the RGW pools, see _create_rgw_pools_rq.
+
+    The request is only built once per hook for a given config; a copy is
+    returned each time so that callers may add ops to it.
+    """
+    api_version = broker_api_version()
+    key = _config_hash(prefix, api_version)
+    if key not in _broker_requests:
+        _broker_requests[key] = _create_rgw_pools_rq(
+            prefix=prefix, api_version=api_version)
+    return copy.deepcopy(_broker_requests[key])
+
+
+def same_request(rq, other):
+    """Whether two broker requests have the same api version and ops.
+
+    CephBrokerRq's own comparison only looks at a few params of each op,
+    so requests differing in, say, compression settings, target sizes,
+    quotas or the nonce of a key rotation compare equal; all the params
+    of the ops are compared here.
+
+    :param rq: broker request
+    :type rq: CephBrokerRq
+    :param other: broker request to compare with
+    :type other: Optional[CephBrokerRq]
+    :rtype: bool
+    """
+    return (other is not None and rq.api_version == other.api_version and
+            ops_digest(rq) == ops_digest(other))
+
+
+def request_sent(rq, relation='mon'):
+    """Whether the unit last sent the same request on every relation.
+
+    :param rq: broker request
+    :type rq: CephBrokerRq
+    :rtype: bool
+    """
+    for rid in relation_ids(relation):
+        broker_req = relation_get(attribute='broker_req', rid=rid,
+                                  unit=local_unit())
+        if not broker_req or not same_request(
+                rq, CephBrokerRq(raw_request_data=broker_req)):
+            return False
+    return True
+
+
+def is_request_complete(rq, relation='mon'):
+    """Whether ceph-mon completed the same request, see same_request().
+
+    The relation data does not change during a hook, bar the request sent
+    by the unit itself, so the result is kept until a request is sent.
+    """
+    key = (relation, ops_digest(rq))
+    if key not in _request_states:
+        _request_states[key] = (
+            request_sent(rq, relation=relation) and
+            _is_request_complete(rq, relation=relation))
+    return _request_states[key]
+
+
+def send_request_if_needed(rq, relation='mon'):
+    """Send a broker request unless the same one was sent already.
+
+    As charmhelpers' send_request_if_needed() but for the comparison of
+    requests, see same_request().
+    """
+    _request_states.clear()
+    if request_sent(rq, relation=relation):
+        log('Request already sent but not complete, not sending new '
+            'request', level=DEBUG)
+        return
+    for rid in relation_ids(relation):
+        log('Sending request {}'.format(rq.request_id), level=DEBUG)
+        relation_set(relation_id=rid, broker_req=rq.request)
+
+
+def get_request_response(rq, relation='mon'):
+    """Response of ceph-mon to the request the unit last sent, if any.
+
+    :param rq: broker request, for its ops
+    :type rq: CephBrokerRq
+    :returns: the decoded response
+    :rtype: Optional[Dict[str, Any]]
+    """
+    answer = _request_answer(rq, relation=relation)
+    return answer[2] if answer else None
+
+
+def get_request_responder(rq, relation='mon'):
+    """The ceph-mon unit which answered the request the unit last sent.
+
+    The key it publishes is the one current when it processed the request;
+    ceph-mon units which did not publish anything since may still give a
+    key that was rotated since.
+
+    :param rq: broker request, for its ops
+    :type rq: CephBrokerRq
+    :returns: relation id and name of the unit, if any
+    :rtype: Optional[Tuple[str, str]]
+    """
+    answer = _request_answer(rq, relation=relation)
+    return answer[:2] if answer else None
+
+
+def _request_answer(rq, relation='mon'):
+    """Relation id, unit and response of the answer to the request"""
+    broker_key = get_broker_rsp_key()
+    for rid in relation_ids(relation):
+        broker_req = relation_get(attribute='broker_req', rid=rid,
+                                  unit=local_unit())
+        if not broker_req:
+            continue
+        sent = CephBrokerRq(raw_request_data=broker_req)
+        if not same_request(rq, sent):
+            continue
+        for unit in related_units(rid):
+            rsp = (relation_get(rid=rid, unit=unit) or {}).get(broker_key)
+            if not rsp:
+                continue
+            rsp = json.loads(rsp)
+            if rsp.get('request-id') == sent.request_id:
+                return rid, unit, rsp
+    return None
+
+
+def request_pools_ready(rq, relation='mon'):
+    """Whether the pools radosgw needs to start exist, see STARTUP_POOLS.
+
+    Only api version 2 responses report the state of each op, so the pools
+    are ready before the whole request is complete, once the ops creating
+    them and granting access to them are, or are in progress.
+
+    :param rq: broker request
+    :type rq: CephBrokerRq
+    :rtype: bool
+    """
+    rsp = get_request_response(rq, relation=relation)
+    if not rsp or 'ops' not in rsp or len(rsp['ops']) != len(rq.ops):
+        return False
+    for op, state in zip(rq.ops, rsp['ops']):
+        needed = (
+            op['op'] == 'add-permissions-to-key' or
+            op['op'] == 'create-pool' and op['name'].endswith(STARTUP_POOLS))
+        if needed and state.get('state') not in ('complete', 'in-progress'):
+            return False
+    log('Pools needed by radosgw are ready', level=DEBUG)
+    return True
+
+
+def resume_request(rq, relation='mon'):
+    """Send again a request which failed part way through, if worth it.
+
+    ceph-mon resumes api version 2 requests from the op which failed when
+    sent again with a new request id.  They are only sent again if more ops
+    completed than the last time, so that a request failing again at the
+    same op is not sent over and over.
+
+    :param rq: broker request
+    :type rq: CephBrokerRq
+    :returns: whether the request was sent again
+    :rtype: bool
+    """
+    rsp = get_request_response(rq, relation=relation)
+    if not rsp or rsp.get('api-version') != 2 or not rsp.get('exit-code'):
+        return False
+    done = len([state for state in rsp.get('ops', [])
+                if state.get('state') in ('complete', 'in-progress')])
+    db = unitdata.kv()
+    resumed = db.get(BROKER_RESUMED_KEY) or {}
+    if resumed.get('digest') == ops_digest(rq) and done <= resumed['done']:
+        log('Broker request failed again: {}'.format(rsp.get('stderr')),
+            level=INFO)
+        return False
+    db.set(BROKER_RESUMED_KEY, {'digest': ops_digest(rq), 'done': done})
+    db.flush()
+    rq.request_id = str(uuid.uuid1())
+    log('Resuming broker request, {} of {} ops done, as {}'.format(
+        done, len(rq.ops), rq.request_id), level=INFO)
+    _request_states.clear()
+    # NOTE: published straight away, as charmhelpers does when sending the
+    # request, since get_request_response() reads it back in the same hook.
+    for rid in relation_ids(relation):
+        relation_set(relation_id=rid, broker_req=rq.request)
+    return True
+
+
+def data_pool_compression():
+    """BlueStore compression settings of the data pool, as configured.
+
+    :returns: keyword arguments of the CephBrokerRq create pool ops
+    :rtype: Dict[str, Any]
+    :raises: AssertionError or ValueError if the settings are not valid
+    """
+    context = CephBlueStoreCompressionContext()
+    settings = {op_key.replace('-', '_'): value
+                for op_key, value in context.get_op().items()
+                if value is not None}
+    if settings:
+        # Validation queries the installed ceph version, so leave it to
+        # deployments which set compression at all.
+        context.validate()
+    return settings
+
+
+def pool_group_settings():
+    """Settings of the pool groups, as configured.
+
+    :returns: settings of each group configured, by group
+    :rtype: Dict[str, Dict[str, Union[int, float]]]
+    :raises: ValueError if the settings are not valid
+    """
+    try:
+        settings = yaml.safe_load(config('rgw-pool-group-settings') or '{}')
+    except yaml.YAMLError as e:
+        raise ValueError('rgw-pool-group-settings is not valid YAML: '
+                         '{}'.format(e))
+    if not isinstance(settings, dict):
+        raise ValueError('rgw-pool-group-settings is not a dictionary')
+    for group, values in settings.items():
+        if group not in POOL_GROUP_NAMES:
+            raise ValueError('unknown pool group {}'.format(group))
+        if not isinstance(values, dict):
+            raise ValueError('settings of pool group {} are not a '
+                             'dictionary'.format(group))
+        for key, value in values.items():
+            if key not in POOL_GROUP_KEYS:
+                raise ValueError('unknown setting {} of pool group '
+                                 '{}'.format(key, group))
+            # NOTE: integers are valid ratios but booleans are integers.
+            valid = (not isinstance(value, bool) and
+                     isinstance(value, (int, POOL_GROUP_KEYS[key])) and
+                     value > 0)
+            if not valid:
+                raise ValueError('{} of pool group {} must be a positive '
+                                 '{}'.format(key, group,
+                                             POOL_GROUP_KEYS[key].__name__))
+        if 'target-size-bytes' in values and 'target-size-ratio' in values:
+            raise ValueError('pool group {} has both target-size-bytes and '
+                             'target-size-ratio'.format(group))
+    return settings
+
+
+def _add_pool_group_settings(rq, pool, settings):
+    """Add the settings of the group of a pool to its create pool op.
+
+    :param rq: broker request, its last op creating the pool
+    :type rq: CephBrokerRq
+    :param pool: name of the pool, without prefix
+    :type pool: str
+    :param settings: settings of the pool groups, see pool_group_settings()
+    :type settings: Dict[str, Dict[str, Union[int, float]]]
+    """
+    # NOTE: the quotas are the max-bytes and max-objects keys CephBrokerRq
+    #       sets, it does not know of the target sizes, brokers which do not
+    #       know of them ignoring them.
+    values = settings.get(POOL_GROUPS.get(pool, 'meta'))
+    if values:
+        rq.ops[-1].update(values)
+
+
+def ec_data_pool_profile():
+    """EC performance profile and k the data pool was created with.
+
+    Ceph fixes the stripe width of an erasure coded pool when it creates
+    it, so the settings of the pool and of radosgw derive from the profile
+    recorded once the pool exists, see record_ec_data_pool_profile(),
+    rather than from the configured one.
+
+    :returns: name of the profile, if any, and k; the configured ones until
+              the pool is known to exist
+    :rtype: Tuple[Optional[str], int]
+    """
+    recorded = leader_get(EC_DATA_POOL_PROFILE)
+    if recorded:
+        recorded = json.loads(recorded)
+        return recorded['profile'], recorded['k']
+    return config('ec-performance-profile'), config('ec-profile-k')
+
+
+def record_ec_data_pool_profile():
+    """Record the profile the data pool was created with, leader only.
+
+    To be called once the request creating the pool is complete.
+    """
+    if (config('pool-type') != 'erasure-coded' or not is_leader() or
+            leader_get(EC_DATA_POOL_PROFILE)):
+        return
+    profile = {'profile': config('ec-performance-profile'),
+               'k': config('ec-profile-k')}
+    log('Data pool created with EC performance profile {}'.format(
+        profile['profile']), level=INFO)
+    leader_set({EC_DATA_POOL_PROFILE: json.dumps(profile)})
+
+
+def ec_stripe_settings(profile_name, k):
+    """radosgw settings matching an EC performance profile.
+
+    radosgw writes objects in chunks of rgw_max_chunk_size, striping them
+    over rados objects of rgw_obj_stripe_size.  Both are rounded down to
+    multiples of the stripe width of the data pool, k stripe units, so that
+    writes fill whole stripes.
+
+    :param profile_name: name of the profile, see EC_PERFORMANCE_PROFILES
+    :type profile_name: Optional[str]
+    :param k: number of data chunks of the erasure code profile
+    :type k: int
+    :returns: rgw_max_chunk_size and rgw_obj_stripe_size, if any profile
+    :rtype: Dict[str, int]
+    """
+    profile = EC_PERFORMANCE_PROFILES.get(profile_name)
+    if not profile:
+        return {}
+    stripe_width = k * profile['stripe-unit']
+    chunk_size = (max(1, profile['max-chunk-size'] // stripe_width) *
+                  stripe_width)
+    obj_stripe_size = (max(1, profile['obj-stripe-size'] // chunk_size) *
+                       chunk_size)
+    return {
+        'rgw_max_chunk_size': chunk_size,
+        'rgw_obj_stripe_size': obj_stripe_size,
+    }
+
+
+def _create_rgw_pools_rq(prefix=None, api_version=1):
     """Pre-create RGW pools so that they have the correct settings.
 
     If a prefix is provided it will be prepended to each pool name.
@@ -98,17 +625,20 @@ def get_create_rgw_pools_rq(prefix=None):
         }
         w = weights.get(pool, 0.10)
         if prefix:
-            pool = "{prefix}{pool}".format(prefix=prefix, pool=pool)
+            name = "{prefix}{pool}".format(prefix=prefix, pool=pool)
+        else:
+            name = pool
         if pg_num > 0:
-            rq.add_op_create_pool(name=pool, replica_count=replicas,
+            rq.add_op_create_pool(name=name, replica_count=replicas,
                                   pg_num=pg_num, group='objects',
                                   app_name=CEPH_POOL_APP_NAME)
         else:
-            rq.add_op_create_pool(name=pool, replica_count=replicas,
+            rq.add_op_create_pool(name=name, replica_count=replicas,
                                   weight=w, group='objects',
                                   app_name=CEPH_POOL_APP_NAME)
+        _add_pool_group_settings(rq, pool, group_settings)
 
-    rq = CephBrokerRq()
+    rq = CephBrokerRq(api_version=api_version)
     replicas = config('ceph-osd-replication-count')
 
     prefix = prefix or 'default'
@@ -118,6 +648,17 @@ def get_create_rgw_pools_rq(prefix=None):
         '.rgw.buckets.data'
     ]
     bucket_weight = config('rgw-buckets-pool-weight')
+    try:
+        compression = data_pool_compression()
+    except (AssertionError, ValueError) as e:
+        log('Ignoring BlueStore compression settings: {}'.format(e),
+            level=WARNING)
+        compression = {}
+    try:
+        group_settings = pool_group_settings()
+    except ValueError as e:
+        log('Ignoring rgw-pool-group-settings: {}'.format(e), level=WARNING)
+        group_settings = {}
 
     if config('pool-type') == 'erasure-coded':
         # General EC plugin config
@@ -151,22 +692,42 @@ def get_create_rgw_pools_rq(prefix=None):
             erasure_type=plugin,
             erasure_technique=technique
         )
+        performance = EC_PERFORMANCE_PROFILES.get(ec_data_pool_profile()[0])
+        if performance:
+            # NOTE: CephBrokerRq does not know of the stripe unit.
+            for op in rq.ops:
+                if (op['op'] == 'create-erasure-profile' and
+                        op['name'] == profile_name):
+                    op['stripe-unit'] = performance['stripe-unit']
 
-        for pool in heavy:
-            pool = "{prefix}{pool}".format(prefix=prefix, pool=pool)
+        for suffix in heavy:
+            pool = "{prefix}{pool}".format(prefix=prefix, pool=suffix)
             rq.add_op_create_erasure_pool(
                 name=pool,
                 erasure_profile=profile_name,
                 weight=bucket_weight,
                 group="objects",
-                app_name=CEPH_POOL_APP_NAME
+                app_name=CEPH_POOL_APP_NAME,
+                **compression
             )
+            _add_pool_group_settings(rq, suffix, group_settings)
+            if performance:
+                for key, value in sorted(performance['pool-values'].items()):
+                    # NOTE: compression configured explicitly prevails.
+                    if key in compression:
+                        continue
+                    rq.add_op({'op': 'set-pool-value', 'name': pool,
+                               'key': key, 'value': value})
     else:
-        for pool in heavy:
-            pool = "{prefix}{pool}".format(prefix=prefix, pool=pool)
-            rq.add_op_create_pool(name=pool, replica_count=replicas,
-                                  weight=bucket_weight, group='objects',
-                                  app_name=CEPH_POOL_APP_NAME)
+        for suffix in heavy:
+            pool = "{prefix}{pool}".format(prefix=prefix, pool=suffix)
+            rq.add_op_create_replicated_pool(name=pool,
+                                             replica_count=replicas,
+                                             weight=bucket_weight,
+                                             group='objects',
+                                             app_name=CEPH_POOL_APP_NAME,
+                                             **compression)
+            _add_pool_group_settings(rq, suffix, group_settings)
 
     # NOTE: we want these pools to have a smaller pg_num/pgp_num than the
     # others since they are not expected to contain as much data
@@ -192,8 +753,13 @@ def get_create_rgw_pools_rq(prefix=None):
     _add_light_pool(rq, '.rgw.root', pg_num)
 
     if config('restrict-ceph-pools'):
-        rq.add_op_request_access_to_group(name="objects",
-                                          permission='rwx',
-                                          key_name='radosgw.gateway')
+        # NOTE: app-name asks the broker to grant access to the pools of the
+        #       group by their application tag, rather than pool by pool,
+        #       brokers which do not know of it ignoring it.
+        rq.add_op({'op': 'add-permissions-to-key',
+                   'group': 'objects',
+                   'name': 'radosgw.gateway',
+                   'group-permission': 'rwx',
+                   'app-name': CEPH_POOL_APP_NAME})
 
     return rq
@@ -0,0 +1,185 @@
+#
+# Copyright 2020 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+import hashlib
+import os
+import time
+
+from collections import OrderedDict
+
+import charmhelpers.contrib.hardening.harden as ch_harden
+
+from charmhelpers.core.hookenv import (
+    charm_dir,
+    config,
+    log,
+    DEBUG,
+)
+from charmhelpers.core import unitdata
+
+# unitdata key holding the fingerprint of each hardening module's targets as
+# recorded after it was last applied.
+HARDENING_FINGERPRINTS_KEY = 'hardening-fingerprints'
+
+# Default hardening settings shipped with charmhelpers.
+HARDENING_DEFAULTS_DIR = os.path.join(os.path.dirname(ch_harden.__file__),
+                                      'defaults')
+
+# Files and directories audited, or read to drive the audits, by each of the
+# charmhelpers hardening modules.
+HARDENING_TARGETS = OrderedDict([
+    ('os', [
+        '/etc/group',
+        '/etc/gshadow',
+        '/etc/login.defs',
+        '/etc/modprobe.d',
+        '/etc/pam.d',
+        '/etc/passwd',
+        '/etc/profile.d',
+        '/etc/securetty',
+        '/etc/security',
+        '/etc/shadow',
+        '/etc/sysctl.conf',
+        '/etc/sysctl.d',
+        '/usr/share/pam-configs',
+        '/var/lib/dpkg/status',
+    ]),
+    ('ssh', [
+        '/etc/ssh',
+        '/var/lib/dpkg/status',
+    ]),
+    ('mysql', [
+        '/etc/mysql',
+        '/var/lib/dpkg/status',
+    ]),
+    ('apache', [
+        '/etc/apache2',
+        '/var/lib/dpkg/status',
+    ]),
+])
+
+
+def _stat(path):
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return '{} missing'.format(path)
+    return '{} {} {} {} {} {}'.format(path, st.st_mode, st.st_uid, st.st_gid,
+                                      st.st_size, st.st_mtime_ns)
+
+
+def fingerprint(module):
+    """Fingerprint the state of the targets of a hardening module.
+
+    Only file metadata is looked at (mode, ownership, size and mtime) so
+    this is cheap in comparison with running the audits. The hardening
+    defaults shipped with the charm and any user provided hardening.yaml
+    are included so that changes to them are picked up.
+
+    :param module: name of hardening module (os, ssh, mysql, apache)
+    :type module: str
+    :returns: hex digest
+    :rtype: str
+    """
+    paths = [
+        os.path.join(HARDENING_DEFAULTS_DIR, '{}.yaml'.format(module)),
+        os.path.join(charm_dir() or '', 'hardening.yaml'),
+    ]
+    paths.extend(HARDENING_TARGETS.get(module, []))
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(_stat(path).encode('UTF-8'))
+        if not os.path.isdir(path) or os.path.islink(path):
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(dirs + files):
+                digest.update(_stat(os.path.join(root, name)).encode('UTF-8'))
+    return digest.hexdigest()
+
+
+def stale_modules(modules):
+    """Determine which hardening modules need their audits running.
+
+    A module is stale if it has not been applied before, if the fingerprint
+    of its targets has changed since it was last applied or if it was last
+    applied longer ago than the harden-sweep-interval config option.
+
+    :param modules: hardening modules enabled
+    :type modules: List[str]
+    :returns: modules which need their audits running
+    :rtype: List[str]
+    """
+    interval = (config('harden-sweep-interval') or 0) * 60
+    recorded = unitdata.kv().get(HARDENING_FINGERPRINTS_KEY) or {}
+    stale = []
+    for module in modules:
+        previous = recorded.get(module)
+        if (module not in HARDENING_TARGETS or not previous or
+                not interval or
+                time.time() - previous['timestamp'] > interval or
+                fingerprint(module) != previous['fingerprint']):
+            stale.append(module)
+    return stale
+
+
+def record_modules(modules):
+    """Record the fingerprint of hardening modules which have been applied.
+
+    :param modules: hardening modules applied
+    :type modules: List[str]
+    """
+    db = unitdata.kv()
+    recorded = db.get(HARDENING_FINGERPRINTS_KEY) or {}
+    for module in modules:
+        if module in HARDENING_TARGETS:
+            recorded[module] = {
+                'fingerprint': fingerprint(module),
+                'timestamp': time.time(),
+            }
+    db.set(HARDENING_FINGERPRINTS_KEY, recorded)
+    db.flush()
+
+
+def harden(overrides=None):
+    """Hardening decorator which skips modules whose targets are unchanged.
+
+    Behaves as charmhelpers' harden() decorator except that only the
+    modules returned by stale_modules() are run; the fingerprints of the
+    modules run are recorded as soon as they have completed, before the
+    decorated function is called, so that changes it makes to the targets
+    are audited by the next hook.
+
+    :param overrides: Optional list of stack modules used to override those
+                      provided with 'harden' config.
+    :returns: Returns value returned by decorated function once executed.
+    """
+    def _harden_inner1(f):
+        def _harden_inner2(*args, **kwargs):
+            enabled = overrides or (config('harden') or '').split()
+            modules = stale_modules(enabled)
+            if not modules:
+                if enabled:
+                    log("Hardening of '{}' is up to date for '{}'"
+                        .format(' '.join(enabled), f.__name__), level=DEBUG)
+                return f(*args, **kwargs)
+            ch_harden.harden(overrides=modules)(
+                functools.wraps(f)(lambda: None))()
+            record_modules(modules)
+            return f(*args, **kwargs)
+        return _harden_inner2
+
+    return _harden_inner1
@@ -0,0 +1,218 @@
+#
+# Copyright 2020 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Accounting and memoization of the Juju hook tools run by hookenv.
+
+charmhelpers' hookenv runs every hook tool through the subprocess module it
+imported.  install() swaps that module, for hookenv only, for a
+HookToolClient which:
+
+* remembers the output of read-only hook tools for the rest of the hook,
+  forgetting it again when a hook tool changing it is run;
+* serves ``relation-get`` of a single setting of a unit from all of the
+  unit's settings, fetched once, so reading several settings of a unit
+  costs one call;
+* counts the calls of each hook tool and the time spent in them, which is
+  logged once the hook has completed.
+"""
+
+import json
+import os
+import subprocess
+import time
+
+from collections import OrderedDict
+
+from charmhelpers.core import hookenv
+
+# Hook tools whose output only changes when a hook tool below changes it.
+READ_ONLY_TOOLS = frozenset([
+    'action-get',
+    'config-get',
+    'goal-state',
+    'is-leader',
+    'leader-get',
+    'network-get',
+    'relation-get',
+    'relation-ids',
+    'relation-list',
+    'storage-get',
+    'storage-list',
+    'unit-get',
+])
+
+# Hook tools changing the output of read-only hook tools.
+INVALIDATES = {
+    'leader-set': ('leader-get',),
+    'relation-set': ('relation-get',),
+}
+
+HOOK_TOOLS = READ_ONLY_TOOLS | frozenset([
+    'action-fail',
+    'action-log',
+    'action-set',
+    'application-version-set',
+    'close-port',
+    'juju-log',
+    'juju-reboot',
+    'leader-set',
+    'open-port',
+    'opened-ports',
+    'relation-set',
+    'status-get',
+    'status-set',
+])
+
+
+class HookToolClient(object):
+    """Stand in for the subprocess module used by hookenv."""
+
+    def __init__(self, subprocess_module=subprocess):
+        self._subprocess = subprocess_module
+        self._results = {}
+        self.stats = OrderedDict()
+
+    def __getattr__(self, name):
+        return getattr(self._subprocess, name)
+
+    @staticmethod
+    def _tool(args):
+        if isinstance(args, (list, tuple)) and args:
+            tool = os.path.basename(str(args[0]))
+            if tool in HOOK_TOOLS:
+                return tool
+        return None
+
+    def _account(self, tool, seconds=0.0, memoized=False):
+        stats = self.stats.setdefault(
+            tool, {'calls': 0, 'memoized': 0, 'seconds': 0.0})
+        if memoized:
+            stats['memoized'] += 1
+        else:
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+
+    def _run(self, func, tool, args, *popenargs, **kwargs):
+        if tool is None:
+            return func(args, *popenargs, **kwargs)
+        for invalidated in INVALIDATES.get(tool, ()):
+            self.forget(invalidated)
+        start = time.time()
+        try:
+            return func(args, *popenargs, **kwargs)
+        finally:
+            self._account(tool, time.time() - start)
+
+    def forget(self, tool=None):
+        """Forget remembered output of a read-only hook tool, or all of them.
+
+        :param tool: name of hook tool
+        :type tool: Optional[str]
+        """
+        for key in list(self._results):
+            if tool is None or key[0] == tool:
+                del self._results[key]
+
+    def _relation_get_unit(self, args):
+        """Split relation-get of a single setting into all and the setting.
+
+        :returns: arguments of relation-get of all settings and name of
+                  setting, or None if args do not get a single setting of
+                  a unit on a relation.
+        :rtype: Optional[Tuple[List[str], str]]
+        """
+        args = list(args)
+        if (len(args) == 6 and args[1] == '--format=json' and
+                args[2] == '-r' and args[4] != '-'):
+            attribute = args[4]
+            args[4] = '-'
+            return args, attribute
+        return None
+
+    def check_output(self, args, *popenargs, **kwargs):
+        tool = self._tool(args)
+        read_only = (tool in READ_ONLY_TOOLS or
+                     (tool == 'relation-set' and '--help' in args))
+        if not read_only:
+            return self._run(self._subprocess.check_output, tool, args,
+                             *popenargs, **kwargs)
+        key = (tool, json.dumps([args, popenargs, kwargs], sort_keys=True,
+                                default=str))
+        if key in self._results:
+            self._account(tool, memoized=True)
+            return self._results[key]
+        split = None
+        if tool == 'relation-get' and not popenargs and not kwargs:
+            split = self._relation_get_unit(args)
+        if split:
+            all_args, attribute = split
+            settings = json.loads(
+                self.check_output(all_args).decode('UTF-8')) or {}
+            result = json.dumps(settings.get(attribute)).encode('UTF-8')
+        else:
+            result = self._run(self._subprocess.check_output, tool, args,
+                               *popenargs, **kwargs)
+        self._results[key] = result
+        return result
+
+    def check_call(self, args, *popenargs, **kwargs):
+        return self._run(self._subprocess.check_call, self._tool(args), args,
+                         *popenargs, **kwargs)
+
+    def call(self, args, *popenargs, **kwargs):
+        return self._run(self._subprocess.call, self._tool(args), args,
+                         *popenargs, **kwargs)
+
+    def report(self):
+        """Summarise the calls of each hook tool.
+
+        :returns: one line per hook tool, most time consuming first
+        :rtype: List[str]
+        """
+        lines = []
+        for tool, stats in sorted(self.stats.items(),
+                                  key=lambda item: -item[1]['seconds']):
+            lines.append('{}: {} calls, {:.3f}s, {} memoized'.format(
+                tool, stats['calls'], stats['seconds'], stats['memoized']))
+        return lines
+
+
+def install():
+    """Run hookenv's hook tools through a HookToolClient.
+
+    The calls made are logged once the hook has completed successfully,
+    after the other callbacks of hookenv.atexit() as long as this is
+    called before they are registered.
+
+    :returns: the client installed
+    :rtype: HookToolClient
+    """
+    client = hookenv.subprocess
+    if not isinstance(client, HookToolClient):
+        client = HookToolClient(hookenv.subprocess)
+        hookenv.subprocess = client
+        hookenv.atexit(log_report)
+    return client
+
+
+def log_report():
+    """Log the calls of each hook tool made by the hook."""
+    client = hookenv.subprocess
+    if not isinstance(client, HookToolClient):
+        return
+    lines = client.report()
+    if lines:
+        hookenv.log('Hook tool calls: {}'.format('; '.join(lines)),
+                    level=hookenv.DEBUG)
@@ -23,8 +23,9 @@ import uuid
 sys.path.append('lib')
 
 import ceph_rgw as ceph
-import charms_ceph.utils as ceph_utils
-import multisite
+import hook_tools
+import key_rotation
+import profiling
 
 from charmhelpers.core.hookenv import (
     relation_get,
@@ -32,7 +33,6 @@ from charmhelpers.core.hookenv import (
     related_units,
     config,
     open_port,
-    relation_set,
     log,
     DEBUG,
     Hooks, UnregisteredHookError,
@@ -40,24 +40,18 @@ from charmhelpers.core.hookenv import (
     is_leader,
     leader_set,
     leader_get,
+    atexit,
 )
-from charmhelpers.fetch import (
-    apt_update,
-    apt_install,
-    apt_purge,
-    add_source,
-    filter_installed_packages,
-    filter_missing_packages,
-)
+from charmhelpers.fetch import add_source
 from charmhelpers.payload.execd import execd_preinstall
 from charmhelpers.core.host import (
-    cmp_pkgrevno,
     is_container,
     service,
     service_pause,
     service_reload,
     service_restart,
     service_resume,
+    service_running,
     service_stop,
 )
 from charmhelpers.contrib.network.ip import (
@@ -68,10 +62,6 @@ from charmhelpers.contrib.openstack.ip import (
     canonical_url,
     PUBLIC, INTERNAL, ADMIN,
 )
-from charmhelpers.contrib.storage.linux.ceph import (
-    send_request_if_needed,
-    is_request_complete,
-)
 from charmhelpers.contrib.openstack.utils import (
     is_unit_paused_set,
     pausable_restart_on_change as restart_on_change,
@@ -81,33 +71,60 @@ from charmhelpers.contrib.openstack.utils import (
 from charmhelpers.contrib.openstack.ha.utils import (
     generate_ha_relation_data,
 )
+from ceph_rgw import (
+    is_request_complete,
+    send_request_if_needed,
+)
 from utils import (
     assess_status,
     disable_unused_apache_sites,
+    flush_relation_settings,
+    lazy_import,
+    LazyConfigRenderer,
     listen_port,
     multisite_deployment,
     pause_unit_helper,
     ready_for_service,
-    register_configs,
+    relation_set,
     request_per_unit_key,
     restart_map,
     restart_nonce_changed,
     resume_unit_helper,
+    save_published_settings,
     service_name,
     services,
     setup_ipv6,
     systemd_based_radosgw,
 )
-from charmhelpers.contrib.charmsupport import nrpe
-from charmhelpers.contrib.hardening.harden import harden
+from apt_utils import (
+    apt_transaction,
+    cmp_pkgrevno,
+    commit_apt_transaction,
+)
+from hardening import harden
 
 from charmhelpers.contrib.openstack.cert_utils import (
     get_certificate_request,
     process_certificates,
 )
 
+# NOTE: only a few hooks need these so defer the cost of importing them
+#       until they are actually used.
+ceph_utils = lazy_import('charms_ceph.utils')
+multisite = lazy_import('multisite')
+nrpe = lazy_import('charmhelpers.contrib.charmsupport.nrpe')
+
 hooks = Hooks()
-CONFIGS = register_configs()
+CONFIGS = LazyConfigRenderer()
+# NOTE: memoize read-only hook tools and log the hook tool calls made by
+#       the hook once it has completed. Installed first as callbacks run at
+#       exit in reverse order, so that the calls made by the others below
+#       are accounted for.
+hook_tools.install()
+# NOTE: relation_set only queues settings; publish them in one go once
+#       the hook has completed successfully.
+atexit(flush_relation_settings)
+atexit(commit_apt_transaction)
 
 PACKAGES = [
     'haproxy',
@@ -141,26 +158,19 @@ def upgrade_available():
 
 def install_packages():
     c = config()
+    transaction = apt_transaction()
     if c.changed('source') or c.changed('key'):
         add_source(c.get('source'), c.get('key'))
-        apt_update(fatal=True)
+        transaction.add_update()
 
     if is_container():
         PACKAGES.remove('ntp')
 
     # NOTE: just use full package list if we're in an upgrade
     #       config-changed execution
-    pkgs = (
-        PACKAGES if upgrade_available() else
-        filter_installed_packages(PACKAGES)
-    )
-    if pkgs:
-        status_set('maintenance', 'Installing radosgw packages')
-        apt_install(pkgs, fatal=True)
-
-    pkgs = filter_missing_packages(APACHE_PACKAGES)
-    if pkgs:
-        apt_purge(pkgs)
+    transaction.add_install(PACKAGES, upgrade=upgrade_available())
+    transaction.add_purge(APACHE_PACKAGES)
+    transaction.commit(fatal=True, message='Installing radosgw packages')
 
     disable_unused_apache_sites()
 
@@ -255,23 +265,39 @@ def mon_relation(rid=None, unit=None):
     @restart_on_change(restart_map())
     def _mon_relation():
         key_name = 'rgw.{}'.format(socket.gethostname())
+        # NOTE: prefer zone name if in use over pool-prefix.
+        prefix = config('zone') or config('pool-prefix')
+        rq = ceph.get_create_rgw_pools_rq(prefix=prefix)
+        rotating = False
         if request_per_unit_key():
             relation_set(relation_id=rid,
                          key_name=key_name)
-        # NOTE: prefer zone name if in use over pool-prefix.
-        rq = ceph.get_create_rgw_pools_rq(
-            prefix=config('zone') or config('pool-prefix'))
-        if is_request_complete(rq, relation='mon'):
-            log('Broker request complete', level=DEBUG)
+            rotating = key_rotation.add_rotate_key_op(rq, key_name)
+            if rotating and key_rotation.rotation_failed(rq):
+                key_rotation.fail_rotation(relation_set)
+                rq = ceph.get_create_rgw_pools_rq(prefix=prefix)
+                rotating = False
+        complete = is_request_complete(rq, relation='mon')
+        if complete or ceph.request_pools_ready(rq, relation='mon'):
+            if complete:
+                log('Broker request complete', level=DEBUG)
+                ceph.record_ec_data_pool_profile()
             CONFIGS.write_all()
-            # New style per unit keys
-            key = relation_get(attribute='{}_key'.format(key_name),
-                               rid=rid, unit=unit)
-            if not key:
-                # Fallback to old style global key
-                key = relation_get(attribute='radosgw_key',
-                                   rid=rid, unit=unit)
-                key_name = None
+            # NOTE: only take the key of the ceph-mon unit which answered
+            #       the request; others may not have published since the
+            #       key was rotated and give the old one.
+            key = None
+            responder = ceph.get_request_responder(rq, relation='mon')
+            if responder:
+                key_rid, key_unit = responder
+                # New style per unit keys
+                key = relation_get(attribute='{}_key'.format(key_name),
+                                   rid=key_rid, unit=key_unit)
+                if not key:
+                    # Fallback to old style global key
+                    key = relation_get(attribute='radosgw_key',
+                                       rid=key_rid, unit=key_unit)
+                    key_name = None
 
             if key:
                 new_keyring = ceph.import_radosgw_key(key,
@@ -290,21 +316,36 @@ def mon_relation(rid=None, unit=None):
                     # host services.
                     update_nrpe_config(checks_to_remove=['radosgw'])
 
-                # NOTE(jamespage):
-                # Multi-site deployments need to defer restart as the
-                # zone is not created until the master relation is
-                # joined; restarting here will cause a restart burst
-                # in systemd and stop the process restarting once
-                # zone configuration is complete.
-                if (not is_unit_paused_set() and
-                        new_keyring and
-                        not multisite_deployment()):
-                    log('Resume service "{}" as we now have keys for it.'
-                        .format(service_name()), level=DEBUG)
-                    service_resume(service_name())
+                if new_keyring and not is_unit_paused_set():
+                    # NOTE: radosgw only reads its keyring on start up so
+                    #       a running gateway needs a restart to use a
+                    #       rotated key.
+                    if service_running(service_name()):
+                        log('Restart service "{}" as its key changed.'
+                            .format(service_name()), level=DEBUG)
+                        service_restart(service_name())
+                    # NOTE(jamespage):
+                    # Multi-site deployments need to defer restart as the
+                    # zone is not created until the master relation is
+                    # joined; restarting here will cause a restart burst
+                    # in systemd and stop the process restarting once
+                    # zone configuration is complete.
+                    elif not multisite_deployment():
+                        log('Resume service "{}" as we now have keys for '
+                            'it.'.format(service_name()), level=DEBUG)
+                        service_resume(service_name())
+
+                if rotating and key_name and complete:
+                    key_rotation.complete_rotation(relation_set)
+                    # NOTE: send the request again without the
+                    #       rotate-key op.
+                    rq = ceph.get_create_rgw_pools_rq(prefix=prefix)
+                    complete = False
 
             process_multisite_relations()
-        else:
+        # NOTE: radosgw is configured as soon as the pools it needs exist,
+        #       ceph-mon creating the others.
+        if not complete and not ceph.resume_request(rq, relation='mon'):
             send_request_if_needed(rq, relation='mon')
     _mon_relation()
 
@@ -395,6 +436,16 @@ def cluster_changed():
             for unit in related_units(r_id):
                 certs_changed(r_id, unit)
     _cluster_changed()
+    if is_leader() and key_rotation.advance_rotation():
+        key_rotation.request_rotation()
+
+
+@hooks.hook('cluster-relation-departed')
+def cluster_departed():
+    # NOTE: drop a departed unit from any key rotation in progress so the
+    #       rotation does not wait for it forever.
+    if is_leader() and key_rotation.advance_rotation():
+        key_rotation.request_rotation()
 
 
 @hooks.hook('ha-relation-joined')
@@ -428,8 +479,9 @@ def update_nrpe_config(checks_to_remove=None):
     :type checks_to_remove: list
 
     """
-    # python-dbus is used by check_upstart_job
-    apt_install('python-dbus')
+    # python-dbus is used by check_upstart_job; installed, if missing, with
+    # any other package changes at the end of the hook.
+    apt_transaction().add_install('python-dbus')
     hostname = nrpe.get_nagios_hostname()
     current_unit = nrpe.get_nagios_unit_name()
     nrpe_setup = nrpe.NRPE(hostname=hostname)
@@ -661,6 +713,8 @@ def leader_settings_changed():
     if not is_leader():
         for r_id in relation_ids('master'):
             master_relation_joined(r_id)
+    if request_per_unit_key():
+        key_rotation.request_rotation()
 
 
 def process_multisite_relations():
@@ -673,8 +727,11 @@ def process_multisite_relations():
 
 
 if __name__ == '__main__':
-    try:
-        hooks.execute(sys.argv)
-    except UnregisteredHookError as e:
-        log('Unknown hook {} - skipping.'.format(e))
-    assess_status(CONFIGS)
+    with profiling.profile(os.path.basename(sys.argv[0])):
+        try:
+            hooks.execute(sys.argv)
+        except UnregisteredHookError as e:
+            log('Unknown hook {} - skipping.'.format(e))
+        assess_status(CONFIGS)
+        # NOTE: the hook has completed, its relation settings are published.
+        save_published_settings()
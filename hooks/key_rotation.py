@@ -0,0 +1,340 @@
+#
+# Copyright 2020 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Rolling rotation of the per unit cephx keys of the gateways.
+
+The rotate-key action, run on the leader, queues every gateway unit in the
+KEY_ROTATION leader setting.  Units rotate their key one at a time, the
+one at the head of the queue:
+
+* adds a rotate-key op to its broker request on the mon relation, ceph-mon
+  replacing the key of the unit and publishing the new one;
+* writes the new keyring and restarts radosgw when mon_relation gets it;
+* reports completion with the KEY_ROTATED setting on the cluster relation,
+  upon which the leader drops it from the queue, letting the next unit go.
+
+So at most one gateway is restarted at any time.  A unit whose rotation
+ceph-mon fails, or cannot perform as its broker does not know of the op,
+reports it with the KEY_ROTATION_FAILED setting instead and keeps its key,
+the leader moving on to the next unit.  The cancel-key-rotation action
+drops the rotation altogether.  Either way the op is only in the broker
+request of a unit while it is due to rotate its key, the request being
+sent again without it once the rotation is over.
+"""
+
+import json
+import socket
+import uuid
+
+import ceph_rgw
+
+from ceph_rgw import send_request_if_needed
+from charmhelpers.core.hookenv import (
+    config,
+    is_leader,
+    leader_get,
+    leader_set,
+    local_unit,
+    log,
+    related_units,
+    relation_get,
+    relation_ids,
+    DEBUG,
+    ERROR,
+    INFO,
+    WARNING,
+)
+from charmhelpers.core import unitdata
+
+# Leader setting holding the rotation in progress, as JSON: its nonce and
+# the units still to rotate their key, in order.
+KEY_ROTATION = 'key-rotation'
+
+# Cluster relation settings holding the nonce of the last rotation a unit
+# completed and of the last one which failed on it.
+KEY_ROTATED = 'key-rotated'
+KEY_ROTATION_FAILED = 'key-rotation-failed'
+
+# unitdata keys holding the nonce of the rotation in the broker request of
+# the unit, if any, of the last rotation it completed and of the last one
+# which failed on it.
+REQUESTED_KEY = 'key-rotation-requested'
+COMPLETED_KEY = 'key-rotation-completed'
+FAILED_KEY = 'key-rotation-failed'
+
+
+def current_rotation():
+    """Rotation in progress, if any.
+
+    :returns: nonce and queue of units of the rotation
+    :rtype: Optional[Dict[str, Any]]
+    """
+    rotation = leader_get(KEY_ROTATION)
+    if not rotation:
+        return None
+    return json.loads(rotation)
+
+
+def gateway_units():
+    """All units of the application, the local one last.
+
+    The leader goes last so the rotation is driven by units it hears from
+    on the cluster relation until its own turn.
+
+    :rtype: List[str]
+    """
+    units = set()
+    for rid in relation_ids('cluster'):
+        units.update(related_units(rid))
+    units.discard(local_unit())
+    return sorted(units) + [local_unit()]
+
+
+def start_rotation():
+    """Queue the rotation of the key of every unit, leader only.
+
+    :returns: the rotation started
+    :rtype: Dict[str, Any]
+    :raises: ValueError if a rotation is already in progress
+    """
+    if current_rotation():
+        raise ValueError('A key rotation is already in progress')
+    rotation = {'nonce': str(uuid.uuid4()), 'queue': gateway_units()}
+    leader_set({KEY_ROTATION: json.dumps(rotation)})
+    log('Rotating keys of {}'.format(', '.join(rotation['queue'])),
+        level=INFO)
+    return rotation
+
+
+def cancel_rotation():
+    """Cancel the rotation in progress, leader only.
+
+    Units which rotated their key keep the new one; the unit rotating its
+    key, if any, drops the rotate-key op from its broker request.
+
+    :returns: the rotation cancelled, with the units which did not rotate
+              their key
+    :rtype: Dict[str, Any]
+    :raises: ValueError if no rotation is in progress
+    """
+    rotation = current_rotation()
+    if not rotation:
+        raise ValueError('No key rotation in progress')
+    leader_set({KEY_ROTATION: None})
+    log('Key rotation {} cancelled'.format(rotation['nonce']),
+        level=WARNING)
+    return rotation
+
+
+def rotation_supported():
+    """Whether ceph-mon can rotate keys.
+
+    The rotate-key op comes with version 2 of the broker api; brokers of
+    earlier versions fail the whole request on the op.
+
+    :rtype: bool
+    """
+    return ceph_rgw.broker_api_version() >= 2
+
+
+def pending_nonce():
+    """Nonce of the rotation the local unit is due to perform, if any.
+
+    :rtype: Optional[str]
+    """
+    rotation = current_rotation()
+    if not rotation or not rotation['queue']:
+        return None
+    if rotation['queue'][0] != local_unit():
+        return None
+    db = unitdata.kv()
+    if rotation['nonce'] in (db.get(COMPLETED_KEY), db.get(FAILED_KEY)):
+        return None
+    return rotation['nonce']
+
+
+def add_rotate_key_op(rq, key_name):
+    """Add the rotation of the unit's key to its broker request if due.
+
+    :param rq: broker request of the unit
+    :type rq: CephBrokerRq
+    :param key_name: name of the unit's key, without the client. prefix
+    :type key_name: str
+    :returns: whether a rotation is pending completion
+    :rtype: bool
+    """
+    db = unitdata.kv()
+    nonce = pending_nonce()
+    if db.get(REQUESTED_KEY) != nonce:
+        if nonce:
+            db.set(REQUESTED_KEY, nonce)
+        else:
+            db.unset(REQUESTED_KEY)
+        db.flush()
+    if nonce:
+        rq.add_op({'op': 'rotate-key', 'name': key_name, 'nonce': nonce})
+    return bool(nonce)
+
+
+def rotation_failed(rq):
+    """Whether the rotation the unit is due to perform failed.
+
+    It fails when ceph-mon does not support it or reports the rotate-key
+    op of the request as failed; api version 1 responses only tell that the
+    request failed, the op being its last.
+
+    :param rq: broker request of the unit, with its rotate-key op
+    :type rq: CephBrokerRq
+    :rtype: bool
+    """
+    if not pending_nonce():
+        return False
+    if not rotation_supported():
+        log('ceph-mon does not support key rotation', level=WARNING)
+        return True
+    rsp = ceph_rgw.get_request_response(rq)
+    if not rsp or not rsp.get('exit-code'):
+        return False
+    if 'ops' not in rsp:
+        return True
+    for op, state in zip(rq.ops, rsp['ops']):
+        if op['op'] == 'rotate-key':
+            return state.get('state') == 'failed'
+    return False
+
+
+def key_name():
+    """Name of the unit's key, without the client. prefix.
+
+    :rtype: str
+    """
+    return 'rgw.{}'.format(socket.gethostname())
+
+
+def broker_request():
+    """The unit's broker request, with the rotation of its key if due.
+
+    :returns: broker request and whether a rotation is pending completion
+    :rtype: Tuple[CephBrokerRq, bool]
+    """
+    # NOTE: prefer zone name if in use over pool-prefix.
+    rq = ceph_rgw.get_create_rgw_pools_rq(
+        prefix=config('zone') or config('pool-prefix'))
+    return rq, add_rotate_key_op(rq, key_name())
+
+
+def request_rotation():
+    """Send the unit's broker request if its rotate-key op is due a change.
+
+    The op is added when the unit is due to rotate its key and dropped once
+    the rotation is over or cancelled.  Units ceph-mon cannot rotate the key
+    of are left to fail the rotation in mon_relation, see rotation_failed().
+    """
+    nonce = pending_nonce()
+    if unitdata.kv().get(REQUESTED_KEY) == nonce:
+        return
+    if nonce and not rotation_supported():
+        log('ceph-mon does not support key rotation', level=WARNING)
+        return
+    rq, rotating = broker_request()
+    if rotating:
+        log('Requesting rotation of key {}'.format(key_name()), level=INFO)
+    send_request_if_needed(rq, relation='mon')
+
+
+def _finish_rotation(nonce, key, setting, relation_set):
+    """Record the end of the unit's rotation and report it to the leader"""
+    db = unitdata.kv()
+    db.set(key, nonce)
+    db.unset(REQUESTED_KEY)
+    db.flush()
+    for rid in relation_ids('cluster'):
+        relation_set(relation_id=rid, relation_settings={setting: nonce})
+    if is_leader():
+        advance_rotation()
+
+
+def complete_rotation(relation_set):
+    """Record that the unit runs with the key rotated, if it was due.
+
+    :param relation_set: function used to publish relation settings
+    :type relation_set: Callable
+    """
+    nonce = pending_nonce()
+    if not nonce or unitdata.kv().get(REQUESTED_KEY) != nonce:
+        return
+    log('Key rotation {} complete'.format(nonce), level=INFO)
+    _finish_rotation(nonce, COMPLETED_KEY, KEY_ROTATED, relation_set)
+
+
+def fail_rotation(relation_set):
+    """Record that the unit's rotation failed, keeping its current key.
+
+    :param relation_set: function used to publish relation settings
+    :type relation_set: Callable
+    """
+    nonce = pending_nonce()
+    if not nonce:
+        return
+    log('Key rotation {} failed, keeping the current key'.format(nonce),
+        level=ERROR)
+    _finish_rotation(nonce, FAILED_KEY, KEY_ROTATION_FAILED, relation_set)
+
+
+def advance_rotation():
+    """Drop units done with their rotation from the queue, leader only.
+
+    Units which left the cluster relation, or whose rotation failed, are
+    dropped too.
+
+    :returns: whether the local unit is now due to rotate its key
+    :rtype: bool
+    """
+    rotation = current_rotation()
+    if not rotation:
+        return False
+    nonce = rotation['nonce']
+    db = unitdata.kv()
+    peers = {
+        local_unit(): (db.get(COMPLETED_KEY), db.get(FAILED_KEY)),
+    }
+    for rid in relation_ids('cluster'):
+        for unit in related_units(rid):
+            rdata = relation_get(rid=rid, unit=unit) or {}
+            peers[unit] = (rdata.get(KEY_ROTATED),
+                           rdata.get(KEY_ROTATION_FAILED))
+    queue = list(rotation['queue'])
+    while queue:
+        unit = queue[0]
+        completed, failed = peers.get(unit, (nonce, None))
+        if failed == nonce:
+            log('Key rotation {} failed on {}'.format(nonce, unit),
+                level=WARNING)
+        elif completed == nonce:
+            log('Key rotation {} done on {}'.format(nonce, unit),
+                level=DEBUG)
+        else:
+            break
+        queue.pop(0)
+    if queue == rotation['queue']:
+        return pending_nonce() is not None
+    if queue:
+        rotation['queue'] = queue
+        leader_set({KEY_ROTATION: json.dumps(rotation)})
+    else:
+        log('Key rotation {} complete on all units'.format(
+            rotation['nonce']), level=INFO)
+        leader_set({KEY_ROTATION: None})
+    return pending_nonce() is not None
@@ -0,0 +1,194 @@
+#
+# Copyright 2020 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Opt-in profiling of hook executions.
+
+Profiling is enabled with the profile-hooks config option or by creating a
+file named ``profile-hooks`` in the charm directory.  Each profiled hook
+produces, in the ``profiles`` directory next to the charm directory:
+
+* ``<timestamp>-<hook>.txt``: the functions taking most time, as measured
+  with cProfile;
+* ``<timestamp>-<hook>.collapsed``: stacks sampled every few milliseconds of
+  wall clock time, one ``frame;frame;frame count`` line per stack, as used by
+  flamegraph.pl and speedscope.
+"""
+
+import cProfile
+import glob
+import io
+import os
+import pstats
+import signal
+import time
+
+from collections import Counter
+from contextlib import contextmanager
+
+from charmhelpers.core.hookenv import (
+    charm_dir,
+    config,
+    log,
+    DEBUG,
+    WARNING,
+)
+
+PROFILE_FLAG = 'profile-hooks'
+PROFILE_KEEP = 20
+TOP_N = 40
+SAMPLE_INTERVAL = 0.005
+
+
+def profiling_enabled():
+    """Determine whether hook executions should be profiled.
+
+    :rtype: bool
+    """
+    if os.path.exists(os.path.join(charm_dir() or '', PROFILE_FLAG)):
+        return True
+    return bool(config('profile-hooks'))
+
+
+def profile_dir():
+    """Directory profiles are written to, next to the charm directory.
+
+    :rtype: str
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(charm_dir() or '.')),
+                        'profiles')
+
+
+class StackSampler(object):
+    """Sample the stack of the main thread at intervals of wall clock time.
+
+    Wall clock time is used rather than CPU time as most of the time of a
+    hook is spent waiting for hook tools and other commands.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self._previous = None
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{}:{}'.format(
+                os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._previous = signal.signal(signal.SIGALRM, self._sample)
+        signal.setitimer(signal.ITIMER_REAL, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, self._previous or signal.SIG_DFL)
+
+    def collapsed(self):
+        """Sampled stacks in collapsed format, most sampled first.
+
+        :rtype: List[str]
+        """
+        return ['{} {}'.format(stack, count)
+                for stack, count in self.stacks.most_common()]
+
+
+def write_profile(name, profiler, sampler):
+    """Write the report and the collapsed stacks of a profiled execution.
+
+    Only the PROFILE_KEEP most recent executions are kept.
+
+    :param name: name of hook or action profiled
+    :type name: str
+    :param profiler: profiler used for the execution
+    :type profiler: cProfile.Profile
+    :param sampler: stack sampler used for the execution
+    :type sampler: StackSampler
+    :returns: path of report, without extension
+    :rtype: str
+    """
+    directory = profile_dir()
+    if not os.path.isdir(directory):
+        os.makedirs(directory, mode=0o750)
+    base = os.path.join(directory, '{}-{}'.format(
+        time.strftime('%Y%m%d%H%M%S'), name))
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats('cumulative').print_stats(TOP_N)
+    stats.sort_stats('tottime').print_stats(TOP_N)
+    with open(base + '.txt', 'w') as f:
+        f.write(stream.getvalue())
+    with open(base + '.collapsed', 'w') as f:
+        f.write('\n'.join(sampler.collapsed()) + '\n')
+    for old in list_profiles()[PROFILE_KEEP:]:
+        for ext in ('.txt', '.collapsed'):
+            if os.path.exists(old + ext):
+                os.remove(old + ext)
+    return base
+
+
+def list_profiles(name=None):
+    """List profiles written, most recent first.
+
+    :param name: only list profiles of this hook or action
+    :type name: Optional[str]
+    :returns: paths of reports, without extension
+    :rtype: List[str]
+    """
+    bases = (path[:-len('.txt')] for path in
+             glob.glob(os.path.join(profile_dir(), '*-*.txt')))
+    if name:
+        # The timestamp contains no '-' while hook names do, so the name
+        # field is everything after the first one.
+        bases = (base for base in bases
+                 if os.path.basename(base).split('-', 1)[1] == name)
+    return sorted(bases, reverse=True)
+
+
+@contextmanager
+def profile(name):
+    """Profile the execution of the block if profiling is enabled.
+
+    :param name: name of hook or action profiled
+    :type name: str
+    """
+    try:
+        enabled = profiling_enabled()
+    except Exception as e:
+        log('Unable to determine whether to profile {}: {}'.format(name, e),
+            level=WARNING)
+        enabled = False
+    if not enabled:
+        yield
+        return
+    profiler = cProfile.Profile()
+    sampler = StackSampler()
+    sampler.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        sampler.stop()
+        try:
+            base = write_profile(name, profiler, sampler)
+            log('Profile of {} written to {}.txt'.format(name, base),
+                level=DEBUG)
+        except (IOError, OSError) as e:
+            log('Unable to write profile of {}: {}'.format(name, e),
+                level=WARNING)
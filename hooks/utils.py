@@ -12,28 +12,39 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import importlib.util
+import json
 import os
 import socket
 import subprocess
+import sys
+import time
 
 from collections import OrderedDict
 from copy import deepcopy
 
 import ceph_radosgw_context
+import ceph_rgw
 
+from charmhelpers.core import hookenv
 from charmhelpers.core.hookenv import (
     relation_get,
     relation_ids,
     related_units,
     application_version_set,
     config,
+    hook_name,
     leader_get,
+    log,
+    DEBUG,
 )
 from charmhelpers.contrib.openstack import (
     context,
     templating,
 )
 from charmhelpers.contrib.openstack.utils import (
+    is_unit_paused_set,
     make_assess_status_func,
     pause_unit,
     resume_unit,
@@ -43,21 +54,25 @@ from charmhelpers.contrib.hahelpers.cluster import (
     https,
 )
 from charmhelpers.core.host import (
-    cmp_pkgrevno,
     lsb_release,
     CompareHostReleases,
     init_is_systemd,
+    service_running,
 )
 from charmhelpers.fetch import (
+    apt_pkg,
+    add_source,
+)
+from charmhelpers.core import unitdata
+
+from apt_utils import (
     apt_cache,
     apt_install,
-    apt_pkg,
     apt_update,
-    add_source,
+    cmp_pkgrevno,
     filter_installed_packages,
     get_upstream_version,
 )
-from charmhelpers.core import unitdata
 
 # The interface is said to be satisfied if anyone of the interfaces in the
 # list has a complete context.
@@ -79,6 +94,26 @@ APACHE_SITE_CONF = '/etc/apache2/sites-available/openstack_https_frontend'
 APACHE_SITE_24_CONF = '/etc/apache2/sites-available/' \
     'openstack_https_frontend.conf'
 
+# Relation settings queued by relation_set() during the current hook,
+# keyed by relation id (None being the relation of the running hook).
+_pending_relation_settings = OrderedDict()
+# unitdata key holding digests of the settings published per relation id.
+PUBLISHED_SETTINGS_KEY = 'published-relation-settings'
+# Digests of the settings published per relation id, as updated by
+# flush_relation_settings() and saved by save_published_settings(), and the
+# relation names written to by relation id.
+_published_settings = None
+_published_endpoints = set()
+
+# unitdata key holding the digest of the inputs of the last status assessment.
+STATUS_INPUTS_KEY = 'assess-status-inputs'
+# Relations whose data feeds into the assessment of the unit's status.
+STATUS_RELATIONS = ['mon', 'cluster', 'ha', 'identity-service',
+                    'certificates', 'master', 'slave']
+# update-status re-assesses at least this often (seconds) even when none of
+# the inputs to the assessment have changed.
+STATUS_MAX_AGE = 1800
+
 BASE_RESOURCE_MAP = OrderedDict([
     (HAPROXY_CONF, {
         'contexts': [context.HAProxyContext(singlenode_mode=True),
@@ -159,6 +194,48 @@ def register_configs(release='icehouse'):
     return configs
 
 
+class LazyConfigRenderer(object):
+    """Proxy for the charm's OSConfigRenderer which defers register_configs().
+
+    Registering configs works out which templates and contexts apply to the
+    unit, which involves querying the package database; hooks which never
+    render a template or assess status do not pay for it.
+    """
+
+    def __init__(self):
+        self._configs = None
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            # Don't register configs when merely being introspected
+            raise AttributeError(name)
+        if self._configs is None:
+            self._configs = register_configs()
+        return getattr(self._configs, name)
+
+
+def lazy_import(name):
+    """Import a module deferring its execution until first attribute access.
+
+    Used by the hooks for modules which are only needed by a handful of
+    hooks so that every other hook does not pay for importing them.
+
+    :param name: fully qualified module name
+    :type name: str
+    :returns: the module, or a lazily loaded placeholder for it
+    :rtype: module
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
 def services():
     """Returns a list of services associate with this charm."""
     _services = []
@@ -198,6 +275,26 @@ def check_optional_relations(configs):
             return ('blocked',
                     'hacluster missing configuration: '
                     'vip, vip_iface, vip_cidr')
+    try:
+        # NOTE: only validated if set, validation checks the ceph version.
+        ceph_rgw.data_pool_compression()
+    except (AssertionError, ValueError) as e:
+        return ('blocked', 'Invalid configuration: {}'.format(e))
+    ec_profile = config('ec-performance-profile')
+    if ec_profile and ec_profile not in ceph_rgw.EC_PERFORMANCE_PROFILES:
+        return ('blocked',
+                'invalid ec-performance-profile: {}'.format(ec_profile))
+    if config('pool-type') == 'erasure-coded':
+        created_with = ceph_rgw.ec_data_pool_profile()[0]
+        if ec_profile != created_with:
+            return ('blocked',
+                    'ec-performance-profile cannot change once the data '
+                    'pool exists, created with: {}'.format(
+                        created_with or 'none'))
+    try:
+        ceph_rgw.pool_group_settings()
+    except ValueError as e:
+        return ('blocked', 'Invalid configuration: {}'.format(e))
     # NOTE: misc multi-site relation and config checks
     multisite_config = (config('realm'),
                         config('zonegroup'),
@@ -262,11 +359,48 @@ def assess_status(configs):
     SIDE EFFECT: calls set_os_workload_status(...) which sets the workload
     status of the unit.
     Also calls status_set(...) directly if paused state isn't complete.
+
+    The update-status hook skips the assessment if none of its inputs
+    (config, leader settings, relation data, paused and service state) have
+    changed since the last one, unless that was over STATUS_MAX_AGE ago.
     @param configs: a templating.OSConfigRenderer() object
     @returns None - this function is executed for its side-effect
     """
+    db = unitdata.kv()
+    digest = _status_inputs_digest()
+    if hook_name() == 'update-status':
+        previous = db.get(STATUS_INPUTS_KEY) or {}
+        if (previous.get('digest') == digest and
+                time.time() - previous.get('timestamp', 0) < STATUS_MAX_AGE):
+            log('Status inputs unchanged, skipping assessment', level=DEBUG)
+            return
     assess_status_func(configs)()
     application_version_set(get_upstream_version(VERSION_PACKAGE))
+    db.set(STATUS_INPUTS_KEY, {'digest': digest, 'timestamp': time.time()})
+    db.flush()
+
+
+def _status_inputs_digest():
+    """Digest of the inputs to the assessment of the unit's status.
+
+    :returns: hex digest
+    :rtype: str
+    """
+    relations = {}
+    for name in STATUS_RELATIONS:
+        for rid in relation_ids(name):
+            relations[rid] = {unit: relation_get(rid=rid, unit=unit)
+                              for unit in related_units(rid)}
+    inputs = {
+        'config': config(),
+        'leader': leader_get(),
+        'paused': is_unit_paused_set(),
+        'relations': relations,
+        'services': {svc: service_running(svc) for svc in services()},
+    }
+    return hashlib.sha256(
+        json.dumps(inputs, sort_keys=True, default=str).encode('UTF-8')
+    ).hexdigest()
 
 
 def assess_status_func(configs):
@@ -445,3 +579,106 @@ def multisite_deployment():
     return all((config('zone'),
                 config('zonegroup'),
                 config('realm')))
+
+
+def relation_set(relation_id=None, relation_settings=None, **kwargs):
+    """Queue relation settings for the local unit.
+
+    Settings are merged per relation id and only published when
+    flush_relation_settings() is called at the end of the hook; Juju
+    does not expose relation data to remote units until the hook has
+    completed successfully so deferring the write is not observable by
+    them. Settings already published with the same value are not re-sent.
+
+    The exception is the broker request, broker_req, which
+    ceph_rgw.send_request_if_needed() and ceph_rgw.resume_request()
+    write to the mon relation straight away: the request is read back
+    within the same hook to tell whether it was sent already, and by
+    charmhelpers to match the response of ceph-mon. broker_req must
+    therefore never be queued here, or the queued value would overwrite
+    the one sent by the hook.
+
+    :param relation_id: relation to update, defaults to the relation of
+                        the running hook
+    :type relation_id: Optional[str]
+    :param relation_settings: settings to publish
+    :type relation_settings: Optional[Dict[str, Any]]
+    """
+    settings = _pending_relation_settings.setdefault(relation_id, {})
+    settings.update(relation_settings or {})
+    settings.update(kwargs)
+
+
+def _settings_digest(value):
+    """Digest of a relation setting value as published by relation-set"""
+    return hashlib.sha256("{}".format(value).encode('UTF-8')).hexdigest()
+
+
+def flush_relation_settings():
+    """Publish relation settings queued by relation_set().
+
+    A digest of every value published is kept per relation id in the
+    unit's local kv store; only keys whose value has changed since they
+    were last published are sent and relations with nothing to update
+    are skipped entirely, so remote units do not see -relation-changed
+    hooks for unchanged settings.
+
+    The digests are only saved by save_published_settings() once the hook
+    has completed: Juju discards the relation settings of a hook which
+    fails, they must then be sent again by the next one.
+    """
+    global _published_settings
+    if not _pending_relation_settings:
+        return
+    if _published_settings is None:
+        _published_settings = deepcopy(
+            unitdata.kv().get(PUBLISHED_SETTINGS_KEY) or {})
+    while _pending_relation_settings:
+        rid, settings = _pending_relation_settings.popitem(last=False)
+        if rid:
+            _published_endpoints.add(rid.split(':')[0])
+        key_rid = rid or hookenv.relation_id()
+        digests = _published_settings.get(key_rid, {}) if key_rid else {}
+        changed = {}
+        for key, value in settings.items():
+            if value is None:
+                if key in digests or not key_rid:
+                    changed[key] = None
+            elif digests.get(key) != _settings_digest(value):
+                changed[key] = value
+        if not changed:
+            continue
+        hookenv.relation_set(relation_id=rid, relation_settings=changed)
+        if not key_rid:
+            continue
+        for key, value in changed.items():
+            if value is None:
+                digests.pop(key, None)
+            else:
+                digests[key] = _settings_digest(value)
+        _published_settings[key_rid] = digests
+
+
+def save_published_settings():
+    """Save the digests of the relation settings published by the hook.
+
+    To be called once the hook has completed successfully, see
+    flush_relation_settings(). Digests of relations which no longer exist
+    are dropped, for the relation names the hook wrote to by relation id:
+    the hook looked their relations up already, which costs no more hook
+    tool calls.
+    """
+    global _published_settings
+    if _published_settings is None:
+        return
+    published = {}
+    for rid, digests in _published_settings.items():
+        name = rid.split(':')[0]
+        if name not in _published_endpoints or rid in relation_ids(name):
+            published[rid] = digests
+    _published_settings = None
+    _published_endpoints.clear()
+    db = unitdata.kv()
+    if db.get(PUBLISHED_SETTINGS_KEY) != published:
+        db.set(PUBLISHED_SETTINGS_KEY, published)
+        db.flush()
@@ -13,8 +13,10 @@
 # limitations under the License.
 
 import collections
+import hashlib
 import json
 import os
+import re
 
 from tempfile import NamedTemporaryFile
 
@@ -34,7 +36,9 @@ from charmhelpers.contrib.storage.linux.ceph import (
     create_erasure_profile,
     delete_pool,
     erasure_profile_exists,
+    get_erasure_profile,
     get_osds,
+    monitor_key_delete,
     monitor_key_get,
     monitor_key_set,
     pool_exists,
@@ -88,6 +92,37 @@ POOL_KEYS = {
     "crush_rule": [str],
 }
 
+# Caps of the monitors granted to the services of groups.
+SERVICE_MON_CAPS = 'allow r, allow command "osd blacklist"'
+
+# Permissions which are a combination of read, write and execute, merged
+# into one grant when a pool is in several groups of a service.
+RWX_PERMISSION = re.compile(r'^[rwx]+$')
+
+# Ops which change groups through BrokerBatch, see process_op().
+BATCHED_OPS = ('create-pool', 'add-permissions-to-key')
+
+# BlueStore compression settings of create-pool ops, applied to new and
+# existing pools.
+POOL_COMPRESSION_KEYS = (
+    'compression-algorithm',
+    'compression-mode',
+    'compression-required-ratio',
+    'compression-min-blob-size',
+    'compression-min-blob-size-hdd',
+    'compression-min-blob-size-ssd',
+    'compression-max-blob-size',
+    'compression-max-blob-size-hdd',
+    'compression-max-blob-size-ssd',
+)
+
+# Target size hints of the PG autoscaler of create-pool ops, applied to new
+# and existing pools from nautilus on.
+POOL_TARGET_SIZE_KEYS = (
+    'target-size-bytes',
+    'target-size-ratio',
+)
+
 CEPH_BUCKET_TYPES = [
     'osd',
     'host',
@@ -106,20 +141,84 @@ CEPH_BUCKET_TYPES = [
 def decode_req_encode_rsp(f):
     """Decorator to decode incoming requests and encode responses."""
 
-    def decode_inner(req):
-        return json.dumps(f(json.loads(req)))
+    def decode_inner(req, *args, **kwargs):
+        return json.dumps(f(json.loads(req), *args, **kwargs))
 
     return decode_inner
 
 
+# Ops whose response carries data for the client, they must be processed
+# again to get it.
+RESULT_OPS = ('rgw-create-user',)
+
+
+def request_digest(reqs):
+    """Digest of a broker request, whatever its request id.
+
+    :param reqs: dict of request parameters.
+    :returns: str. hex digest
+    """
+    request = {k: v for k, v in reqs.items() if k != 'request-id'}
+    return hashlib.sha256(
+        json.dumps(request, sort_keys=True).encode('UTF-8')).hexdigest()
+
+
+def get_request_digest_key(client):
+    """Build the key of the digest of the last request applied for client"""
+    return 'broker.digest.{}'.format(client)
+
+
+def request_applied(client, digest, ops, snapshot):
+    """Whether a request was the last applied for a client and still is.
+
+    Beyond the digest recorded, the pools and erasure profiles the ops
+    apply to are checked to exist in case they were removed since, see
+    op_target_exists().  Requests with ops returning
+    data, see RESULT_OPS, are never considered applied.
+
+    :param client: name of the client application of the request.
+    :param digest: digest of the request, see request_digest().
+    :param ops: ops of the request.
+    :param snapshot: ClusterSnapshot of the cluster.
+    :returns: bool.
+    """
+    if any(op.get('op') in RESULT_OPS for op in ops):
+        return False
+    if snapshot.config_key(get_request_digest_key(client)) != digest:
+        return False
+    return all(op_target_exists(op, snapshot) for op in ops)
+
+
+def op_target_exists(op, snapshot):
+    """Whether the pool or erasure profile an op applies to exists.
+
+    Ops which apply to neither are taken to have a target.
+
+    :param op: dict of the op and its params.
+    :param snapshot: ClusterSnapshot of the cluster.
+    :returns: bool.
+    """
+    if op.get('op') in ('create-pool', 'set-pool-value'):
+        return snapshot.pool_exists(op.get('name'))
+    if op.get('op') == 'create-erasure-profile':
+        return snapshot.erasure_profile_exists(op.get('name'))
+    return True
+
+
 @decode_req_encode_rsp
-def process_requests(reqs):
+def process_requests(reqs, client=None):
     """Process Ceph broker request(s).
 
     This is a versioned api. API version must be supplied by the client making
-    the request.
+    the request, version 2 reporting the state of each op, see
+    process_requests_v2().
+
+    When the name of the client application is given, the digest of the
+    last request applied for it is recorded and a request with the same
+    ops, re-sent with a new request id, returns straight away.
 
     :param reqs: dict of request parameters.
+    :param client: name of the client application of the request.
     :returns: dict. exit-code and reason if not 0
     """
     request_id = reqs.get('request-id')
@@ -127,7 +226,28 @@ def process_requests(reqs):
         version = reqs.get('api-version')
         if version == 1:
             log('Processing request {}'.format(request_id), level=DEBUG)
-            resp = process_requests_v1(reqs['ops'])
+            snapshot = ClusterSnapshot('admin')
+            digest = request_digest(reqs)
+            if client and request_applied(client, digest, reqs['ops'],
+                                          snapshot):
+                log('Request {} already applied for {}'.format(
+                    request_id, client), level=INFO)
+                resp = {'exit-code': 0}
+            else:
+                resp = process_requests_v1(reqs['ops'], snapshot=snapshot)
+                if client and resp.get('exit-code') == 0:
+                    monitor_key_set(service='admin',
+                                    key=get_request_digest_key(client),
+                                    value=digest)
+            if request_id:
+                resp['request-id'] = request_id
+
+            return resp
+        if version == 2:
+            log('Processing request {}'.format(request_id), level=DEBUG)
+            resp = process_requests_v2(reqs['ops'], request_digest(reqs),
+                                       snapshot=ClusterSnapshot('admin'))
+            resp['api-version'] = 2
             if request_id:
                 resp['request-id'] = request_id
 
@@ -148,11 +268,12 @@ def process_requests(reqs):
     return resp
 
 
-def handle_create_erasure_profile(request, service):
+def handle_create_erasure_profile(request, service, batch=None):
     """Create an erasure profile.
 
     :param request: dict of request operations and params
     :param service: The ceph client to run the command under.
+    :param batch: cluster state shared with the other ops of the request.
     :returns: dict. exit-code and reason if not 0
     """
     # "isa" | "lrc" | "shec" | "clay" or it defaults to "jerasure"
@@ -175,6 +296,7 @@ def handle_create_erasure_profile(request, service):
     scalar_mds = request.get('scalar-mds')
     # Device Class
     device_class = request.get('device-class')
+    stripe_unit = request.get('stripe-unit')
 
     if failure_domain and failure_domain not in CEPH_BUCKET_TYPES:
         msg = "failure-domain must be one of {}".format(CEPH_BUCKET_TYPES)
@@ -194,17 +316,53 @@ def handle_create_erasure_profile(request, service):
                            crush_locality=crush_locality,
                            device_class=device_class,
                            erasure_plugin_technique=erasure_technique)
+    if batch:
+        batch.snapshot.erasure_profile_created(name)
+    if stripe_unit:
+        _set_erasure_profile_stripe_unit(service, name, stripe_unit,
+                                         batch=batch)
 
     return {'exit-code': 0}
 
 
-def handle_add_permissions_to_key(request, service):
+def _set_erasure_profile_stripe_unit(service, name, stripe_unit,
+                                     batch=None):
+    """Set the stripe unit of an erasure profile, keeping its other settings.
+
+    create_erasure_profile() does not know of the stripe unit, the size of
+    the chunks of each stripe written to the OSDs.  Pools only take it on
+    when they are created.
+    """
+    if batch:
+        profile = batch.snapshot.erasure_profile(name)
+    else:
+        profile = get_erasure_profile(service=service, name=name)
+    settings = ['{}={}'.format(key, value)
+                for key, value in sorted((profile or {}).items())
+                if key != 'stripe_unit']
+    check_call(['ceph', '--id', service, 'osd', 'erasure-code-profile',
+                'set', name] + settings +
+               ['stripe_unit={}'.format(stripe_unit), '--force'])
+    if batch:
+        batch.snapshot.erasure_profile_created(name)
+
+
+def handle_add_permissions_to_key(request, service, batch=None):
     """Groups are defined by the key cephx.groups.(namespace-)?-(name). This
     key will contain a dict serialized to JSON with data about the group,
     including pools and members.
 
     A group can optionally have a namespace defined that will be used to
     further restrict pool access.
+
+    When the request has an app-name, the pools of the group are tagged
+    with the group, in the metadata of that application, and access to
+    them is granted by this tag, see compile_service_caps(), so that the
+    caps of the service do not grow with the number of pools.  Tagging
+    requires a batch.
+
+    :param batch: cluster state shared with the other ops of the request.
+                  The caps of the service are updated once it is flushed.
     """
     resp = {'exit-code': 0}
 
@@ -213,9 +371,15 @@ def handle_add_permissions_to_key(request, service):
     group_namespace = request.get('group-namespace')
     if group_namespace:
         group_name = "{}-{}".format(group_namespace, group_name)
-    group = get_group(group_name=group_name)
+    group = get_group(group_name=group_name, batch=batch)
+    app_name = request.get('app-name')
+    if app_name and batch:
+        group['app-name'] = app_name
+        group['tag'] = get_group_tag(group_name)
+        batch.tag_group_pools(group_name)
     service_obj = get_service_groups(service=service_name,
-                                     namespace=group_namespace)
+                                     namespace=group_namespace,
+                                     batch=batch)
     if request.get('object-prefix-permissions'):
         service_obj['object_prefix_perms'] = request.get(
             'object-prefix-permissions')
@@ -223,12 +387,17 @@ def handle_add_permissions_to_key(request, service):
     permission = request.get('group-permission') or "rwx"
     if service_name not in group['services']:
         group['services'].append(service_name)
-    save_group(group=group, group_name=group_name)
+    save_group(group=group, group_name=group_name, batch=batch)
     if permission not in service_obj['group_names']:
         service_obj['group_names'][permission] = []
     if group_name not in service_obj['group_names'][permission]:
         service_obj['group_names'][permission].append(group_name)
-    save_service(service=service_obj, service_name=service_name)
+    save_service(service=service_obj, service_name=service_name,
+                 batch=batch)
+    if batch:
+        batch.update_service_permissions(service_name,
+                                         namespace=group_namespace)
+        return resp
     service_obj['groups'] = _build_service_groups(service_obj,
                                                   group_namespace)
     update_service_permissions(service_name, service_obj, group_namespace)
@@ -248,55 +417,496 @@ def handle_set_key_permissions(request, service):
         log("Error updating key capabilities: {}".format(e), level=ERROR)
 
 
-def update_service_permissions(service, service_obj=None, namespace=None):
-    """Update the key permissions for the named client in Ceph"""
+def handle_rotate_key(request, service):
+    """Replace the key of a client, keeping its capabilities.
+
+    The nonce of the request is recorded in the monitor cluster so that a
+    request processed again, as it stays in the broker request of the
+    client once rotated, does not rotate the key again.
+
+    :param request: dict of request operations and params
+    :param service: The ceph client to run the command under.
+    :returns: dict. exit-code and reason if not 0
+    """
+    name = request.get('name')
+    nonce = request.get('nonce')
+    if not name or not nonce:
+        msg = "Missing name or nonce"
+        log(msg, level=ERROR)
+        return {'exit-code': 1, 'stderr': msg}
+    if name == 'admin':
+        msg = "Refusing to rotate the key of client.admin"
+        log(msg, level=ERROR)
+        return {'exit-code': 1, 'stderr': msg}
+    nonce_key = 'rotate-key-{}'.format(name)
+    if monitor_key_get(service, nonce_key) == nonce:
+        log("Key of client.{} already rotated for {}".format(name, nonce),
+            level=DEBUG)
+        return {'exit-code': 0}
+    client = 'client.{}'.format(name)
+    try:
+        entity = json.loads(check_output(
+            ['ceph', '--id', service, 'auth', 'get', client,
+             '--format=json']).decode('UTF-8'))[0]
+        key = check_output(
+            ['ceph-authtool', '--gen-print-key']).decode('UTF-8').strip()
+        with NamedTemporaryFile(mode='w', delete=True) as keyring:
+            keyring.write('[{}]\n\tkey = {}\n'.format(client, key))
+            for subsystem, caps in sorted(entity.get('caps', {}).items()):
+                keyring.write('\tcaps {} = "{}"\n'.format(subsystem, caps))
+            keyring.flush()
+            check_call(['ceph', '--id', service, 'auth', 'import',
+                        '-i', keyring.name])
+    except (CalledProcessError, IndexError, ValueError) as err:
+        msg = "Unable to rotate the key of {}: {}".format(client, err)
+        log(msg, level=ERROR)
+        return {'exit-code': 1, 'stderr': msg}
+    monitor_key_set(service, nonce_key, nonce)
+    log("Rotated the key of {}".format(client), level=INFO)
+    return {'exit-code': 0}
+
+
+class ClusterSnapshot(object):
+    """Cluster state read by the ops of a broker request.
+
+    The OSD map, with the pools and their details, the erasure code
+    profiles, the config-key store and the caps of cephx entities are each
+    read once, the first time an op needs them.  Handlers update the
+    snapshot after changing the cluster so later ops see their changes
+    without reading it again.
+    """
+
+    def __init__(self, service):
+        self.service = service
+        self._osd_dump = None
+        self._profiles = None
+        self._keys = None
+        self._all_keys = False
+        self._caps = None
+
+    def _ceph_json(self, *args):
+        return json.loads(check_output(
+            ['ceph', '--id', self.service] + list(args) + ['--format=json']
+        ).decode('UTF-8'))
+
+    def _read_config_keys(self):
+        try:
+            return json.loads(check_output(
+                ['ceph', '--id', 'admin', 'config-key', 'dump']
+            ).decode('UTF-8'))
+        except (CalledProcessError, ValueError) as e:
+            log("Unable to dump config-keys, reading them one by one: "
+                "{}".format(e), level=DEBUG)
+            return None
+
+    def osd_dump(self):
+        """Output of ceph osd dump"""
+        if self._osd_dump is None:
+            self._osd_dump = self._ceph_json('osd', 'dump')
+        return self._osd_dump
+
+    def osds(self):
+        """Ids of the OSDs, as get_osds() returns them"""
+        return [osd['osd'] for osd in self.osd_dump().get('osds', [])]
+
+    def pool(self, name):
+        """Details of a pool, as in ceph osd pool ls detail"""
+        for pool in self.osd_dump().get('pools', []):
+            if pool['pool_name'] == name:
+                return pool
+        return None
+
+    def pool_exists(self, name):
+        return self.pool(name) is not None
+
+    def cache_mode(self, name):
+        pool = self.pool(name)
+        return pool.get('cache_mode') if pool else None
+
+    def pool_created(self, name, **details):
+        if not self.pool_exists(name):
+            details['pool_name'] = name
+            self.osd_dump().setdefault('pools', []).append(details)
+
+    def pool_updated(self, name, **details):
+        pool = self.pool(name)
+        if pool:
+            pool.update(details)
+
+    def pool_tagged(self, name, app_name, key, value):
+        pool = self.pool(name)
+        if pool:
+            metadata = pool.setdefault('application_metadata', {})
+            metadata.setdefault(app_name, {})[key] = value
+
+    def pool_deleted(self, name):
+        pool = self.pool(name)
+        if pool:
+            self.osd_dump()['pools'].remove(pool)
+
+    def erasure_profiles(self):
+        """Erasure code profiles, by name, not read until asked for"""
+        if self._profiles is None:
+            self._profiles = dict.fromkeys(
+                self._ceph_json('osd', 'erasure-code-profile', 'ls'))
+        return self._profiles
+
+    def erasure_profile_exists(self, name):
+        return name in self.erasure_profiles()
+
+    def erasure_profile(self, name):
+        """Erasure code profile, as get_erasure_profile() returns it"""
+        if not self.erasure_profile_exists(name):
+            return None
+        if self._profiles[name] is None:
+            self._profiles[name] = self._ceph_json(
+                'osd', 'erasure-code-profile', 'get', name)
+        return self._profiles[name]
+
+    def erasure_profile_created(self, name):
+        # NOTE: read the profile again if asked for, it may have changed.
+        self.erasure_profiles()[name] = None
+
+    def config_key(self, key):
+        """Value of a config-key, as monitor_key_get() returns it"""
+        if self._keys is None:
+            self._keys = self._read_config_keys()
+            self._all_keys = self._keys is not None
+            self._keys = self._keys or {}
+        if key not in self._keys and not self._all_keys:
+            self._keys[key] = monitor_key_get(service='admin', key=key)
+        return self._keys.get(key)
+
+    def config_key_set(self, key, value):
+        self.config_key(key)
+        self._keys[key] = value
+
+    def caps(self, entity):
+        """Caps of a cephx entity, by type, None if not known"""
+        if self._caps is None:
+            try:
+                dump = self._ceph_json('auth', 'ls')
+            except (CalledProcessError, ValueError) as e:
+                log("Unable to list cephx entities: {}".format(e),
+                    level=DEBUG)
+                dump = {}
+            self._caps = {auth['entity']: auth.get('caps', {})
+                          for auth in dump.get('auth_dump', [])}
+        return self._caps.get(entity)
+
+    def caps_set(self, entity, caps):
+        self.caps(entity)
+        self._caps[entity] = dict(caps)
+
+
+class StubClusterSnapshot(ClusterSnapshot):
+    """Cluster snapshot of a given state which never queries the cluster.
+
+    For tests of the broker handlers; the OSD map is built from OSD ids
+    and pool details, pools being given as names or dicts.
+    """
+
+    def __init__(self, osds=(), pools=(), erasure_profiles=None,
+                 config_keys=None, caps=None, service='admin'):
+        super(StubClusterSnapshot, self).__init__(service)
+        self._osd_dump = {
+            'osds': [{'osd': osd} for osd in osds],
+            'pools': [dict(pool) if isinstance(pool, dict)
+                      else {'pool_name': pool} for pool in pools],
+        }
+        self._profiles = dict(erasure_profiles or {})
+        self._keys = dict(config_keys or {})
+        self._all_keys = True
+        self._caps = dict(caps or {})
+
+
+class BrokerBatch(object):
+    """Deferred writes of the ops of a broker request.
+
+    Changes to groups and services are applied to the snapshot of the
+    cluster and written by flush(), along with the caps of the services of
+    the changed groups, so that each key and each service's caps are written
+    once per request rather than once per pool, and only if they changed.
+    """
+
+    def __init__(self, service, snapshot=None):
+        self.service = service
+        self.snapshot = snapshot or ClusterSnapshot(service)
+        self._dirty_keys = set()
+        self._tags = set()
+        self._permissions = set()
+
+    def key_get(self, key):
+        """Value of a config-key, as monitor_key_get() would return it"""
+        return self.snapshot.config_key(key)
+
+    def key_set(self, key, value):
+        """Set a config-key, written by flush() if it changed"""
+        if self.key_get(key) != value:
+            self.snapshot.config_key_set(key, value)
+            self._dirty_keys.add(key)
+
+    def key_delete(self, key):
+        """Delete a config-key, by flush() if it exists"""
+        if self.key_get(key) is not None:
+            self.snapshot.config_key_set(key, None)
+            self._dirty_keys.add(key)
+
+    def tag_group_pools(self, group_name):
+        """Tag the pools of a group once flush() is called"""
+        self._tags.add(group_name)
+
+    def update_service_permissions(self, service, namespace=None):
+        """Update the caps of a service once flush() is called"""
+        self._permissions.add((service, namespace or ''))
+
+    def flush(self):
+        """Write changed config-keys, tag pools, then the caps of services.
+
+        Config-keys set to None are deleted.
+        """
+        for key in sorted(self._dirty_keys):
+            if self.key_get(key) is None:
+                monitor_key_delete(service='admin', key=key)
+            else:
+                monitor_key_set(service='admin', key=key,
+                                value=self.key_get(key))
+        self._dirty_keys.clear()
+        for group_name in sorted(self._tags):
+            tag_group_pools(self.service, group_name, batch=self)
+        self._tags.clear()
+        for service, namespace in sorted(self._permissions):
+            update_service_permissions(service, namespace=namespace or None,
+                                       batch=self)
+        self._permissions.clear()
+
+
+def _pool_exists(service, name, batch=None):
+    if batch:
+        return batch.snapshot.pool_exists(name)
+    return pool_exists(service=service, name=name)
+
+
+def _set_pool_quota(service, pool_name, max_bytes, max_objects, batch=None):
+    """Set the quotas of a pool, unless the snapshot shows they are set"""
+    wanted = {}
+    if max_bytes:
+        wanted['quota_max_bytes'] = int(max_bytes)
+    if max_objects:
+        wanted['quota_max_objects'] = int(max_objects)
+    if batch:
+        pool = batch.snapshot.pool(pool_name) or {}
+        if all(pool.get(k) == v for k, v in wanted.items()):
+            log("Pool '{}' quotas already set".format(pool_name),
+                level=DEBUG)
+            return
+    set_pool_quota(service=service, pool_name=pool_name,
+                   max_bytes=max_bytes, max_objects=max_objects)
+    if batch:
+        batch.snapshot.pool_updated(pool_name, **wanted)
+
+
+def _set_pool_options(service, pool_name, wanted, batch=None):
+    """Set values of a pool, unless the snapshot shows it has them.
+
+    Values the snapshot shows the pool already has, in its options, are
+    left alone.
+    """
+    if batch:
+        pool = batch.snapshot.pool(pool_name) or {}
+        options = pool.get('options', {})
+        wanted = {key: value for key, value in wanted.items()
+                  if options.get(key) != value}
+    for key, value in sorted(wanted.items()):
+        pool_set(service=service, pool_name=pool_name, key=key, value=value)
+    if batch and wanted:
+        pool = batch.snapshot.pool(pool_name)
+        if pool:
+            pool.setdefault('options', {}).update(wanted)
+
+
+def _set_pool_compression(service, pool_name, request, batch=None):
+    """Set the compression settings of a create-pool op on the pool"""
+    wanted = {key.replace('-', '_'): request[key]
+              for key in POOL_COMPRESSION_KEYS if request.get(key)}
+    _set_pool_options(service, pool_name, wanted, batch=batch)
+
+
+def _set_pool_target_size(service, pool, request, batch=None):
+    """Set the target size hints of a create-pool op on the pool.
+
+    The hint not requested is zeroed, target_size_ratio, which the pool is
+    created with from the weight of the op, taking precedence over
+    target_size_bytes.
+
+    :param pool: the pool, which knows whether the cluster is nautilus or
+                 later, the autoscaler hints coming with it.
+    """
+    wanted = {key.replace('-', '_'): request[key]
+              for key in POOL_TARGET_SIZE_KEYS if request.get(key)}
+    if not wanted or not pool.nautilus_or_later:
+        return
+    for key in ('target_size_bytes', 'target_size_ratio'):
+        wanted.setdefault(key, 0)
+    if batch:
+        options = (batch.snapshot.pool(pool.name) or {}).get('options', {})
+        wanted = {key: value for key, value in wanted.items()
+                  if value or options.get(key)}
+    _set_pool_options(service, pool.name, wanted, batch=batch)
+
+
+def pool_tagged(pool, group, snapshot):
+    """Whether the snapshot shows a pool tagged for a group by tag_pool()"""
+    details = snapshot.pool(pool) or {}
+    metadata = details.get('application_metadata', {})
+    return metadata.get(group['app-name'], {}).get(group['tag']) == 'true'
+
+
+def tag_pool(service, pool, group, batch):
+    """Tag a pool with a group, in the metadata of the group's application.
+
+    The application is enabled on pools which have none.  Pools which do
+    not exist yet, or with other applications, are left alone.
+
+    :returns: bool. whether the pool is tagged
+    """
+    app_name = group['app-name']
+    details = batch.snapshot.pool(pool)
+    if details is None:
+        return False
+    if pool_tagged(pool, group, batch.snapshot):
+        return True
+    metadata = details.get('application_metadata') or {}
+    if app_name not in metadata:
+        if metadata:
+            log("Pool '{}' is used by {}, not tagging it for {}".format(
+                pool, ', '.join(sorted(metadata)), app_name), level=DEBUG)
+            return False
+        check_call(['ceph', '--id', service, 'osd', 'pool', 'application',
+                    'enable', pool, app_name])
+    check_call(['ceph', '--id', service, 'osd', 'pool', 'application',
+                'set', pool, app_name, group['tag'], 'true'])
+    batch.snapshot.pool_tagged(pool, app_name, group['tag'], 'true')
+    return True
+
+
+def tag_group_pools(service, group_name, batch):
+    """Tag the pools of a group granted by tag, see tag_pool()"""
+    group = get_group(group_name=group_name, batch=batch)
+    if not group.get('tag'):
+        return
+    for pool in group['pools']:
+        try:
+            tag_pool(service, pool, group, batch)
+        except CalledProcessError as e:
+            log("Error tagging pool '{}': {}".format(pool, e), level=ERROR)
+
+
+def update_service_permissions(service, service_obj=None, namespace=None,
+                               batch=None):
+    """Update the key permissions for the named client in Ceph
+
+    With a batch, the caps are left alone if the snapshot shows the client
+    already has them.
+    """
     if not service_obj:
-        service_obj = get_service_groups(service=service, namespace=namespace)
-    permissions = pool_permission_list_for_service(service_obj)
-    call = ['ceph', 'auth', 'caps', 'client.{}'.format(service)] + permissions
+        service_obj = get_service_groups(service=service, namespace=namespace,
+                                         batch=batch)
+    caps = compile_service_caps(service_obj,
+                                snapshot=batch.snapshot if batch else None)
+    entity = 'client.{}'.format(service)
+    if batch and batch.snapshot.caps(entity) == caps:
+        log("Caps of {} unchanged".format(entity), level=DEBUG)
+        return
+    call = ['ceph', 'auth', 'caps', entity]
+    for caps_type, grants in caps.items():
+        call.extend([caps_type, grants])
     try:
         check_call(call)
     except CalledProcessError as e:
         log("Error updating key capabilities: {}".format(e))
+        return
+    if batch:
+        batch.snapshot.caps_set(entity, caps)
 
 
-def add_pool_to_group(pool, group, namespace=None):
+def add_pool_to_group(pool, group, namespace=None, batch=None):
     """Add a named pool to a named group"""
     group_name = group
     if namespace:
         group_name = "{}-{}".format(namespace, group_name)
-    group = get_group(group_name=group_name)
+    group = get_group(group_name=group_name, batch=batch)
     if pool not in group['pools']:
         group["pools"].append(pool)
-    save_group(group, group_name=group_name)
+    save_group(group, group_name=group_name, batch=batch)
+    if batch and group.get('tag'):
+        batch.tag_group_pools(group_name)
     for service in group['services']:
-        update_service_permissions(service, namespace=namespace)
+        if batch:
+            batch.update_service_permissions(service, namespace=namespace)
+        else:
+            update_service_permissions(service, namespace=namespace)
 
 
-def pool_permission_list_for_service(service):
-    """Build the permission string for Ceph for a given service"""
-    permissions = []
-    permission_types = collections.OrderedDict()
-    for permission, group in sorted(service["group_names"].items()):
-        if permission not in permission_types:
-            permission_types[permission] = []
-        for item in group:
-            permission_types[permission].append(item)
-    for permission, groups in permission_types.items():
-        permission = "allow {}".format(permission)
-        for group in groups:
-            for pool in service['groups'][group].get('pools', []):
-                permissions.append("{} pool={}".format(permission, pool))
+def compile_service_caps(service, snapshot=None):
+    """Compile the caps of a service from its groups.
+
+    Grants are additive, so a pool in several groups of the service gets a
+    single grant with the union of their read, write and execute
+    permissions.  Other permissions, and grants repeated across groups, are
+    given once.  Pools are sorted so the caps do not depend on the order in
+    which groups or pools were added.
+
+    Access to the pools of groups tagged for an application is granted
+    with a single grant on the tag of the group, plus one per pool the
+    snapshot shows is not tagged yet.  Without a snapshot, it is granted
+    pool by pool.
+
+    :param service: service, with its groups, as get_service_groups()
+                    returns it.
+    :param snapshot: ClusterSnapshot of the cluster.
+    :returns: OrderedDict. caps of the 'mon' and 'osd' types
+    """
+    target_permissions = collections.defaultdict(set)
+    other_grants = []
+    for permission, groups in sorted(service['group_names'].items()):
+        targets = set()
+        for group_name in groups:
+            group = service['groups'].get(group_name, {})
+            pools = group.get('pools', [])
+            if snapshot and group.get('tag'):
+                targets.add("tag {} {}=true".format(group['app-name'],
+                                                    group['tag']))
+                pools = [pool for pool in pools
+                         if not pool_tagged(pool, group, snapshot)]
+            targets.update("pool={}".format(pool) for pool in pools)
+        for target in targets:
+            if RWX_PERMISSION.match(permission):
+                target_permissions[target].update(permission)
+            else:
+                other_grants.append((target, permission))
+    grants = []
+    for target, permission in sorted(target_permissions.items()):
+        permission = ''.join(p for p in 'rwx' if p in permission)
+        grants.append("allow {} {}".format(permission, target))
+    for target, permission in sorted(set(other_grants)):
+        grants.append("allow {} {}".format(permission, target))
     for permission, prefixes in sorted(
             service.get("object_prefix_perms", {}).items()):
         for prefix in prefixes:
-            permissions.append("allow {} object_prefix {}".format(permission,
-                                                                  prefix))
-    return ['mon', 'allow r, allow command "osd blacklist"',
-            'osd', ', '.join(permissions)]
+            grants.append("allow {} object_prefix {}".format(permission,
+                                                             prefix))
+    return collections.OrderedDict([('mon', SERVICE_MON_CAPS),
+                                    ('osd', ', '.join(grants))])
+
 
+def pool_permission_list_for_service(service):
+    """Build the permission string for Ceph for a given service"""
+    caps = compile_service_caps(service)
+    return ['mon', caps['mon'], 'osd', caps['osd']]
 
-def get_service_groups(service, namespace=None):
+
+def get_service_groups(service, namespace=None, batch=None):
     """Services are objects stored with some metadata, they look like (for a
     service named "nova"):
     {
@@ -314,20 +924,24 @@ def get_service_groups(service, namespace=None):
         }
     }
     """
-    service_json = monitor_key_get(service='admin',
-                                   key="cephx.services.{}".format(service))
+    service_key = "cephx.services.{}".format(service)
+    if batch:
+        service_json = batch.key_get(service_key)
+    else:
+        service_json = monitor_key_get(service='admin', key=service_key)
     try:
         service = json.loads(service_json)
     except (TypeError, ValueError):
         service = None
     if service:
-        service['groups'] = _build_service_groups(service, namespace)
+        service['groups'] = _build_service_groups(service, namespace,
+                                                  batch=batch)
     else:
         service = {'group_names': {}, 'groups': {}}
     return service
 
 
-def _build_service_groups(service, namespace=None):
+def _build_service_groups(service, namespace=None, batch=None):
     """Rebuild the 'groups' dict for a service group
 
     :returns: dict: dictionary keyed by group name of the following
@@ -350,11 +964,11 @@ def _build_service_groups(service, namespace=None):
             name = group
             if namespace:
                 name = "{}-{}".format(namespace, name)
-            all_groups[group] = get_group(group_name=name)
+            all_groups[group] = get_group(group_name=name, batch=batch)
     return all_groups
 
 
-def get_group(group_name):
+def get_group(group_name, batch=None):
     """A group is a structure to hold data about a named group, structured as:
     {
         pools: ['glance'],
@@ -362,7 +976,10 @@ def get_group(group_name):
     }
     """
     group_key = get_group_key(group_name=group_name)
-    group_json = monitor_key_get(service='admin', key=group_key)
+    if batch:
+        group_json = batch.key_get(group_key)
+    else:
+        group_json = monitor_key_get(service='admin', key=group_key)
     try:
         group = json.loads(group_json)
     except (TypeError, ValueError):
@@ -375,17 +992,22 @@ def get_group(group_name):
     return group
 
 
-def save_service(service_name, service):
+def save_service(service_name, service, batch=None):
     """Persist a service in the monitor cluster"""
     service['groups'] = {}
+    service_key = "cephx.services.{}".format(service_name)
+    if batch:
+        return batch.key_set(service_key, json.dumps(service, sort_keys=True))
     return monitor_key_set(service='admin',
-                           key="cephx.services.{}".format(service_name),
+                           key=service_key,
                            value=json.dumps(service, sort_keys=True))
 
 
-def save_group(group, group_name):
+def save_group(group, group_name, batch=None):
     """Persist a group in the monitor cluster"""
     group_key = get_group_key(group_name=group_name)
+    if batch:
+        return batch.key_set(group_key, json.dumps(group, sort_keys=True))
     return monitor_key_set(service='admin',
                            key=group_key,
                            value=json.dumps(group, sort_keys=True))
@@ -396,11 +1018,17 @@ def get_group_key(group_name):
     return 'cephx.groups.{}'.format(group_name)
 
 
-def handle_erasure_pool(request, service):
+def get_group_tag(group_name):
+    """Build the key of the application metadata tagging pools of a group"""
+    return 'group-{}'.format(group_name)
+
+
+def handle_erasure_pool(request, service, batch=None):
     """Create a new erasure coded pool.
 
     :param request: dict of request operations and params.
     :param service: The ceph client to run the command under.
+    :param batch: cluster state shared with the other ops of the request.
     :returns: dict. exit-code and reason if not 0.
     """
     pool_name = request.get('name')
@@ -427,10 +1055,17 @@ def handle_erasure_pool(request, service):
         # Add the pool to the group named "group_name"
         add_pool_to_group(pool=pool_name,
                           group=group_name,
-                          namespace=group_namespace)
+                          namespace=group_namespace,
+                          batch=batch)
 
     # TODO: Default to 3/2 erasure coding. I believe this requires min 5 osds
-    if not erasure_profile_exists(service=service, name=erasure_profile):
+    if batch:
+        profile_exists = batch.snapshot.erasure_profile_exists(
+            erasure_profile)
+    else:
+        profile_exists = erasure_profile_exists(service=service,
+                                                name=erasure_profile)
+    if not profile_exists:
         # TODO: Fail and tell them to create the profile or default
         msg = ("erasure-profile {} does not exist.  Please create it with: "
                "create-erasure-profile".format(erasure_profile))
@@ -443,22 +1078,29 @@ def handle_erasure_pool(request, service):
                        app_name=app_name,
                        allow_ec_overwrites=allow_ec_overwrites)
     # Ok make the erasure pool
-    if not pool_exists(service=service, name=pool_name):
+    if not _pool_exists(service, pool_name, batch=batch):
         log("Creating pool '{}' (erasure_profile={})"
             .format(pool.name, erasure_profile), level=INFO)
         pool.create()
+        if batch:
+            batch.snapshot.pool_created(
+                pool_name, erasure_code_profile=erasure_profile,
+                application_metadata={pool.app_name: {}})
 
     # Set a quota if requested
     if max_bytes or max_objects:
-        set_pool_quota(service=service, pool_name=pool_name,
-                       max_bytes=max_bytes, max_objects=max_objects)
+        _set_pool_quota(service, pool_name, max_bytes, max_objects,
+                        batch=batch)
+    _set_pool_compression(service, pool_name, request, batch=batch)
+    _set_pool_target_size(service, pool, request, batch=batch)
 
 
-def handle_replicated_pool(request, service):
+def handle_replicated_pool(request, service, batch=None):
     """Create a new replicated pool.
 
     :param request: dict of request operations and params.
     :param service: The ceph client to run the command under.
+    :param batch: cluster state shared with the other ops of the request.
     :returns: dict. exit-code and reason if not 0.
     """
     pool_name = request.get('name')
@@ -472,7 +1114,7 @@ def handle_replicated_pool(request, service):
     pg_num = request.get('pg_num')
     if pg_num:
         # Cap pg_num to max allowed just in case.
-        osds = get_osds(service)
+        osds = batch.snapshot.osds() if batch else get_osds(service)
         if osds:
             pg_num = min(pg_num, (len(osds) * 100 // replicas))
 
@@ -488,7 +1130,8 @@ def handle_replicated_pool(request, service):
         # Add the pool to the group named "group_name"
         add_pool_to_group(pool=pool_name,
                           group=group_name,
-                          namespace=group_namespace)
+                          namespace=group_namespace,
+                          batch=batch)
 
     kwargs = {}
     if pg_num:
@@ -502,26 +1145,33 @@ def handle_replicated_pool(request, service):
 
     pool = ReplicatedPool(service=service,
                           name=pool_name, **kwargs)
-    if not pool_exists(service=service, name=pool_name):
+    if not _pool_exists(service, pool_name, batch=batch):
         log("Creating pool '{}' (replicas={})".format(pool.name, replicas),
             level=INFO)
         pool.create()
+        if batch:
+            batch.snapshot.pool_created(
+                pool_name, size=replicas,
+                application_metadata={pool.app_name: {}})
     else:
         log("Pool '{}' already exists - skipping create".format(pool.name),
             level=DEBUG)
 
     # Set a quota if requested
     if max_bytes or max_objects:
-        set_pool_quota(service=service, pool_name=pool_name,
-                       max_bytes=max_bytes, max_objects=max_objects)
+        _set_pool_quota(service, pool_name, max_bytes, max_objects,
+                        batch=batch)
+    _set_pool_compression(service, pool_name, request, batch=batch)
+    _set_pool_target_size(service, pool, request, batch=batch)
 
 
-def handle_create_cache_tier(request, service):
+def handle_create_cache_tier(request, service, batch=None):
     """Create a cache tier on a cold pool.  Modes supported are
     "writeback" and "readonly".
 
     :param request: dict of request operations and params
     :param service: The ceph client to run the command under.
+    :param batch: cluster state shared with the other ops of the request.
     :returns: dict. exit-code and reason if not 0
     """
     # mode = "writeback" | "readonly"
@@ -533,8 +1183,8 @@ def handle_create_cache_tier(request, service):
         cache_mode = "writeback"
 
     # cache and storage pool must exist first
-    if not pool_exists(service=service, name=storage_pool) or not pool_exists(
-            service=service, name=cache_pool):
+    if (not _pool_exists(service, storage_pool, batch=batch) or
+            not _pool_exists(service, cache_pool, batch=batch)):
         msg = ("cold-pool: {} and hot-pool: {} must exist. Please create "
                "them first".format(storage_pool, cache_pool))
         log(msg, level=ERROR)
@@ -542,20 +1192,23 @@ def handle_create_cache_tier(request, service):
 
     p = Pool(service=service, name=storage_pool)
     p.add_cache_tier(cache_pool=cache_pool, mode=cache_mode)
+    if batch:
+        batch.snapshot.pool_updated(cache_pool, cache_mode=cache_mode)
 
 
-def handle_remove_cache_tier(request, service):
+def handle_remove_cache_tier(request, service, batch=None):
     """Remove a cache tier from the cold pool.
 
     :param request: dict of request operations and params
     :param service: The ceph client to run the command under.
+    :param batch: cluster state shared with the other ops of the request.
     :returns: dict. exit-code and reason if not 0
     """
     storage_pool = request.get('cold-pool')
     cache_pool = request.get('hot-pool')
     # cache and storage pool must exist first
-    if not pool_exists(service=service, name=storage_pool) or not pool_exists(
-            service=service, name=cache_pool):
+    if (not _pool_exists(service, storage_pool, batch=batch) or
+            not _pool_exists(service, cache_pool, batch=batch)):
         msg = ("cold-pool: {} or hot-pool: {} doesn't exist. Not "
                "deleting cache tier".format(storage_pool, cache_pool))
         log(msg, level=ERROR)
@@ -563,15 +1216,18 @@ def handle_remove_cache_tier(request, service):
 
     pool = Pool(name=storage_pool, service=service)
     pool.remove_cache_tier(cache_pool=cache_pool)
+    if batch:
+        batch.snapshot.pool_updated(cache_pool, cache_mode='none')
 
 
-def handle_set_pool_value(request, service, coerce=False):
+def handle_set_pool_value(request, service, coerce=False, batch=None):
     """Sets an arbitrary pool value.
 
     :param request: dict of request operations and params
     :param service: The ceph client to run the command under.
     :param coerce: Try to parse/coerce the value into the correct type.
                    Used by the action code that only gets Str from Juju
+    :param batch: cluster state shared with the other ops of the request.
     :returns: dict. exit-code and reason if not 0
     """
     # Set arbitrary pool values
@@ -602,9 +1258,21 @@ def handle_set_pool_value(request, service, coerce=False):
         # Validate that what the user passed is actually legal per Ceph's rules
         validator(params['value'], validator_params[0], validator_params[1])
 
+    # NOTE: the OSD map holds numeric and boolean pool values under the same
+    #       name as the key, flags and rules being encoded differently.
+    cached = batch and validator_params[0] in (int, bool)
+    if cached:
+        pool = batch.snapshot.pool(params['pool']) or {}
+        if pool.get(params['key']) == params['value']:
+            log("Pool '{}' already has {} = {}".format(
+                params['pool'], params['key'], params['value']), level=DEBUG)
+            return
     # Set the value
     pool_set(service=service, pool_name=params['pool'], key=params['key'],
              value=params['value'])
+    if cached:
+        batch.snapshot.pool_updated(params['pool'],
+                                    **{params['key']: params['value']})
 
 
 def handle_rgw_regionmap_update(request, service):
@@ -850,7 +1518,90 @@ def handle_rgw_region_set(request, service):
     os.unlink(infile.name)
 
 
-def process_requests_v1(reqs):
+class UnknownOpError(ValueError):
+    """Raised for ops the broker does not know of."""
+
+
+def process_op(req, batch):
+    """Process a single op of a request.
+
+    :param req: dict of the op and its params.
+    :param batch: cluster state shared with the other ops of the request.
+    :returns: dict. exit-code and reason if not 0, or None on success
+    :raises: UnknownOpError
+    """
+    op = req.get('op')
+    log("Processing op='{}'".format(op), level=DEBUG)
+    # Use admin client since we do not have other client key locations
+    # setup to use them for these operations.
+    svc = 'admin'
+    if op not in BATCHED_OPS:
+        # NOTE: other ops read and write groups and caps directly.
+        batch.flush()
+    if op == "create-pool":
+        pool_type = req.get('pool-type')  # "replicated" | "erasure"
+
+        # Default to replicated if pool_type isn't given
+        if pool_type == 'erasure':
+            ret = handle_erasure_pool(request=req, service=svc, batch=batch)
+        else:
+            ret = handle_replicated_pool(request=req, service=svc,
+                                         batch=batch)
+    elif op == "create-cephfs":
+        ret = handle_create_cephfs(request=req, service=svc)
+    elif op == "create-cache-tier":
+        ret = handle_create_cache_tier(request=req, service=svc, batch=batch)
+    elif op == "remove-cache-tier":
+        ret = handle_remove_cache_tier(request=req, service=svc, batch=batch)
+    elif op == "create-erasure-profile":
+        ret = handle_create_erasure_profile(request=req, service=svc,
+                                            batch=batch)
+    elif op == "delete-pool":
+        pool = req.get('name')
+        ret = delete_pool(service=svc, name=pool)
+        batch.snapshot.pool_deleted(pool)
+    elif op == "rename-pool":
+        old_name = req.get('name')
+        new_name = req.get('new-name')
+        ret = rename_pool(service=svc, old_name=old_name, new_name=new_name)
+        batch.snapshot.pool_updated(old_name, pool_name=new_name)
+    elif op == "snapshot-pool":
+        pool = req.get('name')
+        snapshot_name = req.get('snapshot-name')
+        ret = snapshot_pool(service=svc, pool_name=pool,
+                            snapshot_name=snapshot_name)
+    elif op == "remove-pool-snapshot":
+        pool = req.get('name')
+        snapshot_name = req.get('snapshot-name')
+        ret = remove_pool_snapshot(service=svc, pool_name=pool,
+                                   snapshot_name=snapshot_name)
+    elif op == "set-pool-value":
+        ret = handle_set_pool_value(request=req, service=svc, batch=batch)
+    elif op == "rgw-region-set":
+        ret = handle_rgw_region_set(request=req, service=svc)
+    elif op == "rgw-zone-set":
+        ret = handle_rgw_zone_set(request=req, service=svc)
+    elif op == "rgw-regionmap-update":
+        ret = handle_rgw_regionmap_update(request=req, service=svc)
+    elif op == "rgw-regionmap-default":
+        ret = handle_rgw_regionmap_default(request=req, service=svc)
+    elif op == "rgw-create-user":
+        ret = handle_rgw_create_user(request=req, service=svc)
+    elif op == "move-osd-to-bucket":
+        ret = handle_put_osd_in_bucket(request=req, service=svc)
+    elif op == "add-permissions-to-key":
+        ret = handle_add_permissions_to_key(request=req, service=svc,
+                                            batch=batch)
+    elif op == 'set-key-permissions':
+        ret = handle_set_key_permissions(request=req, service=svc)
+    elif op == 'rotate-key':
+        ret = handle_rotate_key(request=req, service=svc)
+    else:
+        raise UnknownOpError("Unknown operation '{}'".format(op))
+    return ret
+
+
+def process_requests_v1(reqs, snapshot=None):
     """Process v1 requests.
 
     Takes a list of requests (dicts) and processes each one. If an error is
@@ -858,73 +1609,123 @@ def process_requests_v1(reqs):
 
     Returns a response dict containing the exit code (non-zero if any
     operation failed along with an explanation).
+
+    The ops share a snapshot of the cluster state, see ClusterSnapshot,
+    and consecutive create-pool and add-permissions-to-key ops write group
+    membership and caps once, see BrokerBatch.
     """
     ret = None
     log("Processing {} ceph broker requests".format(len(reqs)), level=INFO)
-    for req in reqs:
-        op = req.get('op')
-        log("Processing op='{}'".format(op), level=DEBUG)
-        # Use admin client since we do not have other client key locations
-        # setup to use them for these operations.
-        svc = 'admin'
-        if op == "create-pool":
-            pool_type = req.get('pool-type')  # "replicated" | "erasure"
-
-            # Default to replicated if pool_type isn't given
-            if pool_type == 'erasure':
-                ret = handle_erasure_pool(request=req, service=svc)
-            else:
-                ret = handle_replicated_pool(request=req, service=svc)
-        elif op == "create-cephfs":
-            ret = handle_create_cephfs(request=req, service=svc)
-        elif op == "create-cache-tier":
-            ret = handle_create_cache_tier(request=req, service=svc)
-        elif op == "remove-cache-tier":
-            ret = handle_remove_cache_tier(request=req, service=svc)
-        elif op == "create-erasure-profile":
-            ret = handle_create_erasure_profile(request=req, service=svc)
-        elif op == "delete-pool":
-            pool = req.get('name')
-            ret = delete_pool(service=svc, name=pool)
-        elif op == "rename-pool":
-            old_name = req.get('name')
-            new_name = req.get('new-name')
-            ret = rename_pool(service=svc, old_name=old_name,
-                              new_name=new_name)
-        elif op == "snapshot-pool":
-            pool = req.get('name')
-            snapshot_name = req.get('snapshot-name')
-            ret = snapshot_pool(service=svc, pool_name=pool,
-                                snapshot_name=snapshot_name)
-        elif op == "remove-pool-snapshot":
-            pool = req.get('name')
-            snapshot_name = req.get('snapshot-name')
-            ret = remove_pool_snapshot(service=svc, pool_name=pool,
-                                       snapshot_name=snapshot_name)
-        elif op == "set-pool-value":
-            ret = handle_set_pool_value(request=req, service=svc)
-        elif op == "rgw-region-set":
-            ret = handle_rgw_region_set(request=req, service=svc)
-        elif op == "rgw-zone-set":
-            ret = handle_rgw_zone_set(request=req, service=svc)
-        elif op == "rgw-regionmap-update":
-            ret = handle_rgw_regionmap_update(request=req, service=svc)
-        elif op == "rgw-regionmap-default":
-            ret = handle_rgw_regionmap_default(request=req, service=svc)
-        elif op == "rgw-create-user":
-            ret = handle_rgw_create_user(request=req, service=svc)
-        elif op == "move-osd-to-bucket":
-            ret = handle_put_osd_in_bucket(request=req, service=svc)
-        elif op == "add-permissions-to-key":
-            ret = handle_add_permissions_to_key(request=req, service=svc)
-        elif op == 'set-key-permissions':
-            ret = handle_set_key_permissions(request=req, service=svc)
-        else:
-            msg = "Unknown operation '{}'".format(op)
-            log(msg, level=ERROR)
-            return {'exit-code': 1, 'stderr': msg}
+    batch = BrokerBatch('admin', snapshot=snapshot)
+    try:
+        for req in reqs:
+            try:
+                ret = process_op(req, batch)
+            except UnknownOpError as e:
+                log(str(e), level=ERROR)
+                return {'exit-code': 1, 'stderr': str(e)}
+    finally:
+        # NOTE: keep the group membership and caps of the ops which ran
+        #       even if an op raised, as when they were written op by op.
+        batch.flush()
 
     if type(ret) == dict and 'exit-code' in ret:
         return ret
 
     return {'exit-code': 0}
+
+
+def get_request_progress_key(digest):
+    """Build the key of the progress of requests of a given digest"""
+    return 'broker.progress.{}'.format(digest)
+
+
+def op_state(req, ret, snapshot):
+    """State of an op once processed, as reported by api version 2.
+
+    :param req: dict of the op and its params.
+    :param ret: result of process_op().
+    :param snapshot: ClusterSnapshot of the cluster.
+    :returns: dict. exit-code, state and any data returned by the op
+    """
+    state = {'exit-code': 0, 'state': 'complete'}
+    if isinstance(ret, dict):
+        state.update(ret)
+    if state['exit-code']:
+        state['state'] = 'failed'
+        return state
+    # NOTE: placement groups of existing pools are split or merged in the
+    #       background, from nautilus on, up to the targets of the pool.
+    pool = None
+    if req.get('op') in ('create-pool', 'set-pool-value'):
+        pool = snapshot.pool(req.get('name'))
+    if pool and (
+            pool.get('pg_num_target', pool.get('pg_num')) !=
+            pool.get('pg_num') or
+            pool.get('pg_placement_num_target',
+                     pool.get('pg_placement_num')) !=
+            pool.get('pg_placement_num')):
+        state['state'] = 'in-progress'
+    return state
+
+
+def process_requests_v2(reqs, digest, snapshot=None):
+    """Process v2 requests.
+
+    As v1, bar that the state of each op is reported and that ops are not
+    processed again when the same request is re-sent, whatever its request
+    id, once they succeeded: a request which failed part way through can be
+    resumed from the op which failed.  Ops returning data, see RESULT_OPS,
+    and ops whose pool or erasure profile no longer exists, see
+    op_target_exists(), are processed each time.  The progress of a
+    request is forgotten once it is complete.
+
+    Returns a response dict containing the exit code (non-zero if any
+    operation failed along with an explanation), the state of each op,
+    'complete', 'in-progress', 'failed' or 'pending' if not processed yet,
+    and whether the request is complete.
+
+    :param reqs: list of ops of the request.
+    :param digest: digest of the request, see request_digest().
+    :param snapshot: ClusterSnapshot of the cluster.
+    """
+    batch = BrokerBatch('admin', snapshot=snapshot)
+    progress_key = get_request_progress_key(digest)
+    try:
+        done = set(json.loads(batch.key_get(progress_key) or '[]'))
+    except ValueError:
+        done = set()
+    log("Processing {} ceph broker requests, {} already done".format(
+        len(reqs), len(done)), level=INFO)
+    resp = {'exit-code': 0}
+    states = []
+    for index, req in enumerate(reqs):
+        if resp['exit-code']:
+            states.append({'state': 'pending'})
+            continue
+        if (index in done and req.get('op') not in RESULT_OPS and
+                op_target_exists(req, batch.snapshot)):
+            states.append(op_state(req, None, batch.snapshot))
+            continue
+        try:
+            ret = process_op(req, batch)
+        except Exception as e:
+            # NOTE: report the op failed, keeping the progress made so far.
+            log("Op {} failed: {}".format(index, e), level=ERROR)
+            ret = {'exit-code': 1, 'stderr': str(e)}
+        state = op_state(req, ret, batch.snapshot)
+        states.append(state)
+        if state['exit-code']:
+            resp = {'exit-code': state['exit-code'],
+                    'stderr': state.get('stderr')}
+        else:
+            done.add(index)
+
+    resp['ops'] = states
+    resp['complete'] = all(state['state'] == 'complete' for state in states)
+    if resp['complete']:
+        batch.key_delete(progress_key)
+    else:
+        batch.key_set(progress_key, json.dumps(sorted(done)))
+    batch.flush()
+    return resp
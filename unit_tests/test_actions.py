@@ -12,6 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import shutil
+import tempfile
+
 import mock
 from mock import patch
 
@@ -140,3 +144,112 @@ class MultisiteActionsTestCase(CharmTestCase):
     def test_tidydefaults_unconfigured(self):
         actions.tidydefaults([])
         self.action_fail.assert_called_once()
+
+
+class ProfileReportTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(ProfileReportTestCase, self).setUp(
+            actions, ["action_fail", "action_get", "action_set", "profiling"])
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.profiling.profile_dir.return_value = self.tmpdir
+        self.action_params = {'hook': None, 'count': 1, 'collapsed': False}
+        self.action_get.side_effect = self.action_params.get
+
+    def test_profile_report(self):
+        base = os.path.join(self.tmpdir, '20200101000000-update-status')
+        with open(base + '.txt', 'w') as f:
+            f.write('report')
+        with open(base + '.collapsed', 'w') as f:
+            f.write('hooks.py:<module> 1\n')
+        self.profiling.list_profiles.return_value = [base]
+        self.action_params['hook'] = 'update-status'
+        actions.profile_report([])
+        self.profiling.list_profiles.assert_called_once_with('update-status')
+        self.action_set.assert_called_once_with(values={
+            'profile-0.path': base + '.txt',
+            'profile-0.report': 'report'})
+        self.action_params['collapsed'] = True
+        actions.profile_report([])
+        self.action_set.assert_called_with(values={
+            'profile-0.path': base + '.txt',
+            'profile-0.report': 'report',
+            'profile-0.collapsed': 'hooks.py:<module> 1\n'})
+
+    def test_profile_report_none(self):
+        self.profiling.list_profiles.return_value = []
+        actions.profile_report([])
+        self.action_fail.assert_called_once_with(
+            'No profiles found in {}, is the profile-hooks config option '
+            'set?'.format(self.tmpdir))
+        self.action_set.assert_not_called()
+
+
+class RotateKeyTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(RotateKeyTestCase, self).setUp(
+            actions, ["action_fail", "action_set", "is_leader",
+                      "key_rotation", "request_per_unit_key"])
+        self.is_leader.return_value = True
+        self.request_per_unit_key.return_value = True
+        self.key_rotation.start_rotation.return_value = {
+            'nonce': 'nonce', 'queue': ['rgw/1', 'rgw/0']}
+        self.key_rotation.advance_rotation.return_value = False
+        self.key_rotation.pending_nonce.return_value = None
+
+    def test_rotate_key(self):
+        actions.rotate_key([])
+        self.key_rotation.start_rotation.assert_called_once_with()
+        self.key_rotation.request_rotation.assert_not_called()
+        self.action_set.assert_called_once_with(values={
+            'nonce': 'nonce', 'units': 'rgw/1 rgw/0'})
+
+    def test_rotate_key_single_unit(self):
+        self.key_rotation.pending_nonce.return_value = 'nonce'
+        actions.rotate_key([])
+        self.key_rotation.request_rotation.assert_called_once_with()
+
+    def test_rotate_key_not_leader(self):
+        self.is_leader.return_value = False
+        actions.rotate_key([])
+        self.action_fail.assert_called_once()
+        self.key_rotation.start_rotation.assert_not_called()
+
+    def test_rotate_key_shared_key(self):
+        self.request_per_unit_key.return_value = False
+        actions.rotate_key([])
+        self.action_fail.assert_called_once()
+        self.key_rotation.start_rotation.assert_not_called()
+
+    def test_rotate_key_unsupported(self):
+        self.key_rotation.rotation_supported.return_value = False
+        actions.rotate_key([])
+        self.action_fail.assert_called_once_with(
+            'ceph-mon does not support key rotation')
+        self.key_rotation.start_rotation.assert_not_called()
+
+    def test_cancel_key_rotation(self):
+        self.key_rotation.cancel_rotation.return_value = {
+            'nonce': 'nonce', 'queue': ['rgw/1', 'rgw/0']}
+        actions.cancel_key_rotation([])
+        self.key_rotation.request_rotation.assert_called_once_with()
+        self.action_set.assert_called_once_with(values={
+            'nonce': 'nonce', 'units': 'rgw/1 rgw/0'})
+
+    def test_cancel_key_rotation_none(self):
+        self.key_rotation.cancel_rotation.side_effect = ValueError(
+            'No key rotation in progress')
+        actions.cancel_key_rotation([])
+        self.action_fail.assert_called_once_with(
+            'No key rotation in progress')
+        self.key_rotation.request_rotation.assert_not_called()
+
+    def test_rotate_key_in_progress(self):
+        self.key_rotation.start_rotation.side_effect = ValueError(
+            'A key rotation is already in progress')
+        actions.rotate_key([])
+        self.action_fail.assert_called_once_with(
+            'A key rotation is already in progress')
+        self.action_set.assert_not_called()
@@ -0,0 +1,314 @@
+# Copyright 2020 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock import patch
+
+import apt_utils
+
+from test_utils import CharmTestCase
+
+TO_PATCH = [
+    'apt_pkg',
+    'ch_fetch',
+    'config',
+    'status_set',
+    'unitdata',
+]
+
+HOLD_LOCK = """
+import fcntl, sys, time
+f = open(sys.argv[1], 'w')
+fcntl.lockf(f, fcntl.LOCK_EX)
+print('locked', flush=True)
+time.sleep(float(sys.argv[2]))
+"""
+
+APT_CACHE_SHOW = {
+    'radosgw': {'package': 'radosgw', 'version': '12.2.13-0ubuntu0.18.04.1'},
+    'haproxy': {'package': 'haproxy', 'version': '1.8.8-1ubuntu0.9'},
+    'apache2': {'package': 'apache2', 'version': '2.4.29-1ubuntu4.13'},
+    'ntp': {'package': 'ntp', 'version': '1:4.2.8p10+dfsg-5ubuntu7.1'},
+}
+
+DPKG_STATUS = """Package: radosgw
+Status: install ok installed
+Priority: optional
+Architecture: amd64
+Version: 12.2.13-0ubuntu0.18.04.1
+Description: REST gateway for RADOS distributed object store
+ RADOS is a distributed object store used by the Ceph distributed
+ storage system.
+
+Package: haproxy
+Status: hold ok installed
+Architecture: amd64
+Version: 1.8.8-1ubuntu0.9
+
+Package: ntp
+Status: deinstall ok config-files
+Architecture: amd64
+Version: 1:4.2.8p10+dfsg-5ubuntu7.1
+"""
+
+
+class AptUtilsTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(AptUtilsTestCase, self).setUp(apt_utils, TO_PATCH)
+        for attr in ('_cache', '_installed', '_version_compare',
+                     '_transaction'):
+            _m = patch.object(apt_utils, attr, None)
+            _m.start()
+            self.addCleanup(_m.stop)
+        self.unitdata.kv.return_value = self.test_kv
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.dpkg_status = os.path.join(self.tmpdir, 'status')
+        with open(self.dpkg_status, 'w') as f:
+            f.write(DPKG_STATUS)
+        _m = patch.object(apt_utils, 'DPKG_STATUS', self.dpkg_status)
+        _m.start()
+        self.addCleanup(_m.stop)
+        self.dpkg_lock = os.path.join(self.tmpdir, 'lock-frontend')
+        open(self.dpkg_lock, 'w').close()
+        _m = patch.object(apt_utils, 'DPKG_LOCKS', [self.dpkg_lock])
+        _m.start()
+        self.addCleanup(_m.stop)
+        self.config.side_effect = self.test_config.get
+        _m = patch.object(apt_utils, '_parse_dpkg_status',
+                          wraps=apt_utils._parse_dpkg_status)
+        self._parse_dpkg_status = _m.start()
+        self.addCleanup(_m.stop)
+        self._apt_cache_show = self.patch_cache('_apt_cache_show')
+        self._apt_cache_show.side_effect = lambda pkgs: {
+            k: dict(v) for k, v in APT_CACHE_SHOW.items() if k in pkgs}
+
+    def patch_cache(self, method):
+        _m = patch.object(apt_utils.PackageCache, method)
+        mock = _m.start()
+        self.addCleanup(_m.stop)
+        return mock
+
+    def new_hook(self):
+        """Reset state kept in memory as if a new hook was run."""
+        apt_utils._cache = None
+        apt_utils._installed = None
+        apt_utils._version_compare = None
+
+    def test_parse_dpkg_status(self):
+        self.assertEqual(
+            apt_utils._parse_dpkg_status(self.dpkg_status),
+            {'radosgw': {'version': '12.2.13-0ubuntu0.18.04.1',
+                         'architecture': 'amd64', 'hold': False},
+             'haproxy': {'version': '1.8.8-1ubuntu0.9',
+                         'architecture': 'amd64', 'hold': True}})
+
+    def test_installed_packages(self):
+        installed = apt_utils.installed_packages()
+        self.assertEqual(sorted(installed.keys()), ['haproxy', 'radosgw'])
+        self.assertTrue(installed is apt_utils.installed_packages())
+        self.test_kv.flush.assert_called_once_with()
+        # unchanged dpkg status is not parsed again by the next hook
+        self.new_hook()
+        self.assertEqual(apt_utils.installed_packages(), installed)
+        self._parse_dpkg_status.assert_called_once_with()
+        # change of dpkg status
+        with open(self.dpkg_status, 'a') as f:
+            f.write('\nPackage: apache2\nStatus: install ok installed\n'
+                    'Version: 2.4.29-1ubuntu4.13\n')
+        self.new_hook()
+        self.assertIn('apache2', apt_utils.installed_packages())
+        self.assertEqual(self._parse_dpkg_status.call_count, 2)
+
+    def test_apt_cache_installed(self):
+        cache = apt_utils.apt_cache()
+        self.assertEqual(cache['radosgw'].current_ver.ver_str,
+                         '12.2.13-0ubuntu0.18.04.1')
+        self.assertEqual(cache['radosgw'].name, 'radosgw')
+        self.assertEqual(cache['radosgw'].architecture, 'amd64')
+        self.assertTrue(cache is apt_utils.apt_cache())
+        self._apt_cache_show.assert_not_called()
+
+    def test_apt_cache_prefetch(self):
+        cache = apt_utils.apt_cache()
+        self.assertIsNone(cache['apache2'].current_ver)
+        self.assertIsNone(cache['ntp'].current_ver)
+        self.assertRaises(KeyError, lambda: cache['libapache2-mod-fastcgi'])
+        self._apt_cache_show.assert_called_once_with(
+            ['apache2', 'libapache2-mod-fastcgi', 'ntp'])
+        self.assertFalse('python-dbus' in cache)
+        self._apt_cache_show.assert_called_with(['python-dbus'])
+
+    def test_filter_installed_packages(self):
+        self.assertEqual(
+            apt_utils.filter_installed_packages(
+                ['haproxy', 'ntp', 'radosgw', 'apache2', 'python-dbus']),
+            ['ntp', 'apache2', 'python-dbus'])
+        self.assertEqual(
+            sorted(apt_utils.filter_missing_packages(
+                ['haproxy', 'ntp', 'radosgw', 'apache2'])),
+            ['haproxy', 'radosgw'])
+        self._apt_cache_show.assert_not_called()
+
+    def test_cmp_pkgrevno(self):
+        self.apt_pkg.version_compare.return_value = 1
+        self.assertEqual(apt_utils.cmp_pkgrevno('radosgw', '10.2.0'), 1)
+        self.assertEqual(apt_utils.cmp_pkgrevno('radosgw', '10.2.0'), 1)
+        self.new_hook()
+        self.assertEqual(apt_utils.cmp_pkgrevno('radosgw', '10.2.0'), 1)
+        self.apt_pkg.version_compare.assert_called_once_with(
+            '12.2.13-0ubuntu0.18.04.1', '10.2.0')
+        self.assertEqual(
+            self.test_kv.data[apt_utils.VERSION_COMPARE_KEY],
+            {'12.2.13-0ubuntu0.18.04.1 10.2.0': 1})
+
+    def test_get_upstream_version(self):
+        self.apt_pkg.upstream_version.return_value = '12.2.13'
+        self.assertEqual(apt_utils.get_upstream_version('radosgw'),
+                         '12.2.13')
+        self.apt_pkg.upstream_version.assert_called_once_with(
+            '12.2.13-0ubuntu0.18.04.1')
+        self.assertIsNone(apt_utils.get_upstream_version('apache2'))
+        self.assertIsNone(apt_utils.get_upstream_version('python-dbus'))
+
+    def test_apt_install_invalidates(self):
+        self.assertIsNone(apt_utils.apt_cache()['apache2'].current_ver)
+        apt_utils.apt_install(['apache2'], fatal=True)
+        self.ch_fetch.apt_install.assert_called_once_with(
+            ['apache2'], options=None, fatal=True)
+        with open(self.dpkg_status, 'a') as f:
+            f.write('\nPackage: apache2\nStatus: install ok installed\n'
+                    'Version: 2.4.29-1ubuntu4.13\n')
+        self.assertEqual(apt_utils.apt_cache()['apache2'].current_ver.ver_str,
+                         '2.4.29-1ubuntu4.13')
+
+    def test_apt_purge_invalidates(self):
+        apt_utils.apt_cache()['radosgw']
+        apt_utils.apt_purge('radosgw')
+        self.ch_fetch.apt_purge.assert_called_once_with('radosgw',
+                                                        fatal=False)
+        self.assertIsNone(apt_utils._installed)
+        self.assertFalse(apt_utils._cache._packages)
+
+    def test_apt_update_invalidates(self):
+        apt_utils.apt_cache()['apache2']
+        apt_utils.apt_update(fatal=True)
+        self.ch_fetch.apt_update.assert_called_once_with(fatal=True)
+        apt_utils.apt_cache()['apache2']
+        self.assertEqual(self._apt_cache_show.call_count, 2)
+
+    def test_apt_transaction(self):
+        transaction = apt_utils.apt_transaction()
+        self.assertTrue(transaction is apt_utils.apt_transaction())
+        transaction.add_update()
+        transaction.add_install(['haproxy', 'radosgw', 'apache2'])
+        transaction.add_install('python-dbus')
+        transaction.add_install('python-dbus')
+        transaction.add_purge(['libapache2-mod-fastcgi', 'ntp', 'radosgw'])
+        self.assertEqual(
+            transaction.plan(),
+            (['apache2', 'python-dbus'], ['radosgw']))
+        transaction.commit(message='Installing packages')
+        self.status_set.assert_called_once_with('maintenance',
+                                                'Installing packages')
+        self.ch_fetch.apt_update.assert_called_once_with(fatal=True)
+        self.ch_fetch.apt_install.assert_called_once_with(
+            ['apache2', 'python-dbus', 'radosgw_'], options=None, fatal=True)
+        self.assertEqual(transaction.plan(), ([], []))
+
+    def test_apt_transaction_upgrade(self):
+        transaction = apt_utils.apt_transaction()
+        transaction.add_install(['haproxy', 'radosgw'], upgrade=True)
+        transaction.add_install(['haproxy/trusty-backports'])
+        self.assertEqual(
+            transaction.plan(),
+            (['haproxy', 'radosgw', 'haproxy/trusty-backports'], []))
+
+    def test_commit_apt_transaction(self):
+        apt_utils.apt_transaction().add_install('python-dbus')
+        apt_utils.commit_apt_transaction()
+        self.ch_fetch.apt_install.assert_called_once_with(
+            ['python-dbus'], options=None, fatal=False)
+        self.assertEqual(apt_utils.apt_transaction().plan(), ([], []))
+
+    def test_commit_apt_transaction_locked(self):
+        self.hold_lock(10)
+        apt_utils.apt_transaction().add_install('python-dbus')
+        start = time.time()
+        apt_utils.commit_apt_transaction()
+        # Neither waits for the lock nor fails, the changes are dropped.
+        self.assertLess(time.time() - start, 1)
+        self.ch_fetch.apt_install.assert_not_called()
+        self.status_set.assert_not_called()
+        self.assertEqual(apt_utils.apt_transaction().plan(), ([], []))
+
+    def test_apt_transaction_noop(self):
+        transaction = apt_utils.apt_transaction()
+        transaction.add_update()
+        transaction.add_install(['haproxy', 'radosgw'])
+        transaction.add_purge(['libapache2-mod-fastcgi'])
+        apt_utils.commit_apt_transaction()
+        self.ch_fetch.apt_update.assert_not_called()
+        self.ch_fetch.apt_install.assert_not_called()
+        # nothing queued
+        self.test_kv.get.reset_mock()
+        apt_utils.commit_apt_transaction()
+        self.test_kv.get.assert_not_called()
+
+    def hold_lock(self, seconds):
+        proc = subprocess.Popen(
+            [sys.executable, '-c', HOLD_LOCK, self.dpkg_lock, str(seconds)],
+            stdout=subprocess.PIPE)
+        self.addCleanup(proc.wait)
+        self.addCleanup(proc.kill)
+        proc.stdout.readline()
+        return proc
+
+    def test_dpkg_lock_holder(self):
+        self.assertIsNone(apt_utils.dpkg_lock_holder(self.dpkg_lock))
+        self.assertIsNone(apt_utils.dpkg_lock_holder(
+            os.path.join(self.tmpdir, 'missing')))
+        proc = self.hold_lock(10)
+        self.assertEqual(apt_utils.dpkg_lock_holder(self.dpkg_lock),
+                         proc.pid)
+
+    def test_wait_for_dpkg_lock(self):
+        proc = self.hold_lock(0.5)
+        apt_utils.wait_for_dpkg_lock()
+        self.assertIsNone(apt_utils.dpkg_lock_holder(self.dpkg_lock))
+        self.status_set.assert_called_once()
+        status, message = self.status_set.call_args[0]
+        self.assertEqual(status, 'maintenance')
+        self.assertTrue(message.startswith(
+            'Waiting for dpkg lock held by PID {} ('.format(proc.pid)))
+
+    def test_wait_for_dpkg_lock_timeout(self):
+        self.hold_lock(10)
+        self.assertRaises(apt_utils.DpkgLockTimeout,
+                          apt_utils.wait_for_dpkg_lock, 0.2)
+        # waiting disabled
+        self.test_config.set('dpkg-lock-timeout', 0)
+        apt_utils.wait_for_dpkg_lock()
+        self.status_set.assert_called_once()
+
+    def test_wait_for_dpkg_lock_unlocked(self):
+        apt_utils.wait_for_dpkg_lock()
+        self.status_set.assert_not_called()
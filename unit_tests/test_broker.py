@@ -0,0 +1,379 @@
+# Copyright 2020 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import subprocess
+
+from mock import patch
+
+from charms_ceph import broker
+
+from test_utils import CharmTestCase
+
+TO_PATCH = [
+    'check_call',
+    'log',
+    'monitor_key_delete',
+    'monitor_key_get',
+    'monitor_key_set',
+    'pool_set',
+    'set_pool_quota',
+    'ErasurePool',
+    'ReplicatedPool',
+]
+
+CREATE_POOL = {'op': 'create-pool', 'name': 'p1', 'replicas': 3}
+
+
+class BrokerTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(BrokerTestCase, self).setUp(broker, TO_PATCH)
+        self.ReplicatedPool.return_value.name = 'p1'
+
+    def _snapshot(self, **kwargs):
+        kwargs.setdefault('osds', [0, 1, 2])
+        return broker.StubClusterSnapshot(**kwargs)
+
+    def test_process_requests_v2(self):
+        snapshot = self._snapshot()
+        resp = broker.process_requests_v2([CREATE_POOL], 'digest',
+                                          snapshot=snapshot)
+        self.assertEqual(resp, {'exit-code': 0, 'complete': True,
+                                'ops': [{'exit-code': 0,
+                                         'state': 'complete'}]})
+        self.ReplicatedPool.return_value.create.assert_called_once_with()
+        self.assertTrue(snapshot.pool_exists('p1'))
+        # NOTE: no progress was recorded, none is deleted.
+        self.monitor_key_set.assert_not_called()
+        self.monitor_key_delete.assert_not_called()
+
+    def test_process_requests_v2_resume(self):
+        progress_key = broker.get_request_progress_key('digest')
+        snapshot = self._snapshot(
+            pools=['p1'],
+            config_keys={progress_key: '[0]'})
+        ops = [CREATE_POOL, {'op': 'create-pool', 'name': 'p2',
+                             'replicas': 3}]
+        resp = broker.process_requests_v2(ops, 'digest', snapshot=snapshot)
+        self.assertTrue(resp['complete'])
+        # Only the op not done yet is processed.
+        self.ReplicatedPool.assert_called_once_with(
+            service='admin', name='p2', replicas=3)
+        self.monitor_key_delete.assert_called_once_with(
+            service='admin', key=progress_key)
+
+    def test_process_requests_v2_done_pool_deleted(self):
+        progress_key = broker.get_request_progress_key('digest')
+        snapshot = self._snapshot(config_keys={progress_key: '[0]'})
+        resp = broker.process_requests_v2([CREATE_POOL], 'digest',
+                                          snapshot=snapshot)
+        self.assertTrue(resp['complete'])
+        self.ReplicatedPool.return_value.create.assert_called_once_with()
+        self.assertTrue(snapshot.pool_exists('p1'))
+
+    def test_process_requests_v2_in_progress(self):
+        progress_key = broker.get_request_progress_key('digest')
+        snapshot = self._snapshot(pools=[
+            {'pool_name': 'p1', 'pg_num': 32, 'pg_num_target': 64}])
+        resp = broker.process_requests_v2([CREATE_POOL], 'digest',
+                                          snapshot=snapshot)
+        self.assertFalse(resp['complete'])
+        self.assertEqual(resp['ops'][0]['state'], 'in-progress')
+        self.monitor_key_set.assert_called_once_with(
+            service='admin', key=progress_key, value=json.dumps([0]))
+        self.monitor_key_delete.assert_not_called()
+
+    def test_snapshot_create_pool(self):
+        snapshot = self._snapshot()
+        batch = broker.BrokerBatch('admin', snapshot=snapshot)
+        broker.process_op(dict(CREATE_POOL, group='objects'), batch)
+        self.assertEqual(snapshot.pool('p1')['size'], 3)
+        # The pool is known to exist, it is not created again.
+        broker.process_op(CREATE_POOL, batch)
+        self.ReplicatedPool.return_value.create.assert_called_once_with()
+
+    def test_snapshot_set_pool_value(self):
+        snapshot = self._snapshot(pools=['p1'])
+        batch = broker.BrokerBatch('admin', snapshot=snapshot)
+        op = {'op': 'set-pool-value', 'name': 'p1', 'key': 'size',
+              'value': 2}
+        broker.process_op(op, batch)
+        broker.process_op(op, batch)
+        self.pool_set.assert_called_once_with(
+            service='admin', pool_name='p1', key='size', value=2)
+        self.assertEqual(snapshot.pool('p1')['size'], 2)
+
+    def test_snapshot_create_pool_existing(self):
+        snapshot = self._snapshot(pools=['p1'])
+        batch = broker.BrokerBatch('admin', snapshot=snapshot)
+        broker.process_op(dict(CREATE_POOL, **{'max-bytes': 1024,
+                                               'target-size-ratio': 0.5}),
+                          batch)
+        # The settings of the op are applied to the pool which exists.
+        self.ReplicatedPool.return_value.create.assert_not_called()
+        self.set_pool_quota.assert_called_once_with(
+            service='admin', pool_name='p1', max_bytes=1024,
+            max_objects=None)
+        self.pool_set.assert_called_once_with(
+            service='admin', pool_name='p1', key='target_size_ratio',
+            value=0.5)
+
+    def test_batch_flush(self):
+        snapshot = self._snapshot()
+        batch = broker.BrokerBatch('admin', snapshot=snapshot)
+        ops = [{'op': 'add-permissions-to-key', 'group': 'objects',
+                'name': 'rgw', 'group-permission': 'rwx'}]
+        for pool in ('p1', 'p2'):
+            ops.append(dict(CREATE_POOL, name=pool, group='objects'))
+        for op in ops:
+            broker.process_op(op, batch)
+        # NOTE: keys and caps are only written once flushed.
+        self.monitor_key_set.assert_not_called()
+        self.check_call.assert_not_called()
+        batch.flush()
+        self.assertEqual(
+            sorted(c[1]['key'] for c in self.monitor_key_set.call_args_list),
+            ['cephx.groups.objects', 'cephx.services.rgw'])
+        self.assertEqual(
+            json.loads(snapshot.config_key('cephx.groups.objects')),
+            {'pools': ['p1', 'p2'], 'services': ['rgw']})
+        self.check_call.assert_called_once_with(
+            ['ceph', 'auth', 'caps', 'client.rgw',
+             'mon', broker.SERVICE_MON_CAPS,
+             'osd', 'allow rwx pool=p1, allow rwx pool=p2'])
+        # Nothing changed since, nothing is written again.
+        batch.flush()
+        self.assertEqual(self.monitor_key_set.call_count, 2)
+        self.check_call.assert_called_once()
+
+    def test_process_requests_v1(self):
+        snapshot = self._snapshot()
+        ops = [{'op': 'add-permissions-to-key', 'group': 'objects',
+                'name': 'rgw', 'group-permission': 'rwx'}]
+        for pool in ('p1', 'p2', 'p3'):
+            ops.append(dict(CREATE_POOL, name=pool, group='objects'))
+        self.assertEqual(broker.process_requests_v1(ops, snapshot=snapshot),
+                         {'exit-code': 0})
+        self.assertEqual(self.ReplicatedPool.return_value.create.call_count,
+                         3)
+        # Group membership and caps are written once for all the pools.
+        self.assertEqual(
+            sorted(c[1]['key'] for c in self.monitor_key_set.call_args_list),
+            ['cephx.groups.objects', 'cephx.services.rgw'])
+        self.check_call.assert_called_once_with(
+            ['ceph', 'auth', 'caps', 'client.rgw',
+             'mon', broker.SERVICE_MON_CAPS,
+             'osd', 'allow rwx pool=p1, allow rwx pool=p2, '
+                    'allow rwx pool=p3'])
+
+    def test_process_requests_v1_op_raises(self):
+        snapshot = self._snapshot()
+        self.ReplicatedPool.return_value.create.side_effect = [
+            None, subprocess.CalledProcessError(1, 'ceph')]
+        ops = [{'op': 'add-permissions-to-key', 'group': 'objects',
+                'name': 'rgw', 'group-permission': 'rwx'}]
+        for pool in ('p1', 'p2', 'p3'):
+            ops.append(dict(CREATE_POOL, name=pool, group='objects'))
+        self.assertRaises(subprocess.CalledProcessError,
+                          broker.process_requests_v1, ops, snapshot=snapshot)
+        # The changes of the ops which ran are written nonetheless.
+        self.assertEqual(
+            json.loads(snapshot.config_key('cephx.groups.objects')),
+            {'pools': ['p1', 'p2'], 'services': ['rgw']})
+        self.assertEqual(
+            sorted(c[1]['key'] for c in self.monitor_key_set.call_args_list),
+            ['cephx.groups.objects', 'cephx.services.rgw'])
+        self.check_call.assert_called_once_with(
+            ['ceph', 'auth', 'caps', 'client.rgw',
+             'mon', broker.SERVICE_MON_CAPS,
+             'osd', 'allow rwx pool=p1, allow rwx pool=p2'])
+
+    def test_process_requests_without_client(self):
+        snapshots = []
+
+        def snapshot(service):
+            snapshots.append(self._snapshot())
+            return snapshots[-1]
+
+        request = json.dumps({'api-version': 1, 'request-id': 'id',
+                              'ops': [CREATE_POOL]})
+        with patch.object(broker, 'ClusterSnapshot', side_effect=snapshot):
+            for _ in range(2):
+                self.assertEqual(json.loads(broker.process_requests(request)),
+                                 {'exit-code': 0, 'request-id': 'id'})
+        # Each request is processed in full and no digest is recorded.
+        self.assertEqual(self.ReplicatedPool.return_value.create.call_count,
+                         2)
+        self.monitor_key_set.assert_not_called()
+        self.assertTrue(all(snapshot.pool_exists('p1')
+                            for snapshot in snapshots))
+
+    def _process_requests(self, snapshot, ops=(CREATE_POOL,),
+                          request_id='id'):
+        request = {'api-version': 1, 'request-id': request_id,
+                   'ops': list(ops)}
+        with patch.object(broker, 'ClusterSnapshot', return_value=snapshot):
+            return json.loads(broker.process_requests(json.dumps(request),
+                                                      client='rgw'))
+
+    def test_process_requests_applied(self):
+        digest = broker.request_digest({'api-version': 1,
+                                        'ops': [CREATE_POOL]})
+        snapshot = self._snapshot(
+            pools=['p1'],
+            config_keys={broker.get_request_digest_key('rgw'): digest})
+        self.assertEqual(self._process_requests(snapshot, request_id='new'),
+                         {'exit-code': 0, 'request-id': 'new'})
+        self.ReplicatedPool.assert_not_called()
+        self.monitor_key_set.assert_not_called()
+
+    def test_process_requests_applied_pool_deleted(self):
+        digest = broker.request_digest({'api-version': 1,
+                                        'ops': [CREATE_POOL]})
+        snapshot = self._snapshot(
+            config_keys={broker.get_request_digest_key('rgw'): digest})
+        self.assertEqual(self._process_requests(snapshot),
+                         {'exit-code': 0, 'request-id': 'id'})
+        self.ReplicatedPool.return_value.create.assert_called_once_with()
+        self.monitor_key_set.assert_called_once_with(
+            service='admin', key=broker.get_request_digest_key('rgw'),
+            value=digest)
+
+    def test_request_digest(self):
+        request = {'api-version': 1, 'request-id': 'id',
+                   'ops': [CREATE_POOL]}
+        digest = broker.request_digest(request)
+        self.assertEqual(
+            broker.request_digest(dict(request, **{'request-id': 'new'})),
+            digest)
+        self.assertNotEqual(
+            broker.request_digest(dict(request, ops=[
+                dict(CREATE_POOL, replicas=2)])),
+            digest)
+        # A changed request is processed in full.
+        snapshot = self._snapshot(
+            pools=['p1'],
+            config_keys={broker.get_request_digest_key('rgw'): digest})
+        self._process_requests(snapshot, ops=[dict(CREATE_POOL, replicas=2)])
+        self.ReplicatedPool.assert_called_once_with(
+            service='admin', name='p1', replicas=2)
+
+    def _tagged_service(self):
+        group = {'pools': ['p1', 'p2'], 'services': ['rgw'],
+                 'app-name': 'rgw', 'tag': 'group-objects'}
+        return {'group_names': {'rwx': ['objects']},
+                'groups': {'objects': group}}
+
+    def test_compile_service_caps_tag(self):
+        tagged = {'rgw': {'group-objects': 'true'}}
+        snapshot = self._snapshot(pools=[
+            {'pool_name': 'p1', 'application_metadata': tagged},
+            {'pool_name': 'p2', 'application_metadata': {'rgw': {}}}])
+        service = self._tagged_service()
+        self.assertEqual(
+            broker.compile_service_caps(service, snapshot=snapshot)['osd'],
+            'allow rwx pool=p2, allow rwx tag rgw group-objects=true')
+        snapshot.pool_tagged('p2', 'rgw', 'group-objects', 'true')
+        self.assertEqual(
+            broker.compile_service_caps(service, snapshot=snapshot),
+            {'mon': broker.SERVICE_MON_CAPS,
+             'osd': 'allow rwx tag rgw group-objects=true'})
+        # Without a snapshot, access is granted pool by pool.
+        self.assertEqual(
+            broker.compile_service_caps(service)['osd'],
+            'allow rwx pool=p1, allow rwx pool=p2')
+
+    def test_compile_service_caps_merged(self):
+        service = {
+            'group_names': {'r': ['images'], 'rwx': ['objects'],
+                            'class-read': ['images']},
+            'groups': {'images': {'pools': ['p2', 'p1']},
+                       'objects': {'pools': ['p1']}},
+        }
+        self.assertEqual(
+            broker.compile_service_caps(service)['osd'],
+            'allow rwx pool=p1, allow r pool=p2, '
+            'allow class-read pool=p1, allow class-read pool=p2')
+
+    def test_update_service_permissions_unchanged(self):
+        snapshot = self._snapshot(pools=['p1', 'p2'])
+        batch = broker.BrokerBatch('admin', snapshot=snapshot)
+        service = self._tagged_service()
+        for _ in range(2):
+            broker.update_service_permissions('rgw', service, batch=batch)
+        self.check_call.assert_called_once_with(
+            ['ceph', 'auth', 'caps', 'client.rgw',
+             'mon', broker.SERVICE_MON_CAPS,
+             'osd', 'allow rwx pool=p1, allow rwx pool=p2, '
+                    'allow rwx tag rgw group-objects=true'])
+        # Caps read from the cluster are not written again either.
+        self.check_call.reset_mock()
+        snapshot = self._snapshot(pools=['p1', 'p2'], caps={
+            'client.rgw': broker.compile_service_caps(service, snapshot)})
+        broker.update_service_permissions(
+            'rgw', service, batch=broker.BrokerBatch('admin', snapshot))
+        self.check_call.assert_not_called()
+
+    def test_set_pool_quota(self):
+        snapshot = self._snapshot(pools=[
+            {'pool_name': 'p1', 'quota_max_bytes': 1024}])
+        batch = broker.BrokerBatch('admin', snapshot=snapshot)
+        broker._set_pool_quota('admin', 'p1', 1024, None, batch=batch)
+        self.set_pool_quota.assert_not_called()
+        for _ in range(2):
+            broker._set_pool_quota('admin', 'p1', 1024, 10, batch=batch)
+        self.set_pool_quota.assert_called_once_with(
+            service='admin', pool_name='p1', max_bytes=1024, max_objects=10)
+        self.assertEqual(snapshot.pool('p1')['quota_max_objects'], 10)
+
+    def test_set_pool_options(self):
+        snapshot = self._snapshot(pools=[
+            {'pool_name': 'p1', 'options': {'compression_mode': 'none'}}])
+        batch = broker.BrokerBatch('admin', snapshot=snapshot)
+        wanted = {'compression_mode': 'aggressive',
+                  'compression_algorithm': 'zstd'}
+        for _ in range(2):
+            broker._set_pool_options('admin', 'p1', wanted, batch=batch)
+        self.assertEqual(self.pool_set.call_count, 2)
+        self.pool_set.assert_any_call(service='admin', pool_name='p1',
+                                      key='compression_mode',
+                                      value='aggressive')
+        self.pool_set.assert_any_call(service='admin', pool_name='p1',
+                                      key='compression_algorithm',
+                                      value='zstd')
+        self.assertEqual(snapshot.pool('p1')['options'], wanted)
+
+    def test_tag_pool(self):
+        group = {'pools': ['p1', 'p2', 'p3', 'p4'], 'services': [],
+                 'app-name': 'rgw', 'tag': 'group-objects'}
+        snapshot = self._snapshot(
+            pools=[
+                {'pool_name': 'p1'},
+                {'pool_name': 'p2', 'application_metadata': {'rgw': {}}},
+                {'pool_name': 'p3', 'application_metadata': {'rbd': {}}}],
+            config_keys={'cephx.groups.objects': json.dumps(group)})
+        batch = broker.BrokerBatch('admin', snapshot=snapshot)
+        for _ in range(2):
+            broker.tag_group_pools('admin', 'objects', batch)
+        # NOTE: p3 is used by another application and p4 does not exist.
+        self.assertEqual(
+            [c[0][0][6:] for c in self.check_call.call_args_list],
+            [['enable', 'p1', 'rgw'],
+             ['set', 'p1', 'rgw', 'group-objects', 'true'],
+             ['set', 'p2', 'rgw', 'group-objects', 'true']])
+        self.assertTrue(broker.tag_pool('admin', 'p2', group, batch))
+        self.assertFalse(broker.tag_pool('admin', 'p3', group, batch))
+        self.assertFalse(broker.tag_pool('admin', 'p4', group, batch))
+        self.assertEqual(self.check_call.call_count, 3)
@@ -12,6 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import os
+import shutil
+import stat
+import tempfile
+
 from mock import patch, call
 
 import ceph_rgw as ceph  # noqa
@@ -21,10 +27,21 @@ from test_utils import CharmTestCase  # noqa
 
 TO_PATCH = [
     'config',
-    'os',
-    'subprocess',
+    'get_broker_rsp_key',
+    'grp',
+    'is_leader',
+    'leader_get',
+    'leader_set',
+    'local_unit',
+    'log',
     'mkdir',
+    'pwd',
+    'related_units',
+    'relation_get',
+    'relation_ids',
+    'relation_set',
     'service_name',
+    'unitdata',
 ]
 
 
@@ -33,34 +50,296 @@ class CephRadosGWCephTests(CharmTestCase):
         super(CephRadosGWCephTests, self).setUp(ceph, TO_PATCH)
         self.config.side_effect = self.test_config.get
         self.service_name.return_value = 'ceph-radosgw'
+        for attr in ('_broker_requests', '_request_states'):
+            _m = patch.object(ceph, attr, {})
+            _m.start()
+            self.addCleanup(_m.stop)
+        # NOTE: CephBlueStoreCompressionContext reads the config itself and
+        #       validates it with a pool, which checks the ceph version.
+        for target, new in (
+                ('charmhelpers.contrib.openstack.context.config',
+                 self.test_config.get),
+                ('charmhelpers.contrib.storage.linux.ceph.cmp_pkgrevno',
+                 lambda *args: 1)):
+            _m = patch(target, new)
+            _m.start()
+            self.addCleanup(_m.stop)
+        self.local_unit.return_value = 'ceph-radosgw/0'
+        self.get_broker_rsp_key.return_value = 'broker-rsp-ceph-radosgw-0'
+        self._relation_data = {}
+        self.relation_ids.side_effect = (
+            lambda relation: ['mon:1'] if self._relation_data else [])
+        self.related_units.side_effect = lambda rid: sorted(
+            unit for unit in self._relation_data
+            if unit != 'ceph-radosgw/0')
+        self.relation_get.side_effect = (
+            lambda attribute=None, rid=None, unit=None:
+            self._relation_data.get(unit, {}).get(attribute)
+            if attribute else self._relation_data.get(unit, {}))
+        self.unitdata.kv.return_value = self.test_kv
+        self._leader_data = {}
+        self.leader_get.side_effect = self._leader_data.get
+        self.leader_set.side_effect = self._leader_data.update
+
+    def _mons(self, api_version=None, count=3):
+        for unit in range(count):
+            self._relation_data['ceph-mon/{}'.format(unit)] = (
+                {'broker-api-version': api_version} if api_version else {})
+
+    def _broker_rsp(self, rq, states, exit_code=0, api_version=2):
+        self._relation_data['ceph-radosgw/0'] = {'broker_req': rq.request}
+        rsp = {'exit-code': exit_code, 'request-id': rq.request_id,
+               'api-version': api_version,
+               'ops': [{'state': state} for state in states]}
+        self._relation_data['ceph-mon/0']['broker-rsp-ceph-radosgw-0'] = (
+            json.dumps(rsp))
+
+    def _keyring_dirs(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        for name in ('etc', 'lib'):
+            os.mkdir(os.path.join(tmpdir, name))
+        for name, directory in (('CEPH_DIR', 'etc'),
+                                ('CEPH_RADOSGW_DIR', 'lib')):
+            patcher = patch.object(ceph, name,
+                                   os.path.join(tmpdir, directory))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.pwd.getpwnam.return_value.pw_uid = os.getuid()
+        self.grp.getgrnam.return_value.gr_gid = os.getgid()
+        self.mkdir.side_effect = lambda path, **kwargs: os.makedirs(path)
+        return tmpdir
+
+    def test_render_keyring(self):
+        self.assertEqual(ceph.render_keyring('rgw.juju-host', 'mykey'),
+                         '[client.rgw.juju-host]\n\tkey = mykey\n')
 
     def test_import_radosgw_key(self):
-        self.os.path.exists.return_value = False
-        self.os.path.join.return_value = '/etc/ceph/keyring.rados.gateway'
-        ceph.import_radosgw_key('mykey')
-        cmd = [
-            'ceph-authtool',
-            '/etc/ceph/keyring.rados.gateway',
-            '--create-keyring',
-            '--name=client.radosgw.gateway',
-            '--add-key=mykey'
-        ]
-        self.subprocess.check_call.assert_has_calls([
-            call(cmd),
-            call(['chown', 'root:root',
-                  '/etc/ceph/keyring.rados.gateway'])
-        ])
+        tmpdir = self._keyring_dirs()
+        path = os.path.join(tmpdir, 'etc', 'keyring.rados.gateway')
+        self.assertTrue(ceph.import_radosgw_key('mykey'))
+        with open(path) as f:
+            self.assertEqual(f.read(),
+                             '[client.radosgw.gateway]\n\tkey = mykey\n')
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+        self.pwd.getpwnam.assert_called_with('root')
+        self.grp.getgrnam.assert_called_with('root')
+        self.assertFalse(self.mkdir.called)
+        self.assertEqual(os.listdir(os.path.join(tmpdir, 'etc')),
+                         ['keyring.rados.gateway'])
+
+    def test_import_radosgw_key_per_unit(self):
+        tmpdir = self._keyring_dirs()
+        path = os.path.join(tmpdir, 'lib', 'ceph-rgw.juju-host', 'keyring')
+        link = os.path.join(tmpdir, 'etc', 'ceph.client.rgw.juju-host.keyring')
+        self.assertTrue(ceph.import_radosgw_key('mykey', name='rgw.juju-host'))
+        self.mkdir.assert_called_once_with(path=os.path.dirname(path),
+                                           owner='ceph', group='ceph',
+                                           perms=0o750)
+        self.pwd.getpwnam.assert_called_with('ceph')
+        self.assertEqual(os.readlink(link), path)
+        with open(link) as f:
+            self.assertEqual(f.read(),
+                             '[client.rgw.juju-host]\n\tkey = mykey\n')
+
+    def test_import_radosgw_key_unchanged(self):
+        self._keyring_dirs()
+        self.assertTrue(ceph.import_radosgw_key('mykey', name='rgw.host'))
+        with patch.object(ceph.os, 'rename') as rename:
+            self.assertFalse(ceph.import_radosgw_key('mykey',
+                                                     name='rgw.host'))
+            self.assertFalse(rename.called)
+
+    def test_import_radosgw_key_rotated(self):
+        tmpdir = self._keyring_dirs()
+        self.assertTrue(ceph.import_radosgw_key('mykey', name='rgw.host'))
+        self.assertTrue(ceph.import_radosgw_key('newkey', name='rgw.host'))
+        with open(os.path.join(tmpdir, 'etc',
+                               'ceph.client.rgw.host.keyring')) as f:
+            self.assertEqual(f.read(), '[client.rgw.host]\n\tkey = newkey\n')
+
+    def test_write_keyring_mode(self):
+        tmpdir = self._keyring_dirs()
+        path = os.path.join(tmpdir, 'keyring')
+        self.assertTrue(ceph.write_keyring(path, 'contents', 'root', 'root'))
+        os.chmod(path, 0o644)
+        self.assertTrue(ceph.write_keyring(path, 'contents', 'root', 'root'))
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+        self.assertFalse(ceph.write_keyring(path, 'contents', 'root', 'root'))
+
+    def test_write_keyring_failure(self):
+        tmpdir = self._keyring_dirs()
+        path = os.path.join(tmpdir, 'keyring')
+        with open(path, 'w') as f:
+            f.write('old')
+        with patch.object(ceph.os, 'rename', side_effect=OSError):
+            self.assertRaises(OSError, ceph.write_keyring, path, 'new',
+                              'root', 'root')
+        with open(path) as f:
+            self.assertEqual(f.read(), 'old')
+        self.assertEqual(sorted(os.listdir(tmpdir)),
+                         ['etc', 'keyring', 'lib'])
+
+    @patch('charmhelpers.contrib.storage.linux.ceph.cmp_pkgrevno',
+           lambda *args: 1)
+    def test_create_rgw_pools_rq_cached(self):
+        self.test_config.set('rgw-lightweight-pool-pg-num', 10)
+        with patch.object(ceph, '_create_rgw_pools_rq',
+                          wraps=ceph._create_rgw_pools_rq) as create:
+            rq = ceph.get_create_rgw_pools_rq(prefix='us-east')
+            rq.add_op({'op': 'rotate-key', 'name': 'rgw.host'})
+            again = ceph.get_create_rgw_pools_rq(prefix='us-east')
+            create.assert_called_once_with(prefix='us-east', api_version=1)
+            self.assertEqual(again.ops, rq.ops[:-1])
+            self.assertEqual(ceph.ops_digest(again),
+                             ceph.ops_digest(ceph.get_create_rgw_pools_rq(
+                                 prefix='us-east')))
+            self.test_config.set('rgw-lightweight-pool-pg-num', 20)
+            changed = ceph.get_create_rgw_pools_rq(prefix='us-east')
+            self.assertEqual(create.call_count, 2)
+            self.assertNotEqual(ceph.ops_digest(changed),
+                                ceph.ops_digest(again))
+
+    @patch('charmhelpers.contrib.storage.linux.ceph.cmp_pkgrevno',
+           lambda *args: 1)
+    @patch.object(ceph, '_is_request_complete')
+    def test_is_request_complete_cached(self, _is_request_complete):
+        _is_request_complete.return_value = False
+        self._mons()
+        rq = ceph.get_create_rgw_pools_rq()
+        self._broker_rsp(rq, [])
+        self.assertFalse(ceph.is_request_complete(rq, relation='mon'))
+        self.assertFalse(ceph.is_request_complete(
+            ceph.get_create_rgw_pools_rq(), relation='mon'))
+        _is_request_complete.assert_called_once_with(rq, relation='mon')
+        ceph.send_request_if_needed(rq, relation='mon')
+        self.assertFalse(self.relation_set.called)
+        _is_request_complete.return_value = True
+        self.assertTrue(ceph.is_request_complete(rq, relation='mon'))
+
+    @patch('charmhelpers.contrib.storage.linux.ceph.cmp_pkgrevno',
+           lambda *args: 1)
+    @patch.object(ceph, '_is_request_complete')
+    def test_request_compression_changed(self, _is_request_complete):
+        _is_request_complete.return_value = True
+        self._mons(api_version='2')
+        rq = ceph.get_create_rgw_pools_rq()
+        self._broker_rsp(rq, ['complete'] * len(rq.ops))
+        self.assertTrue(ceph.is_request_complete(rq))
+        self.test_config.set('bluestore-compression-mode', 'aggressive')
+        changed = ceph.get_create_rgw_pools_rq()
+        # NOTE: CephBrokerRq's own comparison ignores compression.
+        self.assertEqual(changed, rq)
+        self.assertFalse(ceph.same_request(changed, rq))
+        self.assertFalse(ceph.is_request_complete(changed))
+        self.assertIsNone(ceph.get_request_response(changed))
+        ceph.send_request_if_needed(changed)
+        self.relation_set.assert_called_once_with(
+            relation_id='mon:1', broker_req=changed.request)
+
+    @patch('charmhelpers.contrib.storage.linux.ceph.cmp_pkgrevno',
+           lambda *args: 1)
+    @patch.object(ceph, '_is_request_complete')
+    def test_request_rotate_key_nonce_changed(self, _is_request_complete):
+        _is_request_complete.return_value = True
+        self._mons(api_version='2')
+        rq = ceph.get_create_rgw_pools_rq()
+        rq.add_op({'op': 'rotate-key', 'name': 'rgw.host', 'nonce': 'old'})
+        self._broker_rsp(rq, ['complete'] * len(rq.ops))
+        self.assertTrue(ceph.is_request_complete(rq))
+        rotation = ceph.get_create_rgw_pools_rq()
+        rotation.add_op({'op': 'rotate-key', 'name': 'rgw.host',
+                         'nonce': 'new'})
+        self.assertFalse(ceph.is_request_complete(rotation))
+        ceph.send_request_if_needed(rotation)
+        self.relation_set.assert_called_once_with(
+            relation_id='mon:1', broker_req=rotation.request)
+
+    @patch('charmhelpers.contrib.storage.linux.ceph.cmp_pkgrevno',
+           lambda *args: 1)
+    def test_get_request_responder(self):
+        self._mons(api_version='2')
+        rq = ceph.get_create_rgw_pools_rq()
+        self.assertIsNone(ceph.get_request_responder(rq))
+        self._broker_rsp(rq, ['complete'] * len(rq.ops))
+        self.assertEqual(ceph.get_request_responder(rq),
+                         ('mon:1', 'ceph-mon/0'))
+        # The response to another request is not an answer.
+        rq.add_op({'op': 'rotate-key', 'name': 'rgw.host', 'nonce': 'new'})
+        self.assertIsNone(ceph.get_request_responder(rq))
+
+    def test_broker_api_version(self):
+        self.assertEqual(ceph.broker_api_version(), 1)
+        self._mons(api_version='2')
+        self.assertEqual(ceph.broker_api_version(), 2)
+        self._relation_data['ceph-mon/3'] = {}
+        self.assertEqual(ceph.broker_api_version(), 1)
+
+    @patch('charmhelpers.contrib.storage.linux.ceph.cmp_pkgrevno',
+           lambda *args: 1)
+    def test_create_rgw_pools_rq_api_version(self):
+        self.assertEqual(ceph.get_create_rgw_pools_rq().api_version, 1)
+        self._mons(api_version='2')
+        self.assertEqual(ceph.get_create_rgw_pools_rq().api_version, 2)
+
+    @patch('charmhelpers.contrib.storage.linux.ceph.cmp_pkgrevno',
+           lambda *args: 1)
+    def test_request_pools_ready(self):
+        self.test_config.set('restrict-ceph-pools', True)
+        self._mons(api_version='2')
+        rq = ceph.get_create_rgw_pools_rq(prefix='us-east')
+        self.assertFalse(ceph.request_pools_ready(rq))
+        names = [op.get('name') for op in rq.ops]
+        states = ['complete' if name.endswith(ceph.STARTUP_POOLS) or
+                  op['op'] == 'add-permissions-to-key' else 'pending'
+                  for name, op in zip(names, rq.ops)]
+        states[names.index('us-east.rgw.log')] = 'in-progress'
+        self._broker_rsp(rq, states, exit_code=1)
+        self.assertTrue(ceph.request_pools_ready(rq))
+        states[names.index('us-east.rgw.meta')] = 'failed'
+        self._broker_rsp(rq, states, exit_code=1)
+        self.assertFalse(ceph.request_pools_ready(rq))
+        self._broker_rsp(rq, [], api_version=None)
+        self.assertFalse(ceph.request_pools_ready(rq))
+
+    @patch('charmhelpers.contrib.storage.linux.ceph.cmp_pkgrevno',
+           lambda *args: 1)
+    def test_resume_request(self):
+        self._mons(api_version='2')
+        rq = ceph.get_create_rgw_pools_rq()
+        request_id = rq.request_id
+        states = ['complete'] * 4 + ['failed'] + ['pending'] * 10
+        self._broker_rsp(rq, states, exit_code=1)
+        self.assertTrue(ceph.resume_request(rq))
+        self.assertNotEqual(rq.request_id, request_id)
+        self.relation_set.assert_called_once_with(relation_id='mon:1',
+                                                  broker_req=rq.request)
+        # Failing again at the same op.
+        self._broker_rsp(rq, states, exit_code=1)
+        self.assertFalse(ceph.resume_request(rq))
+        states = ['complete'] * 5 + ['failed'] + ['pending'] * 9
+        self._broker_rsp(rq, states, exit_code=1)
+        self.assertTrue(ceph.resume_request(rq))
+        self._broker_rsp(rq, ['complete'] * 15)
+        self.assertFalse(ceph.resume_request(rq))
+        self._broker_rsp(rq, [], exit_code=1, api_version=None)
+        self.assertFalse(ceph.resume_request(rq))
+        self.assertEqual(self.relation_set.call_count, 2)
 
+    @patch('charmhelpers.contrib.storage.linux.ceph.CephBrokerRq'
+           '.add_op_create_replicated_pool')
     @patch('charmhelpers.contrib.storage.linux.ceph.CephBrokerRq'
            '.add_op_create_pool')
-    def test_create_rgw_pools_rq_with_prefix(self, mock_broker):
+    def test_create_rgw_pools_rq_with_prefix(self, mock_broker,
+                                             mock_replicated_pool):
         self.test_config.set('rgw-lightweight-pool-pg-num', 10)
         self.test_config.set('ceph-osd-replication-count', 3)
         self.test_config.set('rgw-buckets-pool-weight', 19)
         ceph.get_create_rgw_pools_rq(prefix='us-east')
+        mock_replicated_pool.assert_called_once_with(
+            replica_count=3, weight=19, name='us-east.rgw.buckets.data',
+            group='objects', app_name='rgw')
         mock_broker.assert_has_calls([
-            call(replica_count=3, weight=19, name='us-east.rgw.buckets.data',
-                 group='objects', app_name='rgw'),
             call(pg_num=10, replica_count=3, name='us-east.rgw.control',
                  group='objects', app_name='rgw'),
             call(pg_num=10, replica_count=3, name='us-east.rgw.data.root',
@@ -92,19 +371,23 @@ class CephRadosGWCephTests(CharmTestCase):
         )
 
     @patch('charmhelpers.contrib.storage.linux.ceph.CephBrokerRq'
-           '.add_op_request_access_to_group')
+           '.add_op')
+    @patch('charmhelpers.contrib.storage.linux.ceph.CephBrokerRq'
+           '.add_op_create_replicated_pool')
     @patch('charmhelpers.contrib.storage.linux.ceph.CephBrokerRq'
            '.add_op_create_pool')
     def test_create_rgw_pools_rq_no_prefix_post_jewel(self, mock_broker,
-                                                      mock_request_access):
+                                                      mock_replicated_pool,
+                                                      mock_add_op):
         self.test_config.set('rgw-lightweight-pool-pg-num', -1)
         self.test_config.set('ceph-osd-replication-count', 3)
         self.test_config.set('rgw-buckets-pool-weight', 19)
         self.test_config.set('restrict-ceph-pools', True)
         ceph.get_create_rgw_pools_rq(prefix=None)
+        mock_replicated_pool.assert_called_once_with(
+            replica_count=3, weight=19, name='default.rgw.buckets.data',
+            group='objects', app_name='rgw')
         mock_broker.assert_has_calls([
-            call(replica_count=3, weight=19, name='default.rgw.buckets.data',
-                 group='objects', app_name='rgw'),
             call(weight=0.10, replica_count=3, name='default.rgw.control',
                  group='objects', app_name='rgw'),
             call(weight=0.10, replica_count=3, name='default.rgw.data.root',
@@ -136,20 +419,21 @@ class CephRadosGWCephTests(CharmTestCase):
             call(weight=0.10, replica_count=3, name='.rgw.root',
                  group='objects', app_name='rgw')],
         )
-        mock_request_access.assert_called_with(key_name='radosgw.gateway',
-                                               name='objects',
-                                               permission='rwx')
+        mock_add_op.assert_called_with({
+            'op': 'add-permissions-to-key', 'group': 'objects',
+            'name': 'radosgw.gateway', 'group-permission': 'rwx',
+            'app-name': 'rgw'})
 
     @patch('charmhelpers.contrib.storage.linux.ceph.CephBrokerRq'
            '.add_op_create_erasure_profile')
     @patch('charmhelpers.contrib.storage.linux.ceph.CephBrokerRq'
            '.add_op_create_erasure_pool')
     @patch('charmhelpers.contrib.storage.linux.ceph.CephBrokerRq'
-           '.add_op_request_access_to_group')
+           '.add_op')
     @patch('charmhelpers.contrib.storage.linux.ceph.CephBrokerRq'
            '.add_op_create_pool')
     def test_create_rgw_pools_rq_no_prefix_ec(self, mock_broker,
-                                              mock_request_access,
+                                              mock_add_op,
                                               mock_request_create_ec_pool,
                                               mock_request_create_ec_profile):
         self.test_config.set('rgw-lightweight-pool-pg-num', -1)
@@ -212,9 +496,213 @@ class CephRadosGWCephTests(CharmTestCase):
             call(weight=0.10, replica_count=3, name='.rgw.root',
                  group='objects', app_name='rgw')],
         )
-        mock_request_access.assert_called_with(key_name='radosgw.gateway',
-                                               name='objects',
-                                               permission='rwx')
+        mock_add_op.assert_called_with({
+            'op': 'add-permissions-to-key', 'group': 'objects',
+            'name': 'radosgw.gateway', 'group-permission': 'rwx',
+            'app-name': 'rgw'})
+
+    @patch('charmhelpers.contrib.storage.linux.ceph.cmp_pkgrevno',
+           lambda *args: 1)
+    def test_create_rgw_pools_rq_ec_performance_profile(self):
+        self.service_name.return_value = 'rgw'
+        self.test_config.set('pool-type', 'erasure-coded')
+        self.test_config.set('ec-performance-profile', 'small-object')
+        ops = ceph.get_create_rgw_pools_rq(prefix=None).ops
+        profile = [op for op in ops
+                   if op['op'] == 'create-erasure-profile'][0]
+        self.assertEqual(profile['stripe-unit'], 4096)
+        self.assertEqual(
+            [(op['name'], op['key'], op['value']) for op in ops
+             if op['op'] == 'set-pool-value'],
+            [('default.rgw.buckets.data', 'compression_mode', 'none'),
+             ('default.rgw.buckets.data', 'fast_read', True)])
+        self.test_config.set('ec-performance-profile', None)
+        ops = ceph.get_create_rgw_pools_rq(prefix=None).ops
+        self.assertFalse([op for op in ops
+                          if op['op'] == 'set-pool-value' or
+                          'stripe-unit' in op])
+
+    @patch('charmhelpers.contrib.storage.linux.ceph.cmp_pkgrevno',
+           lambda *args: 1)
+    def test_create_rgw_pools_rq_ec_profile_recorded(self):
+        self.service_name.return_value = 'rgw'
+        self.test_config.set('pool-type', 'erasure-coded')
+        self.test_config.set('ec-performance-profile', 'throughput')
+        self.is_leader.return_value = True
+        ceph.record_ec_data_pool_profile()
+        self.assertEqual(ceph.ec_data_pool_profile(), ('throughput', 1))
+        # A profile changed once the pool exists does not apply.
+        self.test_config.set('ec-performance-profile', 'small-object')
+        ops = ceph.get_create_rgw_pools_rq(prefix=None).ops
+        profile = [op for op in ops
+                   if op['op'] == 'create-erasure-profile'][0]
+        self.assertEqual(profile['stripe-unit'], 65536)
+        self.assertEqual(
+            [(op['key'], op['value']) for op in ops
+             if op['op'] == 'set-pool-value'],
+            [('compression_mode', 'none'), ('fast_read', False)])
+        ceph.record_ec_data_pool_profile()
+        self.assertEqual(ceph.ec_data_pool_profile(), ('throughput', 1))
+
+    def test_record_ec_data_pool_profile(self):
+        self.test_config.set('ec-performance-profile', 'capacity')
+        self.is_leader.return_value = True
+        ceph.record_ec_data_pool_profile()
+        self.leader_set.assert_not_called()
+        self.test_config.set('pool-type', 'erasure-coded')
+        self.is_leader.return_value = False
+        ceph.record_ec_data_pool_profile()
+        self.leader_set.assert_not_called()
+        self.assertEqual(ceph.ec_data_pool_profile(), ('capacity', 1))
+        self.is_leader.return_value = True
+        ceph.record_ec_data_pool_profile()
+        self.leader_set.assert_called_once_with({
+            ceph.EC_DATA_POOL_PROFILE: json.dumps(
+                {'profile': 'capacity', 'k': 1})})
+
+    @patch('charmhelpers.contrib.storage.linux.ceph.cmp_pkgrevno',
+           lambda *args: 1)
+    def test_create_rgw_pools_rq_compression(self):
+        self.service_name.return_value = 'rgw'
+        self.test_config.set('bluestore-compression-mode', 'aggressive')
+        self.test_config.set('bluestore-compression-algorithm', 'zstd')
+        self.test_config.set('bluestore-compression-min-blob-size', 8192)
+        ops = ceph.get_create_rgw_pools_rq(prefix=None).ops
+        compressed = {op['name']: (op['compression-mode'],
+                                   op['compression-algorithm'],
+                                   op['compression-min-blob-size'])
+                      for op in ops
+                      if op['op'] == 'create-pool' and
+                      op.get('compression-mode')}
+        self.assertEqual(compressed, {
+            'default.rgw.buckets.data': ('aggressive', 'zstd', 8192)})
+        # NOTE: compression configured prevails over the EC profile.
+        self.test_config.set('pool-type', 'erasure-coded')
+        self.test_config.set('ec-performance-profile', 'capacity')
+        ops = ceph.get_create_rgw_pools_rq(prefix=None).ops
+        self.assertEqual(
+            [(op['key'], op['value']) for op in ops
+             if op['op'] == 'set-pool-value'],
+            [('fast_read', False)])
+        self.assertEqual(
+            [op['compression-mode'] for op in ops
+             if op['op'] == 'create-pool' and
+             op['name'] == 'default.rgw.buckets.data'],
+            ['aggressive'])
+
+    @patch.object(ceph.CephBlueStoreCompressionContext, 'validate')
+    def test_data_pool_compression_unset(self, validate):
+        self.assertEqual(ceph.data_pool_compression(), {})
+        validate.assert_not_called()
+
+    @patch('charmhelpers.contrib.storage.linux.ceph.cmp_pkgrevno',
+           lambda *args: 1)
+    def test_create_rgw_pools_rq_invalid_compression(self):
+        self.test_config.set('bluestore-compression-mode', 'sometimes')
+        ops = ceph.get_create_rgw_pools_rq(prefix=None).ops
+        data = [op for op in ops
+                if op['op'] == 'create-pool' and
+                op['name'] == 'default.rgw.buckets.data']
+        self.assertEqual(len(data), 1)
+        self.assertIsNone(data[0]['compression-mode'])
+        self.assertTrue(self.log.called)
+
+    @patch('charmhelpers.contrib.storage.linux.ceph.cmp_pkgrevno',
+           lambda *args: 1)
+    def test_create_rgw_pools_rq_pool_group_settings(self):
+        self.service_name.return_value = 'rgw'
+        self.test_config.set('rgw-pool-group-settings', (
+            '{data: {target-size-ratio: 0.6}, '
+            'index: {target-size-bytes: 107374182400}, '
+            'log: {target-size-bytes: 10737418240, max-bytes: 53687091200}}'))
+
+        def settings(ops):
+            keys = ('target-size-bytes', 'target-size-ratio', 'max-bytes')
+            return {op['name']: {key: op[key] for key in keys
+                                 if op.get(key)}
+                    for op in ops if op['op'] == 'create-pool'}
+
+        expected = {
+            'us-east.rgw.buckets.data': {'target-size-ratio': 0.6},
+            'us-east.rgw.buckets.index': {
+                'target-size-bytes': 107374182400},
+            'us-east.rgw.buckets.extra': {
+                'target-size-bytes': 107374182400},
+            'us-east.rgw.control': {},
+            'us-east.rgw.data.root': {},
+            'us-east.rgw.meta': {},
+            'us-east.rgw.users.keys': {},
+            'us-east.rgw.users.email': {},
+            'us-east.rgw.users.swift': {},
+            'us-east.rgw.users.uid': {},
+            '.rgw.root': {},
+        }
+        for pool in ('.rgw.log', '.rgw.usage', '.rgw.intent-log', '.rgw.gc'):
+            expected['us-east' + pool] = {
+                'target-size-bytes': 10737418240, 'max-bytes': 53687091200}
+        ops = ceph.get_create_rgw_pools_rq(prefix='us-east').ops
+        self.assertEqual(settings(ops), expected)
+        self.test_config.set('pool-type', 'erasure-coded')
+        ops = ceph.get_create_rgw_pools_rq(prefix='us-east').ops
+        self.assertEqual(settings(ops), expected)
+        # NOTE: invalid settings are ignored, the unit being blocked.
+        self.test_config.set('rgw-pool-group-settings', '{data: []}')
+        ops = ceph.get_create_rgw_pools_rq(prefix='us-east').ops
+        self.assertEqual(settings(ops),
+                         {name: {} for name in expected})
+
+    @patch('charmhelpers.contrib.storage.linux.ceph.cmp_pkgrevno',
+           lambda *args: 1)
+    @patch.object(ceph, '_is_request_complete')
+    def test_request_pool_group_settings_changed(self,
+                                                 _is_request_complete):
+        _is_request_complete.return_value = True
+        self._mons(api_version='2')
+        rq = ceph.get_create_rgw_pools_rq()
+        self._broker_rsp(rq, ['complete'] * len(rq.ops))
+        self.assertTrue(ceph.is_request_complete(rq))
+        # The settings of existing pools are changed by a new request.
+        self.test_config.set('rgw-pool-group-settings',
+                             '{log: {max-bytes: 53687091200}}')
+        changed = ceph.get_create_rgw_pools_rq()
+        self.assertFalse(ceph.is_request_complete(changed))
+        ceph.send_request_if_needed(changed)
+        self.relation_set.assert_called_once_with(
+            relation_id='mon:1', broker_req=changed.request)
+
+    def test_pool_group_settings(self):
+        self.assertEqual(ceph.pool_group_settings(), {})
+        self.test_config.set('rgw-pool-group-settings',
+                             '{meta: {target-size-ratio: 1, '
+                             'max-objects: 100000}}')
+        self.assertEqual(ceph.pool_group_settings(), {
+            'meta': {'target-size-ratio': 1, 'max-objects': 100000}})
+        for invalid in ('[data]',
+                        '{data: [',
+                        '{objects: {max-bytes: 1024}}',
+                        '{data: {max-bytes: 1.5}}',
+                        '{data: {max-objects: true}}',
+                        '{data: {target-size-ratio: -0.5}}',
+                        '{data: {pg-num: 128}}',
+                        '{data: {target-size-ratio: 0.5, '
+                        'target-size-bytes: 1024}}'):
+            self.test_config.set('rgw-pool-group-settings', invalid)
+            with self.assertRaises(ValueError):
+                ceph.pool_group_settings()
+
+    def test_ec_stripe_settings(self):
+        self.assertEqual(ceph.ec_stripe_settings(None, 4), {})
+        self.assertEqual(ceph.ec_stripe_settings('throughput', 4), {
+            'rgw_max_chunk_size': 4194304,
+            'rgw_obj_stripe_size': 16777216})
+        # 6 stripe units of 64KiB do not divide 4MiB
+        self.assertEqual(ceph.ec_stripe_settings('throughput', 6), {
+            'rgw_max_chunk_size': 3932160,
+            'rgw_obj_stripe_size': 15728640})
+        # a stripe is wider than the chunk size of the profile
+        self.assertEqual(ceph.ec_stripe_settings('small-object', 200), {
+            'rgw_max_chunk_size': 819200,
+            'rgw_obj_stripe_size': 819200})
 
     @patch.object(utils.apt_pkg, 'version_compare', lambda *args: -1)
     @patch.object(utils, 'lsb_release',
@@ -398,6 +398,43 @@ class MonContextTest(CharmTestCase):
         self.assertEqual(expect, mon_ctxt())
         self.assertTrue(mock_ensure_rsv_v6.called)
 
+    @patch.object(ceph, 'config', lambda *args: '{}')
+    @patch.object(context, 'ensure_host_resolvable_v6')
+    def test_ctxt_ec_performance_profile(self, mock_ensure_rsv_v6):
+        self.socket.gethostname.return_value = 'testhost'
+        mon_ctxt = context.MonContext()
+
+        def _relation_get(attr, unit, rid):
+            if attr == 'ceph-public-address':
+                return '10.5.4.1'
+            elif attr == 'auth':
+                return 'cephx'
+            elif attr == 'fsid':
+                return 'testfsid'
+
+        self.relation_get.side_effect = _relation_get
+        self.relation_ids.return_value = ['mon:6']
+        self.related_units.return_value = ['ceph/0']
+        self.test_config.set('ec-performance-profile', 'throughput')
+        self.test_config.set('ec-profile-k', 4)
+        leader_data = {}
+        with patch.object(context.ceph_rgw, 'config',
+                          self.test_config.get), \
+                patch.object(context.ceph_rgw, 'leader_get',
+                             leader_data.get):
+            self.assertNotIn('rgw_max_chunk_size', mon_ctxt())
+            self.test_config.set('pool-type', 'erasure-coded')
+            ctxt = mon_ctxt()
+            self.assertEqual(ctxt['rgw_max_chunk_size'], 4194304)
+            self.assertEqual(ctxt['rgw_obj_stripe_size'], 16777216)
+            # The settings follow the profile the data pool was created
+            # with.
+            leader_data[context.ceph_rgw.EC_DATA_POOL_PROFILE] = (
+                '{"profile": "small-object", "k": 2}')
+            ctxt = mon_ctxt()
+            self.assertEqual(ctxt['rgw_max_chunk_size'], 524288)
+            self.assertEqual(ctxt['rgw_obj_stripe_size'], 524288)
+
     @patch.object(ceph, 'config', lambda *args:
                   '{"client.radosgw.gateway": {"rgw init timeout": 60}}')
     @patch.object(context, 'ensure_host_resolvable_v6')
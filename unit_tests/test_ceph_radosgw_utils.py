@@ -13,6 +13,8 @@
 # limitations under the License.
 
 from mock import (
+    ANY,
+    call,
     patch,
     MagicMock,
 )
@@ -42,8 +44,15 @@ class CephRadosGWUtilTests(CharmTestCase):
         self.get_upstream_version.return_value = '10.2.2'
         self.socket.gethostname.return_value = 'testhost'
         self.config.side_effect = self.test_config.get
+        self.unitdata.kv.return_value = self.test_kv
 
-    def test_assess_status(self):
+    @patch.object(utils, '_status_inputs_digest')
+    @patch.object(utils, 'hook_name')
+    def test_assess_status(self, hook_name, _status_inputs_digest):
+        hook_name.return_value = 'config-changed'
+        _status_inputs_digest.return_value = 'digest'
+        self.test_kv.data[utils.STATUS_INPUTS_KEY] = {
+            'digest': 'digest', 'timestamp': utils.time.time()}
         with patch.object(utils, 'assess_status_func') as asf:
             callee = MagicMock()
             asf.return_value = callee
@@ -54,6 +63,70 @@ class CephRadosGWUtilTests(CharmTestCase):
                 utils.VERSION_PACKAGE
             )
             self.application_version_set.assert_called_with('10.2.2')
+            self.test_kv.set.assert_called_once_with(
+                utils.STATUS_INPUTS_KEY,
+                {'digest': 'digest', 'timestamp': ANY})
+
+    @patch.object(utils, '_status_inputs_digest')
+    @patch.object(utils, 'hook_name')
+    def test_assess_status_update_status(self, hook_name,
+                                         _status_inputs_digest):
+        hook_name.return_value = 'update-status'
+        _status_inputs_digest.return_value = 'digest'
+        self.test_kv.data[utils.STATUS_INPUTS_KEY] = {
+            'digest': 'digest', 'timestamp': utils.time.time()}
+        with patch.object(utils, 'assess_status_func') as asf:
+            # Inputs unchanged since last assessment
+            utils.assess_status('test-config')
+            asf.assert_not_called()
+            self.application_version_set.assert_not_called()
+            self.test_kv.set.assert_not_called()
+
+            # Inputs changed
+            _status_inputs_digest.return_value = 'newdigest'
+            utils.assess_status('test-config')
+            asf.assert_called_once_with('test-config')
+            self.test_kv.set.assert_called_once_with(
+                utils.STATUS_INPUTS_KEY,
+                {'digest': 'newdigest', 'timestamp': ANY})
+
+            # Inputs unchanged but last assessment has expired
+            asf.reset_mock()
+            self.test_kv.data[utils.STATUS_INPUTS_KEY]['timestamp'] -= (
+                utils.STATUS_MAX_AGE + 1)
+            utils.assess_status('test-config')
+            asf.assert_called_once_with('test-config')
+
+    @patch.object(utils, 'services')
+    @patch.object(utils, 'service_running')
+    @patch.object(utils, 'is_unit_paused_set')
+    @patch.object(utils, 'leader_get')
+    def test_status_inputs_digest(self, leader_get, is_unit_paused_set,
+                                  service_running, services):
+        leader_get.return_value = {'restart_nonce': 'nonce'}
+        is_unit_paused_set.return_value = False
+        service_running.return_value = True
+        services.return_value = ['haproxy']
+        _relation_data = {
+            'mon:1': {
+                'ceph-mon/0': {'auth': 'cephx'},
+            },
+        }
+        self.relation_ids.side_effect = lambda name: (
+            list(_relation_data.keys()) if name == 'mon' else [])
+        self.related_units.side_effect = (
+            lambda rid: _relation_data[rid].keys()
+        )
+        self.relation_get.side_effect = (
+            lambda rid, unit: _relation_data[rid][unit]
+        )
+        digest = utils._status_inputs_digest()
+        self.assertEqual(digest, utils._status_inputs_digest())
+        _relation_data['mon:1']['ceph-mon/0']['fsid'] = 'fsid'
+        self.assertNotEqual(digest, utils._status_inputs_digest())
+        digest = utils._status_inputs_digest()
+        service_running.return_value = False
+        self.assertNotEqual(digest, utils._status_inputs_digest())
 
     @patch.object(utils, 'get_optional_interfaces')
     @patch.object(utils, 'check_optional_relations')
@@ -260,38 +333,63 @@ class CephRadosGWUtilTests(CharmTestCase):
         self.assertEqual(utils.service_name(),
                          'radosgw')
 
+    @patch('charmhelpers.contrib.openstack.context.config')
+    @patch.object(utils.ceph_rgw, 'config')
+    @patch.object(utils, 'leader_get')
+    @patch.object(utils.context.CephBlueStoreCompressionContext, 'validate')
+    def test_check_optional_relations_compression(self, validate, leader_get,
+                                                  rgw_config, context_config):
+        rgw_config.side_effect = self.test_config.get
+        context_config.side_effect = self.test_config.get
+        self.relation_ids.return_value = []
+        configs = MagicMock()
+        self.assertEqual(utils.check_optional_relations(configs),
+                         ('unknown', ''))
+        # No compression setting, nothing to validate.
+        validate.assert_not_called()
+        self.test_config.set('bluestore-compression-mode', 'sometimes')
+        validate.side_effect = AssertionError('invalid mode')
+        self.assertEqual(utils.check_optional_relations(configs),
+                         ('blocked', 'Invalid configuration: invalid mode'))
+
+    @patch.object(utils.ceph_rgw, 'leader_get')
+    @patch.object(utils.ceph_rgw, 'config')
+    @patch.object(utils.ceph_rgw, 'data_pool_compression')
+    @patch.object(utils, 'leader_get')
+    def test_check_optional_relations_ec_profile_changed(
+            self, leader_get, data_pool_compression, rgw_config,
+            rgw_leader_get):
+        rgw_config.side_effect = self.test_config.get
+        self.relation_ids.return_value = []
+        self.test_config.set('pool-type', 'erasure-coded')
+        self.test_config.set('ec-performance-profile', 'small-object')
+        rgw_leader_get.return_value = None
+        configs = MagicMock()
+        self.assertEqual(utils.check_optional_relations(configs),
+                         ('unknown', ''))
+        rgw_leader_get.return_value = '{"profile": "throughput", "k": 4}'
+        self.assertEqual(utils.check_optional_relations(configs), (
+            'blocked', 'ec-performance-profile cannot change once the data '
+            'pool exists, created with: throughput'))
+
     def test_restart_nonce_changed_new(self):
-        _db_data = {}
-        mock_db = MagicMock()
-        mock_db.get.side_effect = lambda key: _db_data.get(key)
-        self.unitdata.kv.return_value = mock_db
         self.assertTrue(utils.restart_nonce_changed('foobar'))
-        mock_db.set.assert_called_once_with('restart_nonce',
-                                            'foobar')
-        mock_db.flush.assert_called_once_with()
+        self.test_kv.set.assert_called_once_with('restart_nonce',
+                                                 'foobar')
+        self.test_kv.flush.assert_called_once_with()
 
     def test_restart_nonce_changed_existing(self):
-        _db_data = {
-            'restart_nonce': 'foobar'
-        }
-        mock_db = MagicMock()
-        mock_db.get.side_effect = lambda key: _db_data.get(key)
-        self.unitdata.kv.return_value = mock_db
+        self.test_kv.data['restart_nonce'] = 'foobar'
         self.assertFalse(utils.restart_nonce_changed('foobar'))
-        mock_db.set.assert_not_called()
-        mock_db.flush.assert_not_called()
+        self.test_kv.set.assert_not_called()
+        self.test_kv.flush.assert_not_called()
 
     def test_restart_nonce_changed_changed(self):
-        _db_data = {
-            'restart_nonce': 'foobar'
-        }
-        mock_db = MagicMock()
-        mock_db.get.side_effect = lambda key: _db_data.get(key)
-        self.unitdata.kv.return_value = mock_db
+        self.test_kv.data['restart_nonce'] = 'foobar'
         self.assertTrue(utils.restart_nonce_changed('soofar'))
-        mock_db.set.assert_called_once_with('restart_nonce',
-                                            'soofar')
-        mock_db.flush.assert_called_once_with()
+        self.test_kv.set.assert_called_once_with('restart_nonce',
+                                                 'soofar')
+        self.test_kv.flush.assert_called_once_with()
 
     def test_multisite_deployment(self):
         self.test_config.set('zone', 'testzone')
@@ -308,3 +406,97 @@ class CephRadosGWUtilTests(CharmTestCase):
         self.assertEquals(443, utils.listen_port())
         self.test_config.set('port', 42)
         self.assertEquals(42, utils.listen_port())
+
+    @patch.object(utils, '_published_settings', None)
+    @patch.object(utils, '_published_endpoints', set())
+    @patch.object(utils, 'hookenv')
+    def test_flush_relation_settings(self, mock_hookenv):
+        digest = utils._settings_digest
+        self.test_kv.data[utils.PUBLISHED_SETTINGS_KEY] = {
+            'identity-service:1': {'swift_service': digest('swift'),
+                                   'swift_region': digest('RegionOne')},
+            'object-store:2': {'swift-url': digest('http://10.0.0.1:80')},
+            'cluster:3': {'stale': digest('yes')},
+            'object-store:9': {'swift-url': digest('http://10.0.0.1:80')},
+            'gateway:10': {'hostname': digest('10.0.0.1')},
+        }
+        mock_hookenv.relation_id.return_value = 'cluster:3'
+        self.relation_ids.side_effect = lambda name: {
+            'identity-service': ['identity-service:1'],
+            'object-store': ['object-store:2'],
+            'cluster': ['cluster:3'],
+        }.get(name, [])
+        utils.relation_set(relation_id='identity-service:1',
+                           swift_service='swift',
+                           swift_region='RegionTwo')
+        utils.relation_set(relation_id='identity-service:1',
+                           s3_service='s3', port=80)
+        utils.relation_set(relation_id='object-store:2',
+                           relation_settings={
+                               'swift-url': 'http://10.0.0.1:80'})
+        utils.relation_set(relation_settings={'private-address': '10.0.0.1',
+                                              'stale': None,
+                                              'missing': None})
+        mock_hookenv.relation_set.assert_not_called()
+        utils.flush_relation_settings()
+        mock_hookenv.relation_set.assert_has_calls([
+            call(relation_id='identity-service:1',
+                 relation_settings={'swift_region': 'RegionTwo',
+                                    's3_service': 's3', 'port': 80}),
+            call(relation_id=None,
+                 relation_settings={'private-address': '10.0.0.1',
+                                    'stale': None}),
+        ])
+        self.assertEqual(mock_hookenv.relation_set.call_count, 2)
+        self.assertFalse(utils._pending_relation_settings)
+        # Digests are only saved once the hook has completed, dropping
+        # those of relations no longer listed for relations written to.
+        self.test_kv.set.assert_not_called()
+        utils.save_published_settings()
+        self.assertEqual(self.test_kv.data[utils.PUBLISHED_SETTINGS_KEY], {
+            'identity-service:1': {'swift_service': digest('swift'),
+                                   'swift_region': digest('RegionTwo'),
+                                   's3_service': digest('s3'),
+                                   'port': digest(80)},
+            'object-store:2': {'swift-url': digest('http://10.0.0.1:80')},
+            'cluster:3': {'private-address': digest('10.0.0.1')},
+            'gateway:10': {'hostname': digest('10.0.0.1')},
+        })
+        self.test_kv.flush.assert_called_once_with()
+
+        # Settings published already are not sent again; numbers compare
+        # as published.
+        mock_hookenv.relation_set.reset_mock()
+        utils.relation_set(relation_id='identity-service:1',
+                           swift_region='RegionTwo', port='80')
+        utils.flush_relation_settings()
+        mock_hookenv.relation_set.assert_not_called()
+        utils.save_published_settings()
+        self.test_kv.flush.assert_called_once_with()
+
+        # Settings of a hook which did not complete are sent again.
+        utils.relation_set(relation_id='identity-service:1', port=443)
+        utils.flush_relation_settings()
+        utils._published_settings = None
+        utils.relation_set(relation_id='identity-service:1', port=443)
+        utils.flush_relation_settings()
+        self.assertEqual(mock_hookenv.relation_set.call_count, 2)
+
+    @patch.object(utils, 'register_configs')
+    def test_lazy_config_renderer(self, register_configs):
+        configs = utils.LazyConfigRenderer()
+        register_configs.assert_not_called()
+        configs.write_all()
+        configs.complete_contexts()
+        register_configs.assert_called_once_with()
+        register_configs.return_value.write_all.assert_called_once_with()
+        (register_configs.return_value.complete_contexts
+         .assert_called_once_with())
+
+    def test_lazy_import(self):
+        self.assertIs(utils.lazy_import('os'), utils.os)
+        with patch.dict(utils.sys.modules):
+            utils.sys.modules.pop('json', None)
+            module = utils.lazy_import('json')
+            self.assertIs(utils.sys.modules['json'], module)
+            self.assertEqual(module.loads('[1]'), [1])
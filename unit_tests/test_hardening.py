@@ -0,0 +1,149 @@
+# Copyright 2020 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+from mock import (
+    patch,
+    MagicMock,
+)
+
+import hardening
+
+from test_utils import CharmTestCase
+
+TO_PATCH = [
+    'charm_dir',
+    'config',
+    'time',
+    'unitdata',
+]
+
+
+class HardeningTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(HardeningTestCase, self).setUp(hardening, TO_PATCH)
+        self.config.side_effect = self.test_config.get
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.charm_dir.return_value = self.tmpdir
+        self.time.time.return_value = 1000.0
+        self.unitdata.kv.return_value = self.test_kv
+        ssh_dir = os.path.join(self.tmpdir, 'ssh')
+        os.mkdir(ssh_dir)
+        self.target = os.path.join(ssh_dir, 'sshd_config')
+        with open(self.target, 'w') as f:
+            f.write('PermitRootLogin no\n')
+        _targets = patch.dict(hardening.HARDENING_TARGETS,
+                              {'ssh': [ssh_dir]})
+        _targets.start()
+        self.addCleanup(_targets.stop)
+
+    def test_fingerprint(self):
+        digest = hardening.fingerprint('ssh')
+        self.assertEqual(hardening.fingerprint('ssh'), digest)
+        with open(self.target, 'a') as f:
+            f.write('PasswordAuthentication no\n')
+        self.assertNotEqual(hardening.fingerprint('ssh'), digest)
+        digest = hardening.fingerprint('ssh')
+        os.chmod(self.target, 0o600)
+        self.assertNotEqual(hardening.fingerprint('ssh'), digest)
+
+    def test_stale_modules(self):
+        self.assertEqual(hardening.stale_modules(['ssh', 'os']),
+                         ['ssh', 'os'])
+        hardening.record_modules(['ssh'])
+        self.test_kv.flush.assert_called_once_with()
+        self.assertEqual(hardening.stale_modules(['ssh']), [])
+        self.assertEqual(hardening.stale_modules(['ssh', 'unknown']),
+                         ['unknown'])
+        # modification of a target
+        with open(self.target, 'a') as f:
+            f.write('PasswordAuthentication no\n')
+        self.assertEqual(hardening.stale_modules(['ssh']), ['ssh'])
+        hardening.record_modules(['ssh'])
+        self.assertEqual(hardening.stale_modules(['ssh']), [])
+        # user provided hardening.yaml
+        with open(os.path.join(self.tmpdir, 'hardening.yaml'), 'w'):
+            pass
+        self.assertEqual(hardening.stale_modules(['ssh']), ['ssh'])
+
+    def test_stale_modules_sweep(self):
+        hardening.record_modules(['ssh'])
+        self.time.time.return_value = 1000.0 + 1440 * 60
+        self.assertEqual(hardening.stale_modules(['ssh']), [])
+        self.time.time.return_value = 1001.0 + 1440 * 60
+        self.assertEqual(hardening.stale_modules(['ssh']), ['ssh'])
+        self.time.time.return_value = 1000.0
+        self.test_config.set('harden-sweep-interval', 0)
+        self.assertEqual(hardening.stale_modules(['ssh']), ['ssh'])
+
+    @patch.object(hardening, 'ch_harden')
+    def test_harden(self, ch_harden):
+        ch_harden.harden.side_effect = (
+            lambda overrides: lambda f: lambda *args, **kwargs: f(*args,
+                                                                  **kwargs))
+        self.test_config.set('harden', 'ssh')
+        _hook = MagicMock()
+        _hook.__name__ = 'update_status'
+        _hook.return_value = 'done'
+        hook = hardening.harden()(_hook)
+        self.assertEqual(hook('arg'), 'done')
+        ch_harden.harden.assert_called_once_with(overrides=['ssh'])
+        self.assertIn('ssh', self.test_kv.data[
+            hardening.HARDENING_FINGERPRINTS_KEY])
+        ch_harden.harden.reset_mock()
+        self.assertEqual(hook('arg'), 'done')
+        ch_harden.harden.assert_not_called()
+        _hook.assert_called_with('arg')
+        self.assertEqual(_hook.call_count, 2)
+
+    @patch.object(hardening, 'ch_harden')
+    def test_harden_hook_changes_target(self, ch_harden):
+        ch_harden.harden.side_effect = (
+            lambda overrides: lambda f: lambda *args, **kwargs: f(*args,
+                                                                  **kwargs))
+        self.test_config.set('harden', 'ssh')
+
+        def _hook():
+            with open(self.target, 'a') as f:
+                f.write('PasswordAuthentication yes\n')
+
+        _hook.__name__ = 'config_changed'
+        hardening.harden()(_hook)()
+        self.assertEqual(hardening.stale_modules(['ssh']), ['ssh'])
+
+    @patch.object(hardening, 'ch_harden')
+    def test_harden_failure(self, ch_harden):
+        def _harden(overrides):
+            def _inner(f):
+                def _run(*args, **kwargs):
+                    raise Exception('audit failed')
+                return _run
+            return _inner
+        ch_harden.harden.side_effect = _harden
+        self.test_config.set('harden', 'ssh')
+        hook = hardening.harden()(MagicMock())
+        self.assertRaises(Exception, hook)
+        self.assertEqual(hardening.stale_modules(['ssh']), ['ssh'])
+
+    @patch.object(hardening, 'ch_harden')
+    def test_harden_disabled(self, ch_harden):
+        _hook = MagicMock()
+        hardening.harden()(_hook)()
+        _hook.assert_called_once_with()
+        ch_harden.harden.assert_not_called()
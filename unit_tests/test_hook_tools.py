@@ -0,0 +1,144 @@
+# Copyright 2020 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import subprocess
+import unittest
+
+from mock import (
+    ANY,
+    call,
+    patch,
+    MagicMock,
+)
+
+import hook_tools
+
+MON_SETTINGS = {
+    'auth': 'cephx',
+    'fsid': '1234',
+    'private-address': '10.0.0.1',
+}
+
+
+class HookToolClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(HookToolClientTestCase, self).setUp()
+        self.subprocess = MagicMock()
+        self.subprocess.check_output.side_effect = self._check_output
+        self.client = hook_tools.HookToolClient(self.subprocess)
+
+    def _check_output(self, args, *popenargs, **kwargs):
+        if args[0] == 'relation-get':
+            if args[4] == '-':
+                return json.dumps(MON_SETTINGS).encode('UTF-8')
+            return json.dumps(MON_SETTINGS.get(args[4])).encode('UTF-8')
+        return b'true'
+
+    def test_memoize_read_only(self):
+        self.assertEqual(self.client.check_output(['is-leader',
+                                                   '--format=json']),
+                         b'true')
+        self.assertEqual(self.client.check_output(['is-leader',
+                                                   '--format=json']),
+                         b'true')
+        self.subprocess.check_output.assert_called_once_with(
+            ['is-leader', '--format=json'])
+        self.assertEqual(self.client.stats['is-leader'],
+                         {'calls': 1, 'memoized': 1, 'seconds': ANY})
+
+    def test_not_memoized(self):
+        self.client.check_output(['status-get', '--format=json'])
+        self.client.check_output(['status-get', '--format=json'])
+        self.client.check_output(['ls', '/'])
+        self.client.check_output(['ls', '/'])
+        self.assertEqual(self.subprocess.check_output.call_count, 4)
+        self.assertEqual(list(self.client.stats.keys()), ['status-get'])
+        self.assertEqual(self.client.stats['status-get']['calls'], 2)
+
+    def test_relation_get_coalesced(self):
+        for attribute in ('fsid', 'auth', 'private-address', 'missing'):
+            self.assertEqual(
+                json.loads(self.client.check_output(
+                    ['relation-get', '--format=json', '-r', 'mon:1',
+                     attribute, 'ceph-mon/0']).decode('UTF-8')),
+                MON_SETTINGS.get(attribute))
+        self.subprocess.check_output.assert_called_once_with(
+            ['relation-get', '--format=json', '-r', 'mon:1', '-',
+             'ceph-mon/0'])
+
+    def test_relation_get_error(self):
+        self.subprocess.check_output.side_effect = (
+            subprocess.CalledProcessError(2, 'relation-get'))
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            self.client.check_output(['relation-get', '--format=json', '-r',
+                                      'mon:1', 'fsid', 'ceph-mon/0'])
+        self.assertEqual(cm.exception.returncode, 2)
+
+    def test_invalidate(self):
+        args = ['relation-get', '--format=json', '-r', 'cluster:1', '-',
+                'ceph-radosgw/0']
+        self.client.check_output(args)
+        self.client.check_output(['leader-get', '--format=json', '-'])
+        self.client.check_call(['relation-set', '-r', 'cluster:1', 'a=b'])
+        self.client.check_output(args)
+        self.client.check_output(['leader-get', '--format=json', '-'])
+        self.subprocess.check_output.assert_has_calls([
+            call(args),
+            call(['leader-get', '--format=json', '-']),
+            call(args),
+        ])
+        self.assertEqual(self.subprocess.check_output.call_count, 3)
+        self.subprocess.check_call.assert_called_once_with(
+            ['relation-set', '-r', 'cluster:1', 'a=b'])
+
+    def test_relation_set_help(self):
+        self.client.check_output(['relation-set', '--help'],
+                                 universal_newlines=True)
+        self.client.check_output(['relation-set', '--help'],
+                                 universal_newlines=True)
+        self.subprocess.check_output.assert_called_once_with(
+            ['relation-set', '--help'], universal_newlines=True)
+
+    def test_passthrough(self):
+        self.assertEqual(self.client.STDOUT, self.subprocess.STDOUT)
+        self.client.call(['juju-log', 'message'])
+        self.subprocess.call.assert_called_once_with(['juju-log', 'message'])
+        self.assertEqual(self.client.stats['juju-log']['calls'], 1)
+
+    def test_report(self):
+        self.client.stats['relation-get'] = {
+            'calls': 2, 'memoized': 10, 'seconds': 0.5}
+        self.client.stats['juju-log'] = {
+            'calls': 4, 'memoized': 0, 'seconds': 1.0}
+        self.assertEqual(self.client.report(), [
+            'juju-log: 4 calls, 1.000s, 0 memoized',
+            'relation-get: 2 calls, 0.500s, 10 memoized',
+        ])
+
+    @patch.object(hook_tools, 'hookenv')
+    def test_install(self, hookenv):
+        hookenv.subprocess = self.subprocess
+        client = hook_tools.install()
+        self.assertTrue(hookenv.subprocess is client)
+        hookenv.atexit.assert_called_once_with(hook_tools.log_report)
+        self.assertTrue(hook_tools.install() is client)
+        hookenv.atexit.assert_called_once_with(hook_tools.log_report)
+        client.check_output(['is-leader', '--format=json'])
+        hook_tools.log_report()
+        hookenv.log.assert_called_once_with(
+            'Hook tool calls: is-leader: 1 calls, {:.3f}s, 0 memoized'.format(
+                client.stats['is-leader']['seconds']),
+            level=hookenv.DEBUG)
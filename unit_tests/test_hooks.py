@@ -21,7 +21,7 @@ from test_utils import (
 )
 from charmhelpers.contrib.openstack.ip import PUBLIC
 
-with patch('charmhelpers.contrib.hardening.harden.harden') as mock_dec:
+with patch('hardening.harden') as mock_dec:
     mock_dec.side_effect = (lambda *dargs, **dkwargs: lambda f:
                             lambda *args, **kwargs: f(*args, **kwargs))
     with patch('charmhelpers.fetch.apt_install'):
@@ -31,9 +31,7 @@ with patch('charmhelpers.contrib.hardening.harden.harden') as mock_dec:
 TO_PATCH = [
     'CONFIGS',
     'add_source',
-    'apt_update',
-    'apt_install',
-    'apt_purge',
+    'apt_transaction',
     'config',
     'cmp_pkgrevno',
     'execd_preinstall',
@@ -56,16 +54,16 @@ TO_PATCH = [
     'service_restart',
     'service_pause',
     'service_resume',
+    'service_running',
     'service',
     'service_name',
     'socket',
+    'key_rotation',
     'restart_map',
     'systemd_based_radosgw',
     'request_per_unit_key',
     'get_certificate_request',
     'process_certificates',
-    'filter_installed_packages',
-    'filter_missing_packages',
     'ceph_utils',
     'multisite_deployment',
 ]
@@ -83,9 +81,22 @@ class CephRadosGWTests(CharmTestCase):
         self.service_name.return_value = 'radosgw'
         self.request_per_unit_key.return_value = False
         self.systemd_based_radosgw.return_value = False
-        self.filter_installed_packages.side_effect = lambda pkgs: pkgs
-        self.filter_missing_packages.side_effect = lambda pkgs: pkgs
         self.multisite_deployment.return_value = False
+        self.service_running.return_value = False
+        self.key_rotation.add_rotate_key_op.return_value = False
+        self.key_rotation.rotation_failed.return_value = False
+        self.key_rotation.advance_rotation.return_value = False
+
+    def test_atexit_order(self):
+        from charmhelpers.core import hookenv
+        callbacks = [callback for callback, _, _ in hookenv._atexit]
+        # Callbacks run last registered first: the hook tool calls are
+        # reported once relation settings and packages are committed.
+        report = callbacks.index(ceph_hooks.hook_tools.log_report)
+        self.assertLess(
+            report, callbacks.index(ceph_hooks.flush_relation_settings))
+        self.assertLess(
+            report, callbacks.index(ceph_hooks.commit_apt_transaction))
 
     def test_upgrade_available(self):
         _vers = {
@@ -116,17 +127,15 @@ class CephRadosGWTests(CharmTestCase):
         upgrade_available.return_value = False
         ceph_hooks.install_packages()
         self.add_source.assert_called_with('distro', 'secretkey')
-        self.apt_update.assert_called_with(fatal=True)
-        self.apt_purge.assert_called_with(ceph_hooks.APACHE_PACKAGES)
-        self.apt_install.assert_called_with(ceph_hooks.PACKAGES,
-                                            fatal=True)
+        transaction = self.apt_transaction.return_value
+        transaction.add_update.assert_called_once_with()
+        transaction.add_install.assert_called_once_with(ceph_hooks.PACKAGES,
+                                                        upgrade=False)
+        transaction.add_purge.assert_called_once_with(
+            ceph_hooks.APACHE_PACKAGES)
+        transaction.commit.assert_called_once_with(
+            fatal=True, message='Installing radosgw packages')
         mock_config.changed.assert_called_with('source')
-        self.filter_installed_packages.assert_called_with(
-            ceph_hooks.PACKAGES
-        )
-        self.filter_missing_packages.assert_called_with(
-            ceph_hooks.APACHE_PACKAGES
-        )
 
     @patch.object(ceph_hooks, 'upgrade_available')
     def test_install_packages_upgrades(self, upgrade_available):
@@ -138,15 +147,15 @@ class CephRadosGWTests(CharmTestCase):
         upgrade_available.return_value = True
         ceph_hooks.install_packages()
         self.add_source.assert_called_with('distro', 'secretkey')
-        self.apt_update.assert_called_with(fatal=True)
-        self.apt_purge.assert_called_with(ceph_hooks.APACHE_PACKAGES)
-        self.apt_install.assert_called_with(ceph_hooks.PACKAGES,
-                                            fatal=True)
+        transaction = self.apt_transaction.return_value
+        transaction.add_update.assert_called_once_with()
+        transaction.add_install.assert_called_once_with(ceph_hooks.PACKAGES,
+                                                        upgrade=True)
+        transaction.add_purge.assert_called_once_with(
+            ceph_hooks.APACHE_PACKAGES)
+        transaction.commit.assert_called_once_with(
+            fatal=True, message='Installing radosgw packages')
         mock_config.changed.assert_called_with('source')
-        self.filter_installed_packages.assert_not_called()
-        self.filter_missing_packages.assert_called_with(
-            ceph_hooks.APACHE_PACKAGES
-        )
 
     @patch.object(ceph_hooks, 'leader_set')
     @patch.object(ceph_hooks, 'is_leader')
@@ -187,15 +196,21 @@ class CephRadosGWTests(CharmTestCase):
         update_nrpe_config.assert_called_with()
         mock_certs_joined.assert_called_once_with('certificates:1')
 
+    def _patch_ceph(self):
+        _ceph = self.patch('ceph')
+        _ceph.get_request_responder.return_value = ('mon:1', 'ceph-mon/0')
+        return _ceph
+
     @patch.object(ceph_hooks, 'is_request_complete',
                   lambda *args, **kwargs: True)
     def test_mon_relation(self):
-        _ceph = self.patch('ceph')
+        _ceph = self._patch_ceph()
         _ceph.import_radosgw_key.return_value = True
         self.relation_get.return_value = 'seckey'
         self.socket.gethostname.return_value = 'testinghostname'
         ceph_hooks.mon_relation()
         self.relation_set.assert_not_called()
+        _ceph.record_ec_data_pool_profile.assert_called_once_with()
         self.service_resume.assert_called_once_with('radosgw')
         _ceph.import_radosgw_key.assert_called_with('seckey',
                                                     name='rgw.testinghostname')
@@ -204,7 +219,7 @@ class CephRadosGWTests(CharmTestCase):
     @patch.object(ceph_hooks, 'is_request_complete',
                   lambda *args, **kwargs: True)
     def test_mon_relation_request_key(self):
-        _ceph = self.patch('ceph')
+        _ceph = self._patch_ceph()
         _ceph.import_radosgw_key.return_value = True
         self.relation_get.return_value = 'seckey'
         self.socket.gethostname.return_value = 'testinghostname'
@@ -219,10 +234,97 @@ class CephRadosGWTests(CharmTestCase):
                                                     name='rgw.testinghostname')
         self.CONFIGS.write_all.assert_called_with()
 
+    @patch.object(ceph_hooks, 'send_request_if_needed')
+    @patch.object(ceph_hooks, 'is_request_complete',
+                  lambda *args, **kwargs: True)
+    def test_mon_relation_rotate_key(self, mock_send_request_if_needed):
+        _ceph = self._patch_ceph()
+        _ceph.import_radosgw_key.return_value = True
+        _ceph.resume_request.return_value = False
+        self.relation_get.return_value = 'newkey'
+        self.socket.gethostname.return_value = 'testinghostname'
+        self.request_per_unit_key.return_value = True
+        self.key_rotation.add_rotate_key_op.return_value = True
+        self.service_running.return_value = True
+        ceph_hooks.mon_relation()
+        self.key_rotation.add_rotate_key_op.assert_called_once_with(
+            _ceph.get_create_rgw_pools_rq.return_value, 'rgw.testinghostname')
+        self.service_restart.assert_called_once_with('radosgw')
+        self.key_rotation.complete_rotation.assert_called_once_with(
+            self.relation_set)
+        # The request is sent again, without the rotate-key op.
+        self.assertEqual(_ceph.get_create_rgw_pools_rq.call_count, 2)
+        mock_send_request_if_needed.assert_called_once_with(
+            _ceph.get_create_rgw_pools_rq.return_value, relation='mon')
+
+    @patch.object(ceph_hooks, 'send_request_if_needed')
+    @patch.object(ceph_hooks, 'is_request_complete',
+                  lambda *args, **kwargs: False)
+    def test_mon_relation_rotate_key_failed(self,
+                                            mock_send_request_if_needed):
+        _ceph = self._patch_ceph()
+        _ceph.request_pools_ready.return_value = True
+        _ceph.resume_request.return_value = False
+        self.relation_get.return_value = 'seckey'
+        self.socket.gethostname.return_value = 'testinghostname'
+        self.request_per_unit_key.return_value = True
+        self.key_rotation.add_rotate_key_op.return_value = True
+        self.key_rotation.rotation_failed.return_value = True
+        ceph_hooks.mon_relation()
+        self.key_rotation.fail_rotation.assert_called_once_with(
+            self.relation_set)
+        self.key_rotation.complete_rotation.assert_not_called()
+        self.assertEqual(_ceph.get_create_rgw_pools_rq.call_count, 2)
+        self.assertTrue(mock_send_request_if_needed.called)
+
+    @patch.object(ceph_hooks, 'is_request_complete',
+                  lambda *args, **kwargs: True)
+    def test_mon_relation_key_rotated(self):
+        _ceph = self._patch_ceph()
+        _ceph.import_radosgw_key.return_value = True
+        self.relation_get.return_value = 'newkey'
+        self.socket.gethostname.return_value = 'testinghostname'
+        self.service_running.return_value = True
+        ceph_hooks.mon_relation()
+        self.service_restart.assert_called_once_with('radosgw')
+        self.service_resume.assert_not_called()
+
+    @patch.object(ceph_hooks, 'is_request_complete',
+                  lambda *args, **kwargs: True)
+    def test_mon_relation_key_unchanged(self):
+        _ceph = self._patch_ceph()
+        _ceph.import_radosgw_key.return_value = False
+        self.relation_get.return_value = 'seckey'
+        self.socket.gethostname.return_value = 'testinghostname'
+        self.service_running.return_value = True
+        ceph_hooks.mon_relation()
+        self.service_restart.assert_not_called()
+        self.service_resume.assert_not_called()
+
+    @patch.object(ceph_hooks, 'is_request_complete',
+                  lambda *args, **kwargs: True)
+    def test_mon_relation_key_from_responder(self):
+        _ceph = self._patch_ceph()
+        _ceph.import_radosgw_key.return_value = True
+        self.relation_get.return_value = 'newkey'
+        self.socket.gethostname.return_value = 'testinghostname'
+        self.request_per_unit_key.return_value = True
+        ceph_hooks.mon_relation(rid='mon:1', unit='ceph-mon/1')
+        self.relation_get.assert_called_once_with(
+            attribute='rgw.testinghostname_key', rid='mon:1',
+            unit='ceph-mon/0')
+        # No unit answered the request, the keyring is left alone.
+        self.relation_get.reset_mock()
+        _ceph.get_request_responder.return_value = None
+        _ceph.import_radosgw_key.reset_mock()
+        ceph_hooks.mon_relation(rid='mon:1', unit='ceph-mon/1')
+        self.relation_get.assert_not_called()
+        _ceph.import_radosgw_key.assert_not_called()
+
     @patch.object(ceph_hooks, 'is_request_complete',
                   lambda *args, **kwargs: True)
     def test_mon_relation_nokey(self):
-        _ceph = self.patch('ceph')
+        _ceph = self._patch_ceph()
         _ceph.import_radosgw_key.return_value = False
         self.relation_get.return_value = None
         ceph_hooks.mon_relation()
@@ -235,8 +337,10 @@ class CephRadosGWTests(CharmTestCase):
                   lambda *args, **kwargs: False)
     def test_mon_relation_send_broker_request(self,
                                               mock_send_request_if_needed):
-        _ceph = self.patch('ceph')
+        _ceph = self._patch_ceph()
         _ceph.import_radosgw_key.return_value = False
+        _ceph.request_pools_ready.return_value = False
+        _ceph.resume_request.return_value = False
         self.relation_get.return_value = 'seckey'
         ceph_hooks.mon_relation()
         self.service_resume.assert_not_called()
@@ -244,6 +348,38 @@ class CephRadosGWTests(CharmTestCase):
         self.assertFalse(self.CONFIGS.called)
         self.assertTrue(mock_send_request_if_needed.called)
 
+    @patch.object(ceph_hooks, 'send_request_if_needed')
+    @patch.object(ceph_hooks, 'is_request_complete',
+                  lambda *args, **kwargs: False)
+    def test_mon_relation_resume_broker_request(self,
+                                                mock_send_request_if_needed):
+        _ceph = self._patch_ceph()
+        _ceph.request_pools_ready.return_value = False
+        _ceph.resume_request.return_value = True
+        ceph_hooks.mon_relation()
+        _ceph.resume_request.assert_called_once_with(
+            _ceph.get_create_rgw_pools_rq.return_value, relation='mon')
+        mock_send_request_if_needed.assert_not_called()
+
+    @patch.object(ceph_hooks, 'send_request_if_needed')
+    @patch.object(ceph_hooks, 'is_request_complete',
+                  lambda *args, **kwargs: False)
+    def test_mon_relation_pools_ready(self, mock_send_request_if_needed):
+        _ceph = self._patch_ceph()
+        _ceph.import_radosgw_key.return_value = True
+        _ceph.request_pools_ready.return_value = True
+        _ceph.resume_request.return_value = False
+        self.relation_get.return_value = 'seckey'
+        self.socket.gethostname.return_value = 'testinghostname'
+        self.request_per_unit_key.return_value = True
+        self.key_rotation.add_rotate_key_op.return_value = True
+        ceph_hooks.mon_relation()
+        self.CONFIGS.write_all.assert_called_with()
+        self.service_resume.assert_called_once_with('radosgw')
+        self.assertTrue(mock_send_request_if_needed.called)
+        # NOTE: the new key may not be there until the request is complete.
+        self.key_rotation.complete_rotation.assert_not_called()
+
     def test_gateway_relation(self):
         self.get_relation_ip.return_value = '10.0.0.1'
         self.listen_port.return_value = 80
@@ -427,8 +563,10 @@ class CephRadosGWTests(CharmTestCase):
                       'internal-address': '10.0.1.1',
                       'private-address': '10.0.3.1'})])
 
+    @patch.object(ceph_hooks, 'is_leader')
     @patch.object(ceph_hooks, 'certs_changed')
-    def test_cluster_changed(self, mock_certs_changed):
+    def test_cluster_changed(self, mock_certs_changed, is_leader):
+        is_leader.return_value = True
         _id_joined = self.patch('identity_joined')
         _relations = {
             'identity-service': ['rid'],
@@ -443,6 +581,17 @@ class CephRadosGWTests(CharmTestCase):
             call('certificates:1', 'vault/0'),
             call('certificates:1', 'vault/1')
         ])
+        self.key_rotation.request_rotation.assert_not_called()
+
+    @patch.object(ceph_hooks, 'is_leader')
+    def test_cluster_departed(self, is_leader):
+        is_leader.return_value = True
+        self.key_rotation.advance_rotation.return_value = True
+        ceph_hooks.cluster_departed()
+        self.key_rotation.request_rotation.assert_called_once_with()
+        is_leader.return_value = False
+        ceph_hooks.cluster_departed()
+        self.key_rotation.request_rotation.assert_called_once_with()
 
     def test_ha_relation_joined(self):
         self.generate_ha_relation_data.return_value = {
@@ -493,6 +642,8 @@ class MiscMultisiteTests(CharmTestCase):
         'slave_relation_changed',
         'service_restart',
         'service_name',
+        'request_per_unit_key',
+        'key_rotation',
     ]
 
     _relation_ids = {
@@ -523,6 +674,16 @@ class MiscMultisiteTests(CharmTestCase):
         self.service_restart.assert_called_once_with('rgw@hostname')
         self.master_relation_joined.assert_called_once_with('master:1')
 
+    def test_leader_settings_changed_rotate_key(self):
+        self.restart_nonce_changed.return_value = False
+        self.is_leader.return_value = False
+        self.request_per_unit_key.return_value = True
+        ceph_hooks.leader_settings_changed()
+        self.key_rotation.request_rotation.assert_called_once_with()
+        self.request_per_unit_key.return_value = False
+        ceph_hooks.leader_settings_changed()
+        self.key_rotation.request_rotation.assert_called_once_with()
+
     def test_process_multisite_relations(self):
         ceph_hooks.process_multisite_relations()
         self.master_relation_joined.assert_called_once_with('master:1')
@@ -786,10 +947,10 @@ class SlaveMultisiteTests(CephRadosMultisiteTests):
         ceph_hooks.slave_relation_changed('slave:1', 'rgw/0')
         self.relation_get.assert_not_called()
 
-    @patch.object(ceph_hooks, 'apt_install')
+    @patch.object(ceph_hooks, 'apt_transaction')
     @patch.object(ceph_hooks, 'services')
     @patch.object(ceph_hooks, 'nrpe')
-    def test_update_nrpe_config(self, nrpe, services, apt_install):
+    def test_update_nrpe_config(self, nrpe, services, apt_transaction):
         # Setup Mocks
         nrpe.get_nagios_hostname.return_value = 'foo'
         nrpe.get_nagios_unit_name.return_value = 'bar'
@@ -801,7 +962,8 @@ class SlaveMultisiteTests(CephRadosMultisiteTests):
         ceph_hooks.update_nrpe_config()
 
         # Verify calls
-        apt_install.assert_called()
+        apt_transaction.return_value.add_install.assert_called_with(
+            'python-dbus')
         nrpe.get_nagios_hostname.assert_called()
         nrpe.get_nagios_unit_name.assert_called()
         nrpe.copy_nrpe_checks.assert_called()
@@ -0,0 +1,225 @@
+# Copyright 2020 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+from mock import MagicMock, call
+
+import key_rotation
+
+from test_utils import CharmTestCase
+
+TO_PATCH = [
+    'ceph_rgw',
+    'config',
+    'is_leader',
+    'leader_get',
+    'leader_set',
+    'local_unit',
+    'log',
+    'related_units',
+    'relation_get',
+    'relation_ids',
+    'send_request_if_needed',
+    'socket',
+    'unitdata',
+]
+
+
+class KeyRotationTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(KeyRotationTestCase, self).setUp(key_rotation, TO_PATCH)
+        self.config.side_effect = self.test_config.get
+        self.socket.gethostname.return_value = 'testinghostname'
+        self.local_unit.return_value = 'rgw/0'
+        self.is_leader.return_value = True
+        self.relation_ids.side_effect = (
+            lambda name: ['cluster:1'] if name == 'cluster' else [])
+        self.related_units.return_value = ['rgw/2', 'rgw/1']
+        self._peer_data = {}
+        self.relation_get.side_effect = (
+            lambda rid, unit: self._peer_data.get(unit))
+        self._leader_data = {}
+        self.leader_get.side_effect = self._leader_data.get
+        self.leader_set.side_effect = self._leader_data.update
+        self.unitdata.kv.return_value = self.test_kv
+        self.ceph_rgw.broker_api_version.return_value = 2
+
+    def _rotation(self, queue, nonce='nonce'):
+        self._leader_data[key_rotation.KEY_ROTATION] = json.dumps(
+            {'nonce': nonce, 'queue': queue})
+
+    def test_start_rotation(self):
+        rotation = key_rotation.start_rotation()
+        self.assertEqual(rotation['queue'], ['rgw/1', 'rgw/2', 'rgw/0'])
+        self.assertEqual(key_rotation.current_rotation(), rotation)
+        with self.assertRaises(ValueError):
+            key_rotation.start_rotation()
+
+    def test_pending_nonce(self):
+        self.assertIsNone(key_rotation.pending_nonce())
+        self._rotation(['rgw/1', 'rgw/0'])
+        self.assertIsNone(key_rotation.pending_nonce())
+        self._rotation(['rgw/0'])
+        self.assertEqual(key_rotation.pending_nonce(), 'nonce')
+        self.test_kv.data[key_rotation.COMPLETED_KEY] = 'nonce'
+        self.assertIsNone(key_rotation.pending_nonce())
+        del self.test_kv.data[key_rotation.COMPLETED_KEY]
+        self.test_kv.data[key_rotation.FAILED_KEY] = 'nonce'
+        self.assertIsNone(key_rotation.pending_nonce())
+
+    def test_cancel_rotation(self):
+        with self.assertRaises(ValueError):
+            key_rotation.cancel_rotation()
+        self._rotation(['rgw/1', 'rgw/0'])
+        self.assertEqual(key_rotation.cancel_rotation()['queue'],
+                         ['rgw/1', 'rgw/0'])
+        self.assertIsNone(key_rotation.current_rotation())
+
+    def test_add_rotate_key_op(self):
+        rq = MagicMock()
+        self.assertFalse(key_rotation.add_rotate_key_op(rq, 'rgw.host'))
+        rq.add_op.assert_not_called()
+        self._rotation(['rgw/0'])
+        self.assertTrue(key_rotation.add_rotate_key_op(rq, 'rgw.host'))
+        rq.add_op.assert_called_once_with(
+            {'op': 'rotate-key', 'name': 'rgw.host', 'nonce': 'nonce'})
+        self.test_kv.flush.assert_called_once_with()
+        self.assertEqual(self.test_kv.data[key_rotation.REQUESTED_KEY],
+                         'nonce')
+        # The op is dropped once the rotation is over.
+        self._leader_data[key_rotation.KEY_ROTATION] = None
+        rq = MagicMock()
+        self.assertFalse(key_rotation.add_rotate_key_op(rq, 'rgw.host'))
+        rq.add_op.assert_not_called()
+        self.assertNotIn(key_rotation.REQUESTED_KEY, self.test_kv.data)
+
+    def test_request_rotation(self):
+        key_rotation.request_rotation()
+        self.send_request_if_needed.assert_not_called()
+        self._rotation(['rgw/0'])
+        key_rotation.request_rotation()
+        rq = self.ceph_rgw.get_create_rgw_pools_rq.return_value
+        rq.add_op.assert_called_once_with(
+            {'op': 'rotate-key', 'name': 'rgw.testinghostname',
+             'nonce': 'nonce'})
+        self.send_request_if_needed.assert_called_once_with(
+            rq, relation='mon')
+        # Sent once only.
+        key_rotation.request_rotation()
+        self.send_request_if_needed.assert_called_once_with(
+            rq, relation='mon')
+        # Sent again without the op once the rotation is cancelled.
+        key_rotation.cancel_rotation()
+        rq.reset_mock()
+        key_rotation.request_rotation()
+        rq.add_op.assert_not_called()
+        self.assertEqual(self.send_request_if_needed.call_count, 2)
+
+    def test_request_rotation_unsupported(self):
+        self.ceph_rgw.broker_api_version.return_value = 1
+        self._rotation(['rgw/0'])
+        key_rotation.request_rotation()
+        self.send_request_if_needed.assert_not_called()
+
+    def _rotate_key_rq(self):
+        rq = MagicMock()
+        rq.ops = [{'op': 'create-pool'}, {'op': 'rotate-key'}]
+        return rq
+
+    def test_rotation_failed(self):
+        rq = self._rotate_key_rq()
+        rsp = self.ceph_rgw.get_request_response
+        self.assertFalse(key_rotation.rotation_failed(rq))
+        self._rotation(['rgw/0'])
+        rsp.return_value = None
+        self.assertFalse(key_rotation.rotation_failed(rq))
+        rsp.return_value = {'exit-code': 0, 'ops': [
+            {'state': 'complete'}, {'state': 'complete'}]}
+        self.assertFalse(key_rotation.rotation_failed(rq))
+        # An op before failed, the rotation is still to be done.
+        rsp.return_value = {'exit-code': 1, 'ops': [
+            {'state': 'failed'}, {'state': 'pending'}]}
+        self.assertFalse(key_rotation.rotation_failed(rq))
+        rsp.return_value = {'exit-code': 1, 'ops': [
+            {'state': 'complete'}, {'state': 'failed'}]}
+        self.assertTrue(key_rotation.rotation_failed(rq))
+        rsp.return_value = {'exit-code': 1}
+        self.assertTrue(key_rotation.rotation_failed(rq))
+        rsp.return_value = None
+        self.ceph_rgw.broker_api_version.return_value = 1
+        self.assertTrue(key_rotation.rotation_failed(rq))
+
+    def test_fail_rotation(self):
+        relation_set = MagicMock()
+        key_rotation.fail_rotation(relation_set)
+        relation_set.assert_not_called()
+        self._rotation(['rgw/0', 'rgw/1'])
+        self.test_kv.data[key_rotation.REQUESTED_KEY] = 'nonce'
+        key_rotation.fail_rotation(relation_set)
+        relation_set.assert_called_once_with(
+            relation_id='cluster:1',
+            relation_settings={key_rotation.KEY_ROTATION_FAILED: 'nonce'})
+        self.assertEqual(self.test_kv.data[key_rotation.FAILED_KEY], 'nonce')
+        self.assertNotIn(key_rotation.REQUESTED_KEY, self.test_kv.data)
+        self.assertIsNone(key_rotation.pending_nonce())
+        # The leader moves on to the next unit.
+        self.assertEqual(key_rotation.current_rotation()['queue'],
+                         ['rgw/1'])
+
+    def test_complete_rotation(self):
+        relation_set = MagicMock()
+        self._rotation(['rgw/0'])
+        key_rotation.complete_rotation(relation_set)
+        relation_set.assert_not_called()
+        self.test_kv.data[key_rotation.REQUESTED_KEY] = 'nonce'
+        key_rotation.complete_rotation(relation_set)
+        relation_set.assert_called_once_with(
+            relation_id='cluster:1',
+            relation_settings={key_rotation.KEY_ROTATED: 'nonce'})
+        self.assertEqual(self.test_kv.data[key_rotation.COMPLETED_KEY],
+                         'nonce')
+        self.assertNotIn(key_rotation.REQUESTED_KEY, self.test_kv.data)
+        self.leader_set.assert_called_once_with(
+            {key_rotation.KEY_ROTATION: None})
+
+    def test_advance_rotation(self):
+        self.assertFalse(key_rotation.advance_rotation())
+        self._rotation(['rgw/1', 'rgw/2', 'rgw/0'])
+        self.assertFalse(key_rotation.advance_rotation())
+        self.leader_set.assert_not_called()
+        self._peer_data['rgw/1'] = {key_rotation.KEY_ROTATED: 'nonce'}
+        self._peer_data['rgw/2'] = {key_rotation.KEY_ROTATED: 'old'}
+        self.assertFalse(key_rotation.advance_rotation())
+        self.assertEqual(key_rotation.current_rotation()['queue'],
+                         ['rgw/2', 'rgw/0'])
+        # rgw/2 left the cluster relation.
+        self.related_units.return_value = ['rgw/1']
+        self.assertTrue(key_rotation.advance_rotation())
+        self.assertEqual(key_rotation.current_rotation()['queue'],
+                         ['rgw/0'])
+        self.test_kv.data[key_rotation.COMPLETED_KEY] = 'nonce'
+        self.assertFalse(key_rotation.advance_rotation())
+        self.assertIsNone(key_rotation.current_rotation())
+        self.assertEqual(self.leader_set.call_args_list[-1],
+                         call({key_rotation.KEY_ROTATION: None}))
+
+    def test_advance_rotation_failed(self):
+        self._rotation(['rgw/1', 'rgw/2', 'rgw/0'])
+        self._peer_data['rgw/1'] = {key_rotation.KEY_ROTATION_FAILED: 'nonce'}
+        self._peer_data['rgw/2'] = {key_rotation.KEY_ROTATED: 'nonce'}
+        self.assertTrue(key_rotation.advance_rotation())
+        self.assertEqual(key_rotation.current_rotation()['queue'],
+                         ['rgw/0'])
@@ -0,0 +1,120 @@
+# Copyright 2020 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import signal
+import tempfile
+import time
+
+from mock import patch
+
+import profiling
+
+from test_utils import CharmTestCase
+
+TO_PATCH = [
+    'charm_dir',
+    'config',
+    'log',
+]
+
+
+def _busy(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+class ProfilingTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(ProfilingTestCase, self).setUp(profiling, TO_PATCH)
+        self.config.side_effect = self.test_config.get
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.charm_dir.return_value = os.path.join(self.tmpdir, 'charm')
+        os.mkdir(self.charm_dir.return_value)
+
+    def test_profiling_enabled(self):
+        self.assertFalse(profiling.profiling_enabled())
+        self.test_config.set('profile-hooks', True)
+        self.assertTrue(profiling.profiling_enabled())
+        self.test_config.set('profile-hooks', False)
+        open(os.path.join(self.charm_dir.return_value, 'profile-hooks'),
+             'w').close()
+        self.assertTrue(profiling.profiling_enabled())
+
+    def test_profile_dir(self):
+        self.assertEqual(profiling.profile_dir(),
+                         os.path.join(self.tmpdir, 'profiles'))
+
+    def test_profile_disabled(self):
+        with profiling.profile('update-status'):
+            _busy(0.01)
+        self.assertFalse(os.path.exists(profiling.profile_dir()))
+
+    def test_profile(self):
+        self.test_config.set('profile-hooks', True)
+        previous = signal.getsignal(signal.SIGALRM)
+        with profiling.profile('update-status'):
+            _busy(0.05)
+        self.assertEqual(signal.getsignal(signal.SIGALRM), previous)
+        self.assertEqual(signal.getitimer(signal.ITIMER_REAL), (0.0, 0.0))
+        profiles = profiling.list_profiles()
+        self.assertEqual(len(profiles), 1)
+        self.assertTrue(profiles[0].endswith('-update-status'))
+        with open(profiles[0] + '.txt') as f:
+            self.assertIn('_busy', f.read())
+        with open(profiles[0] + '.collapsed') as f:
+            stacks = f.read().splitlines()
+        self.assertTrue(stacks)
+        stack, count = stacks[0].rsplit(' ', 1)
+        self.assertIn('test_profiling.py:_busy', stack.split(';'))
+        self.assertTrue(int(count) > 0)
+
+    def test_profile_exception(self):
+        self.test_config.set('profile-hooks', True)
+        with self.assertRaises(ValueError):
+            with profiling.profile('config-changed'):
+                raise ValueError('hook failed')
+        self.assertEqual(len(profiling.list_profiles('config-changed')), 1)
+
+    @patch.object(profiling, 'PROFILE_KEEP', 2)
+    def test_list_profiles(self):
+        os.mkdir(profiling.profile_dir())
+        for name in ('20200101000000-install',
+                     '20200101000001-config-changed',
+                     '20200101000002-update-status',
+                     '20200101000003-mon-relation-changed'):
+            for ext in ('.txt', '.collapsed'):
+                open(os.path.join(profiling.profile_dir(), name + ext),
+                     'w').close()
+        self.assertEqual(
+            [os.path.basename(p) for p in profiling.list_profiles()],
+            ['20200101000003-mon-relation-changed',
+             '20200101000002-update-status',
+             '20200101000001-config-changed',
+             '20200101000000-install'])
+        self.assertEqual(
+            [os.path.basename(p) for p in
+             profiling.list_profiles('config-changed')],
+            ['20200101000001-config-changed'])
+        self.assertEqual(profiling.list_profiles('changed'), [])
+        self.assertEqual(profiling.list_profiles('relation-changed'), [])
+        self.test_config.set('profile-hooks', True)
+        with profiling.profile('update-status'):
+            pass
+        self.assertEqual(len(profiling.list_profiles()), 2)
+        self.assertEqual(profiling.list_profiles('install'), [])
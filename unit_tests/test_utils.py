@@ -17,7 +17,7 @@ import os
 import unittest
 import yaml
 
-from mock import patch
+from mock import MagicMock, patch
 
 
 def load_config():
@@ -65,6 +65,7 @@ class CharmTestCase(unittest.TestCase):
         self.obj = obj
         self.test_config = TestConfig()
         self.test_relation = TestRelation()
+        self.test_kv = TestKV()
         self.patch_all()
 
     def patch(self, method):
@@ -114,3 +115,24 @@ class TestRelation(object):
         elif attr in self.relation_data:
             return self.relation_data[attr]
         return None
+
+
+class TestKV(object):
+    """In memory stand-in for the unitdata.kv() store of charmhelpers.
+
+    get, set, unset and flush are mocks backed by the data dict, so that
+    tests can both inspect the data stored and assert on the calls made.
+    """
+
+    def __init__(self, data=None):
+        self.data = dict(data or {})
+        self.get = MagicMock(side_effect=self._get)
+        self.set = MagicMock(side_effect=self.data.__setitem__)
+        self.unset = MagicMock(side_effect=self._unset)
+        self.flush = MagicMock()
+
+    def _get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def _unset(self, key):
+        self.data.pop(key, None)